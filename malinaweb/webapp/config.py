@@ -5,7 +5,8 @@ class Config(object):
     DEBUG = False
     TESTING = False
     SECRET_KEY = 'fdsafsfdsafdsafh;ljh'
-    ROBOT = Robot()
+    #Components are built on first use so importing the app stays fast
+    ROBOT = Robot(lazy=True)
 
 
 class MalinaConfig(Config):
@@ -1,31 +1,42 @@
 from __future__ import print_function
 from webapp import app, socketio
 from flask_socketio import emit
+from pi2golite import PRIORITY_LOW
 
 ROBOT = app.config["ROBOT"]
-steering = ROBOT.steering
-dist_sensor = ROBOT.components["distance_sensor"]
-obs_lf = ROBOT.components["obstacle_left"]
-obs_rg = ROBOT.components["obstacle_right"]
 connected_users = 0
 
+#Steering is called through the robot so the commands get into telemetry.
+#Robot is lazy - components and methods are looked up when a client uses
+#them so importing the module does not build the robot
 steering_functions = {
-    "dopredu" : steering.forward, "dozadu": steering.reverse,
-    "rotujvlevo" : steering.spin_left, "rotujvpravo" : steering.spin_right,
-    "zatocvpredvpravo" : steering.turn_right, "zatocvpredvlevo": steering.turn_left,
-    "zatocvzadvlevo" : steering.turn_rev_left, "zatocvzadvpravo" : 
-    steering.turn_rev_right, "stop": steering.stop}
+    "dopredu" : "forward", "dozadu": "reverse",
+    "rotujvlevo" : "spin_left", "rotujvpravo" : "spin_right",
+    "zatocvpredvpravo" : "turn_right", "zatocvpredvlevo": "turn_left",
+    "zatocvzadvlevo" : "turn_rev_left", "zatocvzadvpravo" : "turn_rev_right",
+    "stop": "stop"}
+
+def _component(name):
+    return ROBOT.components[name]
 
  #Websockets
 @socketio.on('connect', namespace='/malina')
 def client_connect():
     global connected_users
     connected_users += 1
+    dist_sensor = _component("distance_sensor")
+    obs_lf = _component("obstacle_left")
+    obs_rg = _component("obstacle_right")
     if (connected_users > 0 and ROBOT.is_robot_initiated and not 
             dist_sensor.measure_running.is_set()):
-        dist_sensor.start_distance_measure(lambda dist: socketio.emit('sensors',{'sensor':'distance', 'value':dist}, namespace='/malina'))
-        obs_lf.register_both_callbacks(lambda pin, state: socketio.emit('sensors', {'sensor':'obs_lf', 'value':state}, namespace='/malina'))
-        obs_rg.register_both_callbacks(lambda pin, state: socketio.emit('sensors', {'sensor':'obs_rg', 'value':state}, namespace='/malina'))
+        #UI notifications use the lowest priority so that slow clients
+        #never delay wheel counting or other sensor callbacks
+        dist_sensor.start_distance_measure(lambda dist: socketio.emit('sensors',{'sensor':'distance', 'value':dist}, namespace='/malina'),
+                                           priority=PRIORITY_LOW)
+        obs_lf.register_both_callbacks(lambda pin, state: socketio.emit('sensors', {'sensor':'obs_lf', 'value':state}, namespace='/malina'),
+                                       priority=PRIORITY_LOW)
+        obs_rg.register_both_callbacks(lambda pin, state: socketio.emit('sensors', {'sensor':'obs_rg', 'value':state}, namespace='/malina'),
+                                       priority=PRIORITY_LOW)
     print('New client connected: ' + str(connected_users))
 
 @socketio.on('disconnect', namespace='/malina')
@@ -33,9 +44,9 @@ def client_disconnect():
     global connected_users
     connected_users -= 1
     if connected_users == 0:
-        dist_sensor.stop_distance_measure()
-        obs_lf.remove_callbacks()
-        obs_rg.remove_callbacks()
+        _component("distance_sensor").stop_distance_measure()
+        _component("obstacle_left").remove_callbacks()
+        _component("obstacle_right").remove_callbacks()
     if connected_users < 0:
         connected_users = 0
     print('Client disconnected: ' + str(connected_users))
@@ -43,9 +54,9 @@ def client_disconnect():
 @socketio.on('rychlost', namespace='/malina')
 def io_rychlost(json):
     if json['akce'] == 'zrychli':
-        speed = steering.increase_speed()
+        speed = ROBOT.increase_speed()
     if json['akce'] == 'zpomal':
-        speed = steering.decrease_speed()
+        speed = ROBOT.decrease_speed()
     
     emit('rychlost', {'rychlost' : speed}, broadcast=True)
 
@@ -53,7 +64,7 @@ def io_rychlost(json):
 def io_steering(json):
     action = json['akce']
     if action in steering_functions:
-        steering_functions[action]()
+        getattr(ROBOT, steering_functions[action])()
     else:
         print("Akce neni definovana: " + action)
 
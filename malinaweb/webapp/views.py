@@ -1,3 +1,4 @@
+from __future__ import print_function
 from webapp import app
 from flask import render_template, url_for, redirect
 
@@ -15,5 +16,13 @@ def prepni():
     if ROBOT.is_robot_initiated:
         ROBOT.cleanup()
     else:
-        ROBOT.init()
+        #Hardware comes up in background so the page is served immediately
+        ROBOT.init(background=True).add_done_callback(_report_startup)
     return redirect(url_for('home'))
+
+def _report_startup(future):
+    if future.exception() is not None:
+        app.logger.error("Robot init failed: %s", future.exception())
+        return
+    for name, secs in sorted(ROBOT.startup_times.items(), key=lambda item: -item[1]):
+        app.logger.info("%-20s %8.1f ms", name, secs * 1000)
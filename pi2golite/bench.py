@@ -0,0 +1,186 @@
+"""
+Micro-benchmarks of pi2golite hot paths. Runs against the simulated
+GPIO backend so it can be run anywhere:
+
+    python bench.py [name ...]
+
+Without arguments all benchmarks are run.
+"""
+from __future__ import print_function
+import sys
+import time
+import timeit
+
+from pi2golite import Pi2GoLiteConfig, Robot, VirtualClock, use_gpio
+from pi2golite import simGPIO
+
+
+def _sim_robot():
+    clock = VirtualClock()
+    sim = simGPIO.Simulation(simGPIO.World.box(200, 200), clock=clock)
+    sim.set_pose(100, 100)
+    use_gpio(sim)
+    cfg = Pi2GoLiteConfig()
+    cfg.wheelsensors = dict(cfg.wheelsensors, avail=True)
+    robot = Robot(cfg, clock)
+    robot.init()
+    return robot, sim, clock
+
+
+def _legacy_lookup(robot, attrname):
+    #Attribute lookup as done by Robot.__getattr__ before delegation tables
+    if attrname.startswith('meas_'):
+        attr = attrname[len('meas_'):]
+        if attr in (n for n in dir(robot.measure_steering) if not n.startswith('_')):
+            return getattr(robot.measure_steering, attr)
+    if attrname in (n for n in dir(robot.steering) if not n.startswith('_')):
+        return getattr(robot.steering, attrname)
+    raise AttributeError(attrname)
+
+
+def bench_delegation(number=20000):
+    """Cost of delegated attribute access on Robot and WheelSensor"""
+    robot, _, _ = _sim_robot()
+    whl_sensor = robot.components['wheelsensor_left']
+    line_sensor = robot.components['linesensor_left']
+    results = [
+        ('robot.forward (table)', lambda: robot.forward),
+        ('robot.forward (legacy)', lambda: _legacy_lookup(robot, 'forward')),
+        ('robot.meas_forward (table)', lambda: robot.meas_forward),
+        ('robot.meas_forward (legacy)', lambda: _legacy_lookup(robot, 'meas_forward')),
+        ('wheelsensor.activated (table)', lambda: whl_sensor.activated),
+        ('wheelsensor.activated (legacy)',
+         lambda: getattr(line_sensor, 'activated')
+         if 'activated' in (n for n in dir(line_sensor) if not n.startswith('_'))
+         else None),
+    ]
+    for name, func in results:
+        secs = timeit.timeit(func, number=number)
+        print('%-32s %8.3f us' % (name, secs / number * 1e6))
+
+
+def bench_motor_writes(commands=10000):
+    """PWM writes saved by Motor when the same command is repeated"""
+    robot, _, _ = _sim_robot()
+    for _ in range(commands):
+        robot.forward()
+    for side in ('left_motor', 'right_motor'):
+        motor = robot.components[side]
+        print('%-12s writes: %6d saved: %6d' % (side, motor.writes, motor.saved_writes))
+
+
+def bench_scan(scans=20):
+    """Scans per second of the pan servo sweep scanner in both modes, in
+    the box and with the walls out of range"""
+    from pi2golite.components import Servo
+    from pi2golite.scanner import SweepScanner
+    robot, sim, clock = _sim_robot()
+    servo = Servo(18, 50, 250, 180, simGPIO.SimServoBlaster(sim))
+    servo.init()
+    scanner = SweepScanner(servo, robot.components['distance_sensor'], clock)
+    for world in ('box', 'open'):
+        if world == 'open':
+            sim.world = simGPIO.World()
+        for mode in ('sparse', 'dense'):
+            scanner.set_mode(mode)
+            scanner.reset_stats()
+            start = time.perf_counter()
+            for _ in range(scans):
+                scanner.scan()
+            wall = time.perf_counter() - start
+            print('%-4s %-8s points: %3d  %6.2f scans/s  (%.2f ms CPU per scan)'
+                  % (world, mode, len(scanner.angles), scanner.scans_per_second,
+                     wall / scans * 1e3))
+
+
+def bench_startup():
+    """Per component startup times of sequential and parallel Robot.init"""
+    for parallel in (False, True):
+        robot, _, _ = _sim_robot()
+        robot.cleanup()
+        robot.init(parallel=parallel)
+        print('parallel=%s' % parallel)
+        for name, secs in sorted(robot.startup_times.items(), key=lambda item: -item[1]):
+            print('  %-20s %8.3f ms' % (name, secs * 1e3))
+        robot.cleanup()
+
+
+def bench_fleet(sizes=(1, 10, 100, 1000), duration=2.0):
+    """Robot-steps per second of the fleet simulation as the fleet grows.
+    Every robot drives squares with its MotionQueue"""
+    from pi2golite.fleet import FleetSimulation
+    square = [('forward', 20), ('spin_left', 90)] * 4
+
+    def _drive(robot):
+        robot.motion_queue.run(square, lambda run: _drive(robot))
+
+    for size in sizes:
+        side = int(size ** 0.5 + 0.999)
+        fleet = FleetSimulation(size, simGPIO.World.box(side * 50 + 50, side * 50 + 50))
+        for index in range(size):
+            fleet.set_pose(index, 50 + index % side * 50, 50 + index // side * 50)
+        start = time.perf_counter()
+        robots = fleet.robots()
+        build = time.perf_counter() - start
+        for robot in robots:
+            _drive(robot)
+        ticks = fleet.ticks
+        edges = fleet.edges
+        start = time.perf_counter()
+        fleet.advance(duration)
+        wall = time.perf_counter() - start
+        print('robots: %5d  build %7.3f s  %10.0f robot-steps/s  %8.0f edges/s'
+              % (size, build, (fleet.ticks - ticks) * size / wall,
+                 (fleet.edges - edges) / wall))
+        for robot in robots:
+            robot.motion_queue.cancel()
+            robot.cleanup()
+
+
+def bench_telemetry(edges=100000):
+    """Cost of telemetry recording per sensor edge and PWM write and the
+    resulting CPU share at 10 kHz edge rate"""
+    import shutil
+    import tempfile
+    from pi2golite import TelemetryRecorder, set_recorder
+    robot, _, _ = _sim_robot()
+    sensor = robot.components['obstacle_left']
+    motor = robot.components['left_motor']
+    directory = tempfile.mkdtemp()
+    recorder = TelemetryRecorder(directory, clock=robot.clock)
+    edge = lambda: sensor._on_edge(sensor._pin)
+    speeds = [30, 60] * (edges // 2)
+    pwm = lambda: [motor.forward(speed) for speed in speeds]
+    try:
+        results = {}
+        for state in ('none', 'disabled', 'enabled'):
+            set_recorder(None if state == 'none' else recorder)
+            if state == 'disabled':
+                recorder.disable()
+            else:
+                recorder.enable()
+            results[state] = (min(timeit.repeat(edge, number=edges, repeat=3)) / edges,
+                              min(timeit.repeat(pwm, number=1, repeat=3)) / len(speeds))
+        for state in ('none', 'disabled', 'enabled'):
+            edge_secs, pwm_secs = results[state]
+            overhead = edge_secs - results['none'][0]
+            print('recorder %-8s edge %6.3f us  motor command %6.3f us  '
+                  'overhead at 10 kHz %5.2f %% CPU'
+                  % (state, edge_secs * 1e6, pwm_secs * 1e6, overhead * 1e4 * 100))
+        print('records: %s' % recorder.counts())
+    finally:
+        set_recorder(None)
+        recorder.close()
+        shutil.rmtree(directory)
+
+
+BENCHMARKS = {'delegation': bench_delegation, 'fleet': bench_fleet,
+              'motor_writes': bench_motor_writes, 'scan': bench_scan,
+              'startup': bench_startup, 'telemetry': bench_telemetry}
+
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for bench_name in names:
+        print('== %s ==' % bench_name)
+        BENCHMARKS[bench_name]()
@@ -12,9 +12,7 @@ class MalinaConfig(Pi2GoLiteConfig):
 
 def test():
     r.set_speed(60)
-    for i in range(0,4):
-        r.meas_forward(30)
-        r.meas_turn_left(90)
+    r.motion_queue.run([('forward', 30), ('turn_left', 90)] * 4).wait()
 
 r = Robot(MalinaConfig())
 r.init()
\ No newline at end of file
@@ -1,6 +1,27 @@
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import math
+import threading
+import time
+from pi2golite._helpers import delegation_table
 from pi2golite.components import DistanceSensor, Motor, Sensor, Switch, \
-    WhiteLED, WheelSensor, ServosDriver, WheelCounter
-from pi2golite.behaviours import Steering, StepSteering, MeasureSteering
+    WhiteLED, WheelSensor, ServosDriver, WheelCounter, ServoBlaster, \
+    use_gpio
+from pi2golite.behaviours import Steering, StepSteering, MeasureSteering, \
+    SpeedControl, SpeedRamp, StepMove, MotionQueue, MotionRun
+from pi2golite.aio import AsyncRobot, ObstacleEvent
+from pi2golite.odometry import Odometry, Pose
+from pi2golite.telemetry import TelemetryRecorder, get_recorder, set_recorder
+from pi2golite.clock import SystemClock, VirtualClock, get_clock, set_clock
+from pi2golite.dispatch import Dispatcher, get_dispatcher, set_dispatcher, \
+    PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+
+#State of all sensors at one moment - see Robot.snapshot
+SensorSnapshot = namedtuple('SensorSnapshot', ['timestamp', 'obstacle_left',
+                                               'obstacle_right', 'linesensor_left',
+                                               'linesensor_right', 'switch',
+                                               'distance', 'wheelcount_left',
+                                               'wheelcount_right'])
 
 class Robot(object):
     """
@@ -9,16 +30,50 @@ class Robot(object):
 
     :param cfg:  Instance of Pi2GoLiteConfig. If none then default
                 configuration is used
+           clock: clock used by all components and behaviours. If none
+                then the default clock is used
+           dispatcher: Dispatcher of sensor callbacks. If none then the
+                default one is used or synchronous one for virtual clock
+           lazy: if True components and behaviours are built on first use
+                of the robot instead of in the constructor
     """
 
-    def __init__(self, cfg=None):
+    def __init__(self, cfg=None, clock=None, dispatcher=None, lazy=False):
         self.is_robot_initiated = False
+        self.startup_times = {}
+        self._built = False
+        self._build_lock = threading.RLock()
+        self._init_future = None
+        self.clock = clock if clock is not None else get_clock()
+        if dispatcher is None:
+            if self.clock.realtime:
+                dispatcher = get_dispatcher()
+            else:
+                #Keep simulations deterministic
+                dispatcher = Dispatcher(synchronous=True)
+        self.dispatcher = dispatcher
 
         if not isinstance(cfg, Pi2GoLiteConfig) or cfg is None:
             cfg = Pi2GoLiteConfig()
+        self._cfg = cfg
+        if not lazy:
+            self._build()
+
+    def _build(self):
+        with self._build_lock:
+            if not self._built:
+                start = time.perf_counter()
+                self._build_components(self._cfg)
+                self.startup_times['build'] = time.perf_counter() - start
+                self._built = True
+
+    def _build_components(self, cfg):
+        dispatcher = self.dispatcher
 
         #Defining robot's hardware components
         self.components = {}
+        #Components which have to be initialized before the given one
+        self._dependencies = {}
 
         #Both motor setup
         motor_left = Motor(**cfg.motor_left)
@@ -28,20 +83,27 @@ class Robot(object):
         self.components['right_motor'] = motor_right
 
         #While LEDs setup
-        self.components['front_led'] = WhiteLED(**cfg.front_led)
-        self.components['rear_led'] = WhiteLED(**cfg.rear_led)
+        self.components['front_led'] = WhiteLED(clock=self.clock, **cfg.front_led)
+        self.components['rear_led'] = WhiteLED(clock=self.clock, **cfg.rear_led)
 
         #IR sensors
-        self.components['obstacle_left'] = Sensor(**cfg.obstacle_left)
-        self.components['obstacle_right'] = Sensor(**cfg.obstacle_right)
-        self.components['linesensor_left'] = Sensor(**cfg.linesensor_left)
-        self.components['linesensor_right'] = Sensor(**cfg.linesensor_right)
+        self.components['obstacle_left'] = Sensor(dispatcher=dispatcher, clock=self.clock,
+                                                  **cfg.obstacle_left)
+        self.components['obstacle_right'] = Sensor(dispatcher=dispatcher, clock=self.clock,
+                                                   **cfg.obstacle_right)
+        self.components['linesensor_left'] = Sensor(dispatcher=dispatcher, clock=self.clock,
+                                                    **cfg.linesensor_left)
+        self.components['linesensor_right'] = Sensor(dispatcher=dispatcher, clock=self.clock,
+                                                     **cfg.linesensor_right)
 
         #Switch
-        self.components['switch'] = Switch(**cfg.switch)
+        self.components['switch'] = Switch(dispatcher=dispatcher, clock=self.clock,
+                                           **cfg.switch)
 
         #Distance sensor
-        self.components['distance_sensor'] = DistanceSensor(**cfg.distance_sensor)
+        self.components['distance_sensor'] = DistanceSensor(clock=self.clock,
+                                                          dispatcher=dispatcher,
+                                                          **cfg.distance_sensor)
 
         #Optional components
         #Aliases for wheel sensors as they have to be switched
@@ -52,10 +114,16 @@ class Robot(object):
             whl_sen_rg = WheelSensor(self.components['linesensor_right'])
             self.components['wheelsensor_left'] = whl_sen_lf
             self.components['wheelsensor_right'] = whl_sen_rg
-            whl_cntr_lf = WheelCounter(whl_sen_lf)
-            whl_cntr_rg = WheelCounter(whl_sen_rg)
+            counter_param = self._counter_param(cfg.wheelsensors)
+            whl_cntr_lf = WheelCounter(whl_sen_lf, self.clock, **counter_param)
+            whl_cntr_rg = WheelCounter(whl_sen_rg, self.clock, **counter_param)
             self.components['wheelcounter_left'] = whl_cntr_lf
             self.components['wheelcounter_right'] = whl_cntr_rg
+            #Wheel sensors share the pins with line sensors
+            self._dependencies['wheelsensor_left'] = ('linesensor_left',)
+            self._dependencies['wheelsensor_right'] = ('linesensor_right',)
+            self._dependencies['wheelcounter_left'] = ('wheelsensor_left',)
+            self._dependencies['wheelcounter_right'] = ('wheelsensor_right',)
 
         #Servos
         if cfg.servos['avail']:
@@ -65,42 +133,158 @@ class Robot(object):
         self.steering = Steering(motor_left, motor_right)
 
         if self._whl_counters_avail:
-            self.step_steering = StepSteering(self.steering, whl_cntr_lf, whl_cntr_rg, whl_sen_lf, whl_sen_rg)
+            self.step_steering = StepSteering(self.steering, whl_cntr_lf, whl_cntr_rg,
+                                              whl_sen_lf, whl_sen_rg, self.clock)
             self.measure_steering = MeasureSteering(self.step_steering,
                                                     **cfg.wheelsensors['measure_param'])
+            self.motion_queue = MotionQueue(self.measure_steering)
+            self.odometry = Odometry(whl_cntr_lf, whl_cntr_rg, motor_left, motor_right,
+                                     self.measure_steering.step_distance,
+                                     cfg.wheelsensors['measure_param']['robot_width'],
+                                     self.clock)
+            #Closed loop speed control replacing static motor corrections
+            if cfg.speed_control['avail']:
+                speed_control = SpeedControl(whl_cntr_lf, whl_cntr_rg, self.clock,
+                                             **cfg.speed_control['param'])
+                self.steering.enable_speed_control(speed_control)
+
+        if cfg.speed_ramp['avail']:
+            self.steering.enable_speed_ramp(SpeedRamp(self.clock, **cfg.speed_ramp['param']))
+
+        #Recording of sensor and actuator traffic of all components
+        self.telemetry = None
+        if cfg.telemetry['avail']:
+            self.telemetry = TelemetryRecorder(clock=self.clock, **cfg.telemetry['param'])
+            set_recorder(self.telemetry)
+
+        self._build_delegation()
+
+    @staticmethod
+    def _counter_param(wheelsensors):
+        #Edge rate at speed 100 follows from the wheel speed at full duty
+        #cycle and the distance travelled per step unless configured
+        counter_param = dict(wheelsensors['counter_param'])
+        if counter_param.get('max_rate') is None:
+            measure_param = wheelsensors['measure_param']
+            step_dist = math.pi * measure_param['whl_diameter'] / measure_param['numsteps']
+            counter_param['max_rate'] = wheelsensors['max_speed'] / step_dist
+        return counter_param
+
+    def _build_delegation(self):
+        #Public API of steering behaviours is resolved once so that the
+        #delegated methods cost the same as plain attribute access.
+        #Prefix step_ is used for step_steering, meas_ for measure_steering
+        delegates = [('', self.steering)]
+        if self._whl_counters_avail:
+            delegates.append(('step_', self.step_steering))
+            delegates.append(('meas_', self.measure_steering))
+        exclude = set(dir(type(self))) | set(self.__dict__)
+        self._delegated_attrs = {}
+        for prefix, target in delegates:
+            methods, attributes = delegation_table(target, prefix, exclude)
+            if self.telemetry is not None:
+                #Commands are recorded so the session can be replayed
+                methods = dict((name, self.telemetry.wrap_command(name, method))
+                               for name, method in methods.items())
+            self.__dict__.update(methods)
+            self._delegated_attrs.update(attributes)
 
     def __getattr__(self, attrname):
-        """"Delegate to steering instance to simplify access to key robot's methods"""
+        """Delegate to steering instance to simplify access to key robot's methods.
+        Methods are bound in __init__ so only properties are looked up here"""
+        if attrname.startswith('__') or '_build_lock' not in self.__dict__:
+            raise AttributeError(attrname)
+        if not self._built:
+            #Lazy robot - build on first use of components or behaviours
+            self._build()
+            return getattr(self, attrname)
+        delegated = self.__dict__.get('_delegated_attrs')
+        if delegated and attrname in delegated:
+            target, name = delegated[attrname]
+            return getattr(target, name)
+        raise AttributeError(attrname)
 
+    def snapshot(self):
+        """
+        Returns SensorSnapshot with state of all sensors. Sensor states are
+        maintained by edge events and the distance is the last measured one
+        so no hardware is accessed
+        """
+        comps = self.components
         if self._whl_counters_avail:
-            #Prefix step_ is used for step_steering so try it
-            if attrname.startswith('step_'):
-                attr = attrname.lstrip('step_')
-                if attr in (n for n in dir(self.step_steering) if not n.startswith('_')):
-                    return getattr(self.step_steering, attr)
-
-            #Another allowed prefix is meas_ for meaasure_steering actions
-            elif attrname.startswith('meas_'):
-                attr = attrname.lstrip('meas_')
-                if attr in (n for n in dir(self.measure_steering) if not n.startswith('_')):
-                    return getattr(self.measure_steering, attr)
-
-        #Lastly try steering and if not found raise error
-        if attrname in (name for name in dir(self.steering) if not name.startswith('_')):
-            return getattr(self.steering, attrname)
+            lf_count = comps['wheelcounter_left'].accepted_edges
+            rg_count = comps['wheelcounter_right'].accepted_edges
         else:
-            raise AttributeError(attrname)
+            lf_count = rg_count = None
+        return SensorSnapshot(self.clock.monotonic_ns(),
+                              comps['obstacle_left'].activated,
+                              comps['obstacle_right'].activated,
+                              comps['linesensor_left'].activated,
+                              comps['linesensor_right'].activated,
+                              comps['switch'].activated,
+                              comps['distance_sensor'].last_distance,
+                              lf_count, rg_count)
 
-    def init(self):
-        """Initialize all components connected to pi2golite robot"""
-        for component in self.components.values():
-            component.init()
+    def init(self, parallel=True, background=False):
+        """
+        Initialize all components connected to pi2golite robot.
+        Components are initialized in stages - all components of a stage
+        depend only on components of the previous stages and are
+        initialized concurrently. Time spent by each component is stored
+        in startup_times (in seconds)
+
+        :param  parallel: initialize independent components concurrently
+                background: do not wait for the initialization and return
+                concurrent.futures.Future resolved once the robot is initiated
+        """
+        if background:
+            with self._build_lock:
+                if self._init_future is None or self._init_future.done():
+                    executor = ThreadPoolExecutor(max_workers=1)
+                    self._init_future = executor.submit(self._init, parallel)
+                    executor.shutdown(wait=False)
+                return self._init_future
+        self._init(parallel)
+
+    def _init(self, parallel):
+        start = time.perf_counter()
+        self._build()
+        pending = list(self.components)
+        initiated = set()
+        while pending:
+            stage = [name for name in pending
+                     if all(dep in initiated for dep in self._dependencies.get(name, ()))]
+            if parallel and len(stage) > 1:
+                with ThreadPoolExecutor(max_workers=len(stage)) as executor:
+                    times = list(executor.map(self._init_component, stage))
+            else:
+                times = [self._init_component(name) for name in stage]
+            self.startup_times.update(zip(stage, times))
+            initiated.update(stage)
+            pending = [name for name in pending if name not in initiated]
+        self.startup_times['total'] = time.perf_counter() - start
         self.is_robot_initiated = True
 
+    def _init_component(self, name):
+        start = time.perf_counter()
+        self.components[name].init()
+        return time.perf_counter() - start
+
     def cleanup(self):
         """Clean all components."""
+        if not self._built:
+            return
+        if self._init_future is not None:
+            #Background initialization has to finish first
+            self._init_future.result()
+        #Periodic jobs of speed control and ramp would keep driving the motors
+        self.steering.stop()
+        self.steering.disable_speed_ramp()
+        self.steering.disable_speed_control()
         for component in self.components.values():
             component.cleanup()
+        if self.telemetry is not None:
+            self.telemetry.flush()
         self.is_robot_initiated = False
 
 class Pi2GoLiteConfig(object):
@@ -121,8 +305,19 @@ class Pi2GoLiteConfig(object):
     distance_sensor = {'pin': 8}
     wheelsensors = {'avail': False,
                     'measure_param':{'whl_diameter' : 6.5, 'robot_width': 12,
-                                     'numsteps': 16}}
+                                     'numsteps': 16},
+                    #Wheel speed at speed 100 in distance units per second,
+                    #max_rate None derives the counters' edge rate from it
+                    'max_speed': 40,
+                    'counter_param': {'max_rate': None}}
+    speed_control = {'avail': False,
+                     'param': {'rate': 50, 'kp': 0.5, 'ki': 4.0, 'kd': 0.0}}
+    speed_ramp = {'avail': False,
+                  'param': {'acceleration': 200, 'jerk': 2000, 'rate': 100}}
+    telemetry = {'avail': False,
+                 'param': {'directory': 'telemetry', 'capacity': 65536}}
     servos = {'avail': False,
               'param': {'panpin': 18, 'tiltpin': 22, 'idletimeout': 2000,
                         'minsteps': 50, 'maxsteps': 250, 'panmaxangle': 180,
-                        'tiltmaxangle': 180}}
+                        'tiltmaxangle': 180,
+                        'servoblaster': '/dev/servoblaster'}}
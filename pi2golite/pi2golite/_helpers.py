@@ -6,3 +6,27 @@ def validate_max(value, maxv=100):
     elif value < 0:
         value = 0
     return value
+
+
+def delegation_table(target, prefix='', exclude=()):
+    """
+    Resolves public API of target once. Returns tuple of dictionaries
+    (methods, attributes). Methods maps prefixed name to the bound method,
+    attributes maps prefixed name to tuple (target, name) of the other
+    public attributes (e.g. properties) which have to be read on access
+    """
+    methods = {}
+    attributes = {}
+    cls = type(target)
+    for name in dir(target):
+        if name.startswith('_') or prefix + name in exclude:
+            continue
+        if isinstance(getattr(cls, name, None), property):
+            attributes[prefix + name] = (target, name)
+            continue
+        value = getattr(target, name)
+        if callable(value):
+            methods[prefix + name] = value
+        else:
+            attributes[prefix + name] = (target, name)
+    return methods, attributes
@@ -0,0 +1,173 @@
+"""
+asyncio facade of the Pi2Go Lite robot.
+
+Moves of StepSteering and MeasureSteering are driven by wheel counter edge
+events and only their completion is passed to the event loop (with
+call_soon_threadsafe), so any number of behaviours can await moves, sleep
+and read sensors in one process without a thread per behaviour.
+
+    async def patrol(arobot):
+        await arobot.init()
+        await arobot.meas_forward(30)
+        async for distance in arobot.distances(0.5):
+            ...
+
+Author: Radek Pribyl
+"""
+import asyncio
+import collections
+from pi2golite.behaviours import StepMove
+from pi2golite.dispatch import PRIORITY_HIGH
+
+#Change of an obstacle sensor - see AsyncRobot.obstacles
+ObstacleEvent = collections.namedtuple('ObstacleEvent', ['timestamp', 'side',
+                                                         'activated'])
+
+
+def _set_result(future, result):
+    if not future.done():
+        future.set_result(result)
+
+
+class AsyncRobot(object):
+    """
+    Awaitable facade of Robot. Every method of the robot (including the
+    delegated steering, step_ and meas_ actions) is available as a
+    coroutine function. Actions returning StepMove complete when the move
+    finishes with True, or False when it was cancelled. Cancelling the
+    awaiting task cancels the move. Other attributes are passed through
+
+    :param  robot: instance of Robot
+    """
+    def __init__(self, robot):
+        self._robot = robot
+
+    @property
+    def robot(self):
+        return self._robot
+
+    def __getattr__(self, attrname):
+        if attrname.startswith('_'):
+            raise AttributeError(attrname)
+        attr = getattr(self._robot, attrname)
+        if not callable(attr):
+            return attr
+
+        async def action(*args, **kwargs):
+            result = attr(*args, **kwargs)
+            if isinstance(result, StepMove):
+                return await self.wait_move(result)
+            return result
+        action.__name__ = attrname
+        action.__doc__ = getattr(attr, '__doc__', None)
+        #Resolved once - next access is a plain attribute lookup
+        self.__dict__[attrname] = action
+        return action
+
+    async def init(self, parallel=True):
+        """Initializes the robot in background without blocking the loop"""
+        await self._wrap(self._robot.init(parallel, background=True))
+
+    async def wait_move(self, move):
+        """Waits for StepMove. Returns True if it finished, False if it
+        was cancelled"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        move.add_done_callback(lambda done_move: loop.call_soon_threadsafe(
+            _set_result, future, not done_move.cancelled))
+        try:
+            return await future
+        except asyncio.CancelledError:
+            move.cancel()
+            raise
+
+    async def sleep(self, secs):
+        """Sleeps secs seconds of the robot's clock"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        job = self._robot.clock.call_later(secs, loop.call_soon_threadsafe,
+                                           _set_result, future, None,
+                                           name='async_sleep')
+        try:
+            await future
+        finally:
+            job.cancel()
+
+    async def drive_for(self, duration, action, *args):
+        """Runs steering action (e.g. 'forward') for duration seconds of
+        the robot's clock and stops the motors - also when cancelled"""
+        getattr(self._robot.steering, action)(*args)
+        try:
+            await self.sleep(duration)
+        finally:
+            self._robot.steering.stop()
+
+    async def _wrap(self, concurrent_future):
+        #Unlike asyncio.wrap_future cancelling the task does not cancel the
+        #concurrent future which is still resolved by its producer
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def _done(done_future):
+            loop.call_soon_threadsafe(_copy_result, future, done_future)
+        concurrent_future.add_done_callback(_done)
+        return await future
+
+    async def distance(self):
+        """Measures the distance in cm without blocking the loop"""
+        sensor = self._robot.components['distance_sensor']
+        return await self._wrap(sensor.measure_distance())
+
+    async def distances(self, interval=1):
+        """Asynchronous iterator of distances measured every interval
+        seconds of the robot's clock"""
+        while True:
+            yield await self.distance()
+            await self.sleep(interval)
+
+    async def obstacles(self, bouncetime=100, maxsize=64):
+        """
+        Asynchronous iterator of ObstacleEvent. Current state of both
+        sensors is reported first, then every change. When the consumer
+        is slower than the changes only the last maxsize ones are kept
+
+        :param  bouncetime: debounce time in ms
+                maxsize: maximal number of queued events
+        """
+        loop = asyncio.get_running_loop()
+        queue = collections.deque(maxlen=maxsize)
+        wakeup = asyncio.Event()
+
+        def _push(event):
+            queue.append(event)
+            wakeup.set()
+
+        subscriptions = []
+        for side in ('left', 'right'):
+            sensor = self._robot.components['obstacle_' + side]
+
+            def _edge(pin, state, side=side, sensor=sensor):
+                #Called on the GPIO event thread - only hand over to the loop
+                loop.call_soon_threadsafe(
+                    _push, ObstacleEvent(sensor.last_change, side, state))
+            sensor.register_both_callbacks(_edge, bouncetime, PRIORITY_HIGH)
+            subscriptions.append((sensor, _edge))
+            queue.append(ObstacleEvent(sensor.last_change, side, sensor.activated))
+        try:
+            while True:
+                while queue:
+                    yield queue.popleft()
+                wakeup.clear()
+                await wakeup.wait()
+        finally:
+            for sensor, callback in subscriptions:
+                sensor.remove_callback(callback)
+
+
+def _copy_result(future, done_future):
+    if future.done():
+        return
+    if done_future.exception() is not None:
+        future.set_exception(done_future.exception())
+    else:
+        future.set_result(done_future.result())
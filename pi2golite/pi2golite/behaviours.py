@@ -4,8 +4,10 @@ This modules defines behaviours for Pi2Go Lite robot
 Author: Radek Pribyl
 """
 from pi2golite._helpers import validate_max
+from pi2golite.clock import get_clock
+from array import array
 import math
-import time
+import threading
 
 class Steering(object):
     """
@@ -16,6 +18,11 @@ class Steering(object):
             rg_motor: instance of Motor class defining right motor
             init_speed: initial speed of the robot. Speed can be in
             range of 0 to 100
+
+    Optionally the wheel speeds can be controlled in closed loop by
+    SpeedControl instead of the fixed motor corrections
+    (see enable_speed_control) and speed changes can be acceleration
+    limited by SpeedRamp (see enable_speed_ramp)
     """
     def __init__(self, lf_motor, rg_motor, init_speed=20):
         self._left_motor = lf_motor
@@ -23,6 +30,10 @@ class Steering(object):
         self._curr_speed = init_speed
         self._last_action = self.stop
         self._last_action_arguments = None
+        self._lf_setpoint = 0
+        self._rg_setpoint = 0
+        self._speed_control = None
+        self._speed_ramp = None
 
     def cleanup(self):
         self._left_motor.cleanup()
@@ -38,25 +49,83 @@ class Steering(object):
         else:
             self._last_action(**self._last_action_arguments)
 
+    @property
+    def speed_control(self):
+        return self._speed_control
+
+    def enable_speed_control(self, speed_control):
+        """Drives the motors through SpeedControl instance"""
+        self.disable_speed_control()
+        self._speed_control = speed_control
+        speed_control.start(self._left_motor, self._right_motor)
+        if self._speed_ramp is not None:
+            speed_control.set_setpoints(*self._speed_ramp.current)
+        else:
+            speed_control.set_setpoints(self._lf_setpoint, self._rg_setpoint)
+
+    def disable_speed_control(self):
+        if self._speed_control is not None:
+            self._speed_control.stop()
+            self._speed_control = None
+            self._drive(self._lf_setpoint, self._rg_setpoint)
+
+    @property
+    def speed_ramp(self):
+        return self._speed_ramp
+
+    def enable_speed_ramp(self, speed_ramp):
+        """Changes the wheel speeds through SpeedRamp instance"""
+        self.disable_speed_ramp()
+        self._speed_ramp = speed_ramp
+        speed_ramp.start(self._output, self._lf_setpoint, self._rg_setpoint)
+
+    def disable_speed_ramp(self):
+        if self._speed_ramp is not None:
+            self._speed_ramp.stop()
+            self._speed_ramp = None
+            self._output(self._lf_setpoint, self._rg_setpoint)
+
+    @staticmethod
+    def _apply(motor, speed):
+        if speed > 0:
+            motor.forward(speed)
+        elif speed < 0:
+            motor.reverse(-speed)
+        else:
+            motor.stop()
+
+    def _drive(self, lf_speed, rg_speed):
+        #Speeds are signed - negative speed means reverse direction
+        self._lf_setpoint = lf_speed
+        self._rg_setpoint = rg_speed
+        if self._speed_ramp is not None:
+            self._speed_ramp.set_targets(lf_speed, rg_speed)
+        else:
+            self._output(lf_speed, rg_speed)
+
+    def _output(self, lf_speed, rg_speed):
+        if self._speed_control is not None:
+            self._speed_control.set_setpoints(lf_speed, rg_speed)
+        else:
+            self._apply(self._left_motor, lf_speed)
+            self._apply(self._right_motor, rg_speed)
+
     def _go_forward(self, lf_speed, rg_speed):
-        self._left_motor.forward(lf_speed)
-        self._right_motor.forward(rg_speed)
+        self._drive(lf_speed, rg_speed)
 
     def _go_reverse(self, lf_speed, rg_speed):
-        self._left_motor.reverse(lf_speed)
-        self._right_motor.reverse(rg_speed)
+        self._drive(-lf_speed, -rg_speed)
 
     def stop(self):
-        self._left_motor.stop()
-        self._right_motor.stop()
+        self._drive(0, 0)
         self._last_action = self.stop
         self._last_action_arguments = None
 
     def stop_left(self):
-        self._left_motor.stop()
+        self._drive(0, self._rg_setpoint)
 
     def stop_right(self):
-        self._right_motor.stop()
+        self._drive(self._lf_setpoint, 0)
 
     def forward(self):
         self._go_forward(self._curr_speed, self._curr_speed)
@@ -69,14 +138,12 @@ class Steering(object):
         self._last_action_arguments = None
 
     def spin_left(self):
-        self._left_motor.reverse(self._curr_speed)
-        self._right_motor.forward(self._curr_speed)
+        self._drive(-self._curr_speed, self._curr_speed)
         self._last_action = self.spin_left
         self._last_action_arguments = None
 
     def spin_right(self):
-        self._left_motor.forward(self._curr_speed)
-        self._right_motor.reverse(self._curr_speed)
+        self._drive(self._curr_speed, -self._curr_speed)
         self._last_action = self.spin_right
         self._last_action_arguments = None
 
@@ -95,7 +162,7 @@ class Steering(object):
     def turn_rev_left(self, lf_pct=50):
         lf_speed = float(validate_max(lf_pct)) / 100 * self._curr_speed
         self._go_reverse(lf_speed, self._curr_speed)
-        self._last_action = self.turn_revleft
+        self._last_action = self.turn_rev_left
         self._last_action_arguments = {'lf_pct' : lf_pct}
 
     def turn_rev_right(self, rg_pct=50):
@@ -118,63 +185,444 @@ class Steering(object):
         speed = self._curr_speed - decrement
         return self.set_speed(speed)
 
+class SpeedControl(object):
+    """
+    Closed loop speed control of both wheels. A PID loop per wheel
+    compares the commanded speed with the speed measured by the wheel
+    counter and adjusts the duty cycle of the motor. The loop runs at a
+    fixed rate as a periodic job of the clock's scheduler so it does not
+    need its own thread. Loop jitter and control error statistics are
+    collected
+
+    :param  lf_counter: WheelCounter of left wheel
+            rg_counter: WheelCounter of right wheel
+            clock: clock used for the loop, default clock if None
+            rate: loop frequency in Hz
+            kp, ki, kd: PID gains in duty per unit of speed error
+            max_integral: limit of the integral term (anti windup)
+
+    Measured velocity is converted to speed units (0 - 100) using the
+    max_rate of the wheel counters (edges per second at speed 100) which
+    Robot derives from the wheel geometry and the wheel speed at speed 100
+    (see Pi2GoLiteConfig.wheelsensors).
+    """
+    def __init__(self, lf_counter, rg_counter, clock=None, rate=50, kp=0.5,
+                 ki=4.0, kd=0.0, max_integral=50):
+        self._counters = (lf_counter, rg_counter)
+        self._clock = clock if clock is not None else get_clock()
+        self._period = 1.0 / rate
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd
+        self._max_integral = max_integral
+        self._motors = None
+        self._setpoints = [0, 0]
+        self._integral = [0.0, 0.0]
+        self._prev_error = [0.0, 0.0]
+        self.outputs = [0, 0]
+        self._job = None
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def running(self):
+        return self._job is not None
+
+    def reset_stats(self):
+        self._ticks = 0
+        self._jitter_sum = 0.0
+        self._jitter_max = 0.0
+        self._err_count = [0, 0]
+        self._err_sum = [0.0, 0.0]
+        self._err_sq_sum = [0.0, 0.0]
+        self._err_max = [0.0, 0.0]
+
+    @property
+    def stats(self):
+        """Loop jitter (seconds) and absolute speed error per wheel"""
+        ticks = max(self._ticks, 1)
+        errors = []
+        for wheel in (0, 1):
+            count = max(self._err_count[wheel], 1)
+            errors.append({'mean': self._err_sum[wheel] / count,
+                           'rms': math.sqrt(self._err_sq_sum[wheel] / count),
+                           'max': self._err_max[wheel]})
+        return {'ticks': self._ticks,
+                'jitter_mean': self._jitter_sum / ticks,
+                'jitter_max': self._jitter_max,
+                'left_error': errors[0], 'right_error': errors[1]}
+
+    def start(self, lf_motor, rg_motor):
+        with self._lock:
+            self._motors = (lf_motor, rg_motor)
+            if self._job is None:
+                self._job = self._clock.scheduler.call_every(
+                    self._period, self._tick, delay=self._period, name='speed_control')
+
+    def stop(self):
+        with self._lock:
+            if self._job is not None:
+                self._job.cancel()
+                self._job = None
+
+    def set_setpoints(self, lf_speed, rg_speed):
+        with self._lock:
+            for wheel, speed in enumerate((lf_speed, rg_speed)):
+                previous = self._setpoints[wheel]
+                self._setpoints[wheel] = speed
+                if speed == 0 or previous == 0 or (speed > 0) != (previous > 0):
+                    #Wheel starts, stops or reverses - feed forward is applied
+                    #immediately. Other changes (e.g. of SpeedRamp) keep the
+                    #last output which the loop corrects on its next tick
+                    self._integral[wheel] = 0.0
+                    self._prev_error[wheel] = 0.0
+                    self._output(wheel, abs(speed))
+
+    def _output(self, wheel, duty):
+        speed = self._setpoints[wheel]
+        duty = validate_max(duty) if speed != 0 else 0
+        self.outputs[wheel] = duty
+        Steering._apply(self._motors[wheel], duty if speed >= 0 else -duty)
+
+    def _tick(self):
+        with self._lock:
+            if self._job is None:
+                return
+            jitter = self._job.lateness
+            self._ticks += 1
+            self._jitter_sum += jitter
+            self._jitter_max = max(self._jitter_max, jitter)
+
+            for wheel in (0, 1):
+                target = abs(self._setpoints[wheel])
+                if target == 0:
+                    continue
+                counter = self._counters[wheel]
+                measured = counter.velocity() * 100.0 / counter.max_rate
+                error = target - measured
+                integral = self._integral[wheel] + error * self._period
+                integral = max(-self._max_integral, min(self._max_integral, integral))
+                self._integral[wheel] = integral
+                derivative = (error - self._prev_error[wheel]) / self._period
+                self._prev_error[wheel] = error
+                self._output(wheel, target + self.kp * error + self.ki * integral
+                             + self.kd * derivative)
+
+                abs_error = abs(error)
+                self._err_count[wheel] += 1
+                self._err_sum[wheel] += abs_error
+                self._err_sq_sum[wheel] += abs_error * abs_error
+                self._err_max[wheel] = max(self._err_max[wheel], abs_error)
+
+
+class SpeedRamp(object):
+    """
+    Acceleration limited changes of wheel speeds. A change of speed is
+    turned to a profile - trapezoidal in acceleration when jerk is
+    limited, in speed otherwise - which is precomputed as array of
+    speed increments and cached per size of the change. Profiles of both
+    wheels are played by one periodic job of the clock's scheduler which
+    runs only while a wheel is ramping. Zero speed is never ramped so
+    stopping a wheel takes effect immediately
+
+    :param  clock: clock used for the ramp job, default clock if None
+            acceleration: maximal change of speed (units of 0 - 100) per second
+            jerk: maximal change of acceleration per second, None or 0
+            for unlimited
+            rate: frequency of speed updates in Hz
+    """
+    def __init__(self, clock=None, acceleration=200, jerk=2000, rate=100):
+        self._clock = clock if clock is not None else get_clock()
+        self._period = 1.0 / rate
+        self._acceleration = float(acceleration)
+        self._jerk = float(jerk) if jerk else None
+        self._profiles = {}
+        self._output = None
+        self._current = [0, 0]
+        #Per wheel (start, sign, target, profile) of the played profile
+        self._playing = [None, None]
+        self._index = [0, 0]
+        self._job = None
+        self._lock = threading.Lock()
+
+    @property
+    def current(self):
+        """Speeds of left and right wheel currently output"""
+        return tuple(self._current)
+
+    @property
+    def ramping(self):
+        return self._job is not None
+
+    def start(self, output, lf_speed=0, rg_speed=0):
+        """Starts ramping through output(lf_speed, rg_speed) from given speeds"""
+        with self._lock:
+            self._output = output
+            self._current = [lf_speed, rg_speed]
+            self._playing = [None, None]
+
+    def stop(self):
+        with self._lock:
+            if self._job is not None:
+                self._job.cancel()
+                self._job = None
+            self._playing = [None, None]
+            self._output = None
+
+    def profile(self, change):
+        """Array of speed increments reaching abs(change) sampled at the ramp rate"""
+        change = round(abs(change), 2)
+        profile = self._profiles.get(change)
+        if profile is None:
+            profile = self._profiles[change] = self._build_profile(change)
+        return profile
+
+    def _build_profile(self, change):
+        accel = self._acceleration
+        jerk = self._jerk
+        if jerk:
+            jerk_time = accel / jerk
+            if change < accel * jerk_time:
+                #Maximal acceleration is not reached
+                accel = math.sqrt(change * jerk)
+                jerk_time = accel / jerk
+        else:
+            jerk_time = 0.0
+        accel_time = change / accel - jerk_time
+        total = 2 * jerk_time + accel_time
+        steps = max(int(math.ceil(total / self._period - 1e-9)), 1)
+        profile = array('d')
+        for step in range(1, steps):
+            t = step * self._period
+            if t <= jerk_time:
+                increment = jerk * t * t / 2
+            elif t <= jerk_time + accel_time:
+                increment = accel * jerk_time / 2 + accel * (t - jerk_time)
+            else:
+                increment = change - jerk * (total - t) ** 2 / 2
+            profile.append(min(increment, change))
+        profile.append(change)
+        return profile
+
+    def set_targets(self, lf_speed, rg_speed):
+        """Ramps wheels to signed speeds. Zero speed is output immediately"""
+        with self._lock:
+            if self._output is None:
+                return
+            immediate = False
+            started = []
+            for wheel, target in enumerate((lf_speed, rg_speed)):
+                playing = self._playing[wheel]
+                if playing is not None and playing[2] == target:
+                    continue
+                current = self._current[wheel]
+                if target == 0 or target == current:
+                    immediate = immediate or target != current
+                    self._current[wheel] = target
+                    self._playing[wheel] = None
+                else:
+                    sign = 1 if target > current else -1
+                    self._playing[wheel] = (current, sign, target,
+                                            self.profile(target - current))
+                    self._index[wheel] = 0
+                    started.append(wheel)
+            if started:
+                #First step of new profiles is output right away
+                if self._step(started) and self._job is None:
+                    self._job = self._clock.scheduler.call_every(
+                        self._period, self._tick, delay=self._period, name='speed_ramp')
+            elif immediate:
+                self._output(*self._current)
+
+    def _step(self, wheels=(0, 1)):
+        for wheel in wheels:
+            playing = self._playing[wheel]
+            if playing is None:
+                continue
+            start, sign, target, profile = playing
+            index = self._index[wheel]
+            self._current[wheel] = start + sign * profile[index]
+            if index + 1 >= len(profile):
+                self._current[wheel] = target
+                self._playing[wheel] = None
+            else:
+                self._index[wheel] = index + 1
+        self._output(*self._current)
+        return self._playing[0] is not None or self._playing[1] is not None
+
+    def _tick(self):
+        with self._lock:
+            if self._job is None:
+                return False
+            if not self._step():
+                self._job = None
+                return False
+
+
+class StepMove(object):
+    """
+    Handle of a move started by StepSteering. The move runs in the
+    background driven by wheel counter edge events - the handle allows
+    to wait for it or to cancel it
+
+    :param  step_steering: StepSteering instance running the move
+            clock: clock used for waiting
+            done: True creates already finished move
+            blend: motors are not stopped when the move finishes
+            so that the next move continues without stopping
+    """
+    def __init__(self, step_steering, clock, done=False, blend=False):
+        self._owner = step_steering
+        self._clock = clock
+        self._blend = blend
+        self._done = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+        self.cancelled = False
+        if done:
+            self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """Waits until the move finishes. Returns True if it finished"""
+        return self._clock.wait(self._done, timeout)
+
+    def cancel(self):
+        """Stops the motors and finishes the move"""
+        self._owner._cancel(self)
+
+    def add_done_callback(self, callback):
+        """Calls callback(move) when the move finishes - immediately if
+        it is already finished. Called on the thread finishing the move"""
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
 class StepSteering(object):
     """
     Class defining movement actions of Pi2Go lite using wheel counters.
     The class uses instance of Steering for performing the actual
     movements and WheelCounter instances to stop the motors after
-    defined number of steps
+    defined number of steps. Each motor is stopped directly from the
+    wheel counter edge callback. Actions do not block - they return
+    StepMove handle which can be waited for or cancelled
 
     :param  steering: instance of Steering class for movement delegation
             whl_counter_lf: instance of WheelCounter for left motor
             whl_counter_rg: instance of WheelCounter for right motor
+            whl_sen_lf: instance of WheelSensor for left wheel
+            whl_sen_rg: instance of WheelSensor for right wheel
+            clock: clock used for timing, default clock if None
     """
-    def __init__(self, steering, whl_counter_lf, whl_counter_rg, whl_sen_lf, whl_sen_rg):
+    #Actions which can be run by run_segment
+    actions = ('forward', 'reverse', 'spin_left', 'spin_right', 'turn_left',
+               'turn_right', 'turn_rev_left', 'turn_rev_right')
+
+    def __init__(self, steering, whl_counter_lf, whl_counter_rg, whl_sen_lf, whl_sen_rg,
+                 clock=None):
         self._steering = steering
+        self._clock = clock if clock is not None else get_clock()
         self._whl_counter_lf = whl_counter_lf
         self._whl_counter_rg = whl_counter_rg
         self._whl_sen_lf = whl_sen_lf
         self._whl_sen_rg = whl_sen_rg
         self._lf_motor_running = False
         self._rg_motor_running = False
+        self._move = None
+        self._lock = threading.RLock()
 
-    def _wait_while_running(self):
-        while self._lf_motor_running and self._rg_motor_running:
-            time.sleep(0.01)
-        self._steering.stop()
+    @property
+    def current_move(self):
+        return self._move
 
-    def _stop_left(self):
-        self._steering.stop_left()
-        self._lf_motor_running = False
+    @property
+    def wheel_counters(self):
+        """Tuple of left and right WheelCounter"""
+        return (self._whl_counter_lf, self._whl_counter_rg)
 
-    def _stop_right(self):
-        self._steering.stop_right()
-        self._rg_motor_running = False
+    @property
+    def clock(self):
+        return self._clock
 
-    def _run_both_motors(self, action, steps):
-        if steps > 0:
-            self._lf_motor_running = True
-            self._rg_motor_running = True
-            self._whl_counter_lf.start(steps, self._stop_left)
-            self._whl_counter_rg.start(steps, self._stop_right)
-            action()
-            self._wait_while_running()
-
-    def _run_left_motor(self, action, steps, *args):
-        if steps > 0:
-            self._lf_motor_running = True
-            self._whl_counter_lf.start(steps, self._stop_left)
-            action(*args)
-            self._wait_while_running()
-
-    def _run_right_motor(self, action, steps, *args):
-        if steps > 0:
-            self._rg_motor_running = True
-            self._whl_counter_rg.start(steps, self._stop_right)
-            action(*args)
-            self._wait_while_running()
-
-    def _run_and_count(self, action, lf_steps, rg_steps):
+    @property
+    def steering(self):
+        return self._steering
+
+    def _stop_left(self, move):
+        with self._lock:
+            if move is not self._move:
+                return
+            if not move._blend:
+                self._steering.stop_left()
+            self._lf_motor_running = False
+            finished = self._check_finished()
+        self._finish(finished)
+
+    def _stop_right(self, move):
+        with self._lock:
+            if move is not self._move:
+                return
+            if not move._blend:
+                self._steering.stop_right()
+            self._rg_motor_running = False
+            finished = self._check_finished()
+        self._finish(finished)
+
+    def _finished_move(self):
+        return StepMove(self, self._clock, done=True)
+
+    def _check_finished(self):
+        #Returns the finished move - it has to be finished by _finish once
+        #the lock is released as its callbacks may start another move
+        if not self._lf_motor_running and not self._rg_motor_running:
+            move = self._move
+            self._move = None
+            if move is None or not move._blend or move.cancelled:
+                self._steering.stop()
+            return move
+
+    @staticmethod
+    def _finish(move):
+        if move is not None:
+            move._finish()
+
+    def _cancel(self, move):
+        with self._lock:
+            finished = self._cancel_locked(move)
+        self._finish(finished)
+
+    def _cancel_locked(self, move):
+        if move is not self._move:
+            return None
+        self._whl_counter_lf.cancel()
+        self._whl_counter_rg.cancel()
+        self._lf_motor_running = False
+        self._rg_motor_running = False
+        move.cancelled = True
+        return self._check_finished()
+
+    def _steering_action(self, name):
+        #Turns run with the inner wheel stopped
+        if name not in self.actions:
+            raise AttributeError('unknown action %s' % name)
+        if name.startswith('turn_'):
+            return lambda : getattr(self._steering, name)(0)
+        return getattr(self._steering, name)
+
+    def _run_and_count(self, action, lf_steps, rg_steps, blend=False):
         #Init - prepare
         if lf_steps < 0:
             lf_steps = 0
@@ -182,67 +630,69 @@ class StepSteering(object):
         if rg_steps < 0:
             rg_steps = 0
 
-        lf_count = 0
-        rg_count = 0
-        lf_lst_pos = self._whl_sen_lf.activated
-        rg_lst_pos = self._whl_sen_rg.activated
-        
-        action()
-
-        while lf_count < lf_steps or rg_count < rg_steps:
-            time.sleep(0.002)
-            lf_cur_pos = self._whl_sen_lf.activated
-            if lf_cur_pos != lf_lst_pos:
-                lf_count +=1
-                lf_lst_pos = lf_cur_pos
-                if lf_count >= lf_steps:
-                    self._stop_left()
-
-            rg_cur_pos = self._whl_sen_rg.activated
-            if rg_cur_pos != rg_lst_pos:
-                rg_count += 1
-                rg_lst_pos = rg_cur_pos
-                if rg_count >= rg_steps:
-                    self._stop_right()
-            
-
-        self._steering.stop()
+        with self._lock:
+            #New move replaces the running one
+            replaced = None
+            if self._move is not None:
+                replaced = self._cancel_locked(self._move)
+
+            move = StepMove(self, self._clock, blend=blend)
+            self._move = move
+            self._lf_motor_running = round(lf_steps) > 0
+            self._rg_motor_running = round(rg_steps) > 0
+            speed = self._steering.current_speed
+            if self._lf_motor_running:
+                self._whl_counter_lf.start(lf_steps, lambda: self._stop_left(move), speed)
+            if self._rg_motor_running:
+                self._whl_counter_rg.start(rg_steps, lambda: self._stop_right(move), speed)
+
+            action()
+            finished = self._check_finished()
+        self._finish(replaced)
+        self._finish(finished)
+        return move
+
+    def run_segment(self, action, lf_steps, rg_steps, blend=False):
+        """
+        Runs steering action given by name (see actions) until the left
+        and right wheel make the given number of steps. Returns StepMove
+
+        :param  action: name of the action e.g. 'forward'. Turns run with
+                the inner wheel stopped
+                lf_steps, rg_steps: steps of the wheels, 0 for stopped wheel
+                blend: motors are not stopped when the move finishes so that
+                the next segment continues without stopping
+        """
+        return self._run_and_count(self._steering_action(action), lf_steps, rg_steps,
+                                   blend)
 
     def forward(self, steps):
-        #self._run_both_motors(self._steering.forward, steps)
-        self._run_and_count(self._steering.forward, steps, steps)
+        return self._run_and_count(self._steering.forward, steps, steps)
 
     def reverse(self, steps):
-        #self._run_both_motors(self._steering.reverse, steps)
-        self._run_and_count(self._steering.reverse, steps, steps)
+        return self._run_and_count(self._steering.reverse, steps, steps)
 
     def spin_left(self, steps):
-        #self._run_both_motors(self._steering.spin_left, steps)
-        self._run_and_count(self._steering.spin_left, steps, steps)
+        return self._run_and_count(self._steering.spin_left, steps, steps)
 
     def spin_right(self, steps):
-        #self._run_both_motors(self._steering.spin_right, steps)
-        self._run_and_count(self._steering.spin_right, steps, steps)
+        return self._run_and_count(self._steering.spin_right, steps, steps)
 
     def turn_left(self, steps):
-        #self._run_right_motor(self._steering.turn_left, steps, 0)
         action = lambda : self._steering.turn_left(0)
-        self._run_and_count(action, 0, steps)
+        return self._run_and_count(action, 0, steps)
 
     def turn_right(self, steps):
-        #self._run_left_motor(self._steering.turn_right, steps, 0)
         action = lambda : self._steering.turn_right(0)
-        self._run_and_count(action, steps, 0)
+        return self._run_and_count(action, steps, 0)
 
     def turn_rev_left(self, steps):
-        #self._run_right_motor(self._steering.turn_rev_left, steps, 0)
         action = lambda : self._steering.turn_rev_left(0)
-        self._run_and_count(action, 0, steps)
+        return self._run_and_count(action, 0, steps)
 
     def turn_rev_right(self, steps):
-        #self._run_left_motor(self._steering.turn_rev_right, steps, 0)
         action = lambda : self._steering.turn_rev_right(0)
-        self._run_and_count(action, steps, 0)
+        return self._run_and_count(action, steps, 0)
 
 class MeasureSteering(object):
     """
@@ -260,12 +710,44 @@ class MeasureSteering(object):
 
     Please note that the precision of the movement is determined by the number of steps on
     wheelcounters so it cannot be 100% precise.
+    Actions return StepMove handle of the started move.
     """
     def __init__(self, step_steering, whl_diameter, robot_width, numsteps):
         self._step_steering = step_steering
         self._robot_width = robot_width
         self._step_dist = math.pi * whl_diameter / numsteps
 
+    @property
+    def step_distance(self):
+        """Distance travelled by wheel per one counted step"""
+        return self._step_dist
+
+    @property
+    def robot_width(self):
+        return self._robot_width
+
+    def wheel_velocities(self, window=None):
+        """Velocity of left and right wheel in distance units per second.
+        See WheelCounter.velocity for meaning of window"""
+        lf_counter, rg_counter = self._step_steering.wheel_counters
+        return (lf_counter.velocity(window) * self._step_dist,
+                rg_counter.velocity(window) * self._step_dist)
+
+    @property
+    def step_steering(self):
+        return self._step_steering
+
+    def segment_steps(self, action, value):
+        """
+        Number of steps a moving wheel makes for action (name of a
+        StepSteering action) with distance or angle value
+        """
+        if action not in StepSteering.actions:
+            raise AttributeError('unknown action %s' % action)
+        if action in ('forward', 'reverse'):
+            return self._calc_steps_from_dist(max(value, 0))
+        return self._calc_steps_from_angle(value, action.startswith('spin'))
+
     def _calc_steps_from_dist(self, dist):
         return round(dist / self._step_dist)
 
@@ -281,33 +763,232 @@ class MeasureSteering(object):
     def forward(self, distance):
         if distance > 0:
             steps = self._calc_steps_from_dist(distance)
-            self._step_steering.forward(steps)
+            return self._step_steering.forward(steps)
+        return self._step_steering._finished_move()
 
     def reverse(self, distance):
         if distance > 0:
             steps = self._calc_steps_from_dist(distance)
-            self._step_steering.reverse(steps)
+            return self._step_steering.reverse(steps)
+        return self._step_steering._finished_move()
 
     def spin_left(self, angle):
         steps = self._calc_steps_from_angle(angle, True)
-        self._step_steering.spin_left(steps)
+        return self._step_steering.spin_left(steps)
 
     def spin_right(self, angle):
         steps = self._calc_steps_from_angle(angle, True)
-        self._step_steering.spin_right(steps)
+        return self._step_steering.spin_right(steps)
 
     def turn_left(self, angle):
         steps = self._calc_steps_from_angle(angle)
-        self._step_steering.turn_left(steps)
+        return self._step_steering.turn_left(steps)
 
     def turn_right(self, angle):
         steps = self._calc_steps_from_angle(angle)
-        self._step_steering.turn_right(steps)
+        return self._step_steering.turn_right(steps)
 
     def turn_rev_left(self, angle):
         steps = self._calc_steps_from_angle(angle)
-        self._step_steering.turn_rev_left(steps)
+        return self._step_steering.turn_rev_left(steps)
 
     def turn_rev_right(self, angle):
         steps = self._calc_steps_from_angle(angle)
-        self._step_steering.turn_rev_right(steps)
+        return self._step_steering.turn_rev_right(steps)
+
+class MotionRun(StepMove):
+    """
+    Handle of segments run by MotionQueue. Besides waiting and cancelling
+    it reports the index of the running segment and the overall progress
+
+    :param  queue: MotionQueue running the segments
+            clock: clock used for waiting
+            plan: list of planned segments
+    """
+    def __init__(self, queue, clock, plan):
+        StepMove.__init__(self, queue, clock)
+        self._plan = plan
+        self._total_steps = sum(segment[2] for segment in plan)
+        self._done_steps = 0
+        self.segment = 0
+
+    @property
+    def segments(self):
+        return len(self._plan)
+
+    @property
+    def progress(self):
+        """Finished part of the planned steps (0 - 1)"""
+        return self._owner._progress(self)
+
+
+class MotionQueue(object):
+    """
+    Runs a list of MeasureSteering segments back to back. A segment is
+    a tuple of action name and its distance or angle, e.g.
+    [('forward', 30), ('turn_left', 90)]. Motors are not stopped between
+    the segments - the next segment is started from the wheel counter
+    edge which finished the previous one. Steps a wheel made over its
+    target (e.g. while waiting for the other wheel) are taken from the
+    next segment of that wheel so errors do not accumulate. With a speed
+    ramp the motors are stopped before a segment in which a wheel starts
+    from stop or reverses as the ramped wheel would lag behind the other
+
+    :param  measure_steering: instance of MeasureSteering
+    """
+    #Direction of left and right wheel for each action
+    _wheel_dirs = {'forward': (1, 1), 'reverse': (-1, -1),
+                   'spin_left': (-1, 1), 'spin_right': (1, -1),
+                   'turn_left': (0, 1), 'turn_right': (1, 0),
+                   'turn_rev_left': (0, -1), 'turn_rev_right': (-1, 0)}
+
+    def __init__(self, measure_steering):
+        self._measure_steering = measure_steering
+        self._step_steering = measure_steering.step_steering
+        self._counters = self._step_steering.wheel_counters
+        self._clock = self._step_steering.clock
+        self._lock = threading.RLock()
+        self._run = None
+        self._move = None
+        self._segment_callback = None
+        self._target = [0.0, 0.0]
+        self._position = [0, 0]
+        self._last_dirs = [1, 1]
+        self._start_edges = [0, 0]
+
+    @property
+    def current_run(self):
+        return self._run
+
+    def _plan_segment(self, action, value):
+        if action not in self._wheel_dirs:
+            raise AttributeError('unknown action %s' % action)
+        steps = self._measure_steering.segment_steps(action, value)
+        return (action, self._wheel_dirs[action], steps)
+
+    def run(self, segments, callback=None):
+        """
+        Starts running segments and returns MotionRun handle. A running
+        queue is cancelled first. Optional callback(run) is called after
+        every finished segment from the wheel counter edge callback
+        so it should be short
+        """
+        plan = [self._plan_segment(action, value) for action, value in segments]
+        with self._lock:
+            cancelled = self._cancel_locked(self._run)
+            run = MotionRun(self, self._clock, plan)
+            self._run = run
+            self._segment_callback = callback
+            self._target = [0.0, 0.0]
+            self._position = [0, 0]
+            self._last_dirs = [1, 1]
+            finished = self._start_segment(run)
+        self._finish(cancelled)
+        self._finish(finished)
+        return run
+
+    @staticmethod
+    def _finish(run):
+        #Runs are finished without the lock as their callbacks may use
+        #the queue or the steering
+        if run is not None:
+            run._finish()
+
+    def _start_segment(self, run):
+        #Returns the run if it is finished
+        if run.segment >= len(run._plan):
+            self._run = None
+            return run
+        action, dirs, steps = run._plan[run.segment]
+        wheel_steps = [0, 0]
+        for wheel in (0, 1):
+            if dirs[wheel]:
+                #Steps still missing to the target position of the wheel
+                self._target[wheel] += dirs[wheel] * steps
+                remaining = (self._target[wheel] - self._position[wheel]) * dirs[wheel]
+                wheel_steps[wheel] = max(remaining, 0)
+            self._start_edges[wheel] = self._counters[wheel].accepted_edges
+        blend = (run.segment < len(run._plan) - 1 and
+                 self._can_blend(dirs, run._plan[run.segment + 1][1]))
+        self._move = self._step_steering.run_segment(action, wheel_steps[0],
+                                                     wheel_steps[1], blend)
+        self._move.add_done_callback(self._segment_done)
+        return None
+
+    def _can_blend(self, dirs, next_dirs):
+        #Ramped wheel starting from stop or reversing would lag behind the
+        #other wheel and bend the path - motors are stopped before such segment
+        if self._step_steering.steering.speed_ramp is None:
+            return True
+        return all(not next_dir or next_dir == direction
+                   for direction, next_dir in zip(dirs, next_dirs))
+
+    def _segment_done(self, move):
+        with self._lock:
+            run = self._run
+            if run is None or move is not self._move:
+                return
+            self._move = None
+            if move.cancelled:
+                #Replaced by another move of StepSteering
+                run._done_steps += self._segment_progress(run)
+                self._run = None
+                run.cancelled = True
+                finished = run
+            else:
+                dirs = run._plan[run.segment][1]
+                for wheel in (0, 1):
+                    edges = self._counters[wheel].accepted_edges - self._start_edges[wheel]
+                    #Stopped wheel may still coast in its previous direction
+                    direction = dirs[wheel] or self._last_dirs[wheel]
+                    self._position[wheel] += direction * edges
+                    if dirs[wheel]:
+                        self._last_dirs[wheel] = dirs[wheel]
+                run._done_steps += run._plan[run.segment][2]
+                run.segment += 1
+                callback = self._segment_callback
+                if callback is not None:
+                    callback(run)
+                finished = self._start_segment(run)
+        self._finish(finished)
+
+    def _segment_progress(self, run):
+        #Steps of the running segment made so far
+        planned = run._plan[run.segment][2]
+        edges = max(counter.accepted_edges - start for counter, start
+                    in zip(self._counters, self._start_edges))
+        return min(edges, planned)
+
+    def _progress(self, run):
+        with self._lock:
+            done = run._done_steps
+            if run is self._run and self._move is not None:
+                done += self._segment_progress(run)
+        if not run._total_steps:
+            return 1.0 if run.done else 0.0
+        return min(float(done) / run._total_steps, 1.0)
+
+    def _cancel(self, run):
+        with self._lock:
+            finished = self._cancel_locked(run)
+        self._finish(finished)
+
+    def _cancel_locked(self, run):
+        #Returns the cancelled run which has to be finished
+        if run is None or run is not self._run:
+            return None
+        self._run = None
+        run.cancelled = True
+        move = self._move
+        self._move = None
+        if move is not None:
+            #Progress of the cancelled run stays where it stopped
+            run._done_steps += self._segment_progress(run)
+            move.cancel()
+        return run
+
+    def cancel(self):
+        """Cancels the running segments and stops the motors"""
+        run = self._run
+        if run is not None:
+            self._cancel(run)
@@ -0,0 +1,127 @@
+"""
+Clocks used by pi2golite components and behaviours for all timing.
+SystemClock uses the real monotonic time. VirtualClock only moves when it
+is advanced (or something sleeps on it) so control loops and simulations
+using pi2golite.simGPIO can run much faster than real time.
+
+Components take the clock as optional parameter and use the default clock
+(see get_clock and set_clock) when none is given. Timed jobs are registered
+with the scheduler owned by the clock (see pi2golite.scheduler).
+
+Author: Radek Pribyl
+"""
+import threading
+import time
+from pi2golite.scheduler import Scheduler
+
+
+class SystemClock(object):
+    """
+    Clock using real monotonic time. Callbacks scheduled with call_later
+    and jobs of its scheduler are executed by a single scheduler thread
+    which is started on first use
+    """
+    realtime = True
+
+    def __init__(self):
+        self.scheduler = Scheduler(self)
+
+    def time(self):
+        return time.monotonic()
+
+    def monotonic_ns(self):
+        return time.monotonic_ns()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+    def wait(self, event, timeout=None):
+        """Waits until threading.Event event is set. Returns its state"""
+        return event.wait(timeout)
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        return self.scheduler.call_later(delay, callback, *args, **kwargs)
+
+
+class VirtualClock(object):
+    """
+    Clock which moves only when advanced. Time advances in steps of
+    resolution seconds (or exactly to the time of the next scheduled
+    job) and listeners registered with add_listener are called with
+    the new time after every step - e.g. to advance a simulation.
+    Jobs of its scheduler run while the clock is advanced.
+    Sleeping or waiting on the clock advances it immediately.
+
+    :param  start: initial time in seconds
+            resolution: maximal step of the clock in seconds
+    """
+    realtime = False
+
+    def __init__(self, start=0.0, resolution=0.001):
+        self._now = start
+        self.resolution = resolution
+        self.scheduler = Scheduler(self, threaded=False)
+        self._listeners = []
+        self._lock = threading.RLock()
+
+    def time(self):
+        return self._now
+
+    def monotonic_ns(self):
+        return int(round(self._now * 1e9))
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def advance(self, secs):
+        """Moves the clock by secs seconds running all due jobs"""
+        with self._lock:
+            target = self._now + secs
+            while True:
+                step = min(self._now + self.resolution, target)
+                due = self.scheduler.next_due()
+                if due is not None and due < step:
+                    step = max(due, self._now)
+                self._now = step
+                for listener in self._listeners:
+                    listener(step)
+                self.scheduler.run_due(step)
+                if self._now >= target:
+                    return
+
+    def sleep(self, secs):
+        self.advance(secs)
+
+    def wait(self, event, timeout=None):
+        """Advances the clock until threading.Event event is set or
+        timeout elapses. Returns state of the event"""
+        deadline = None if timeout is None else self._now + timeout
+        while not event.is_set():
+            if deadline is None:
+                step = self.resolution
+            elif self._now >= deadline:
+                return False
+            else:
+                step = min(self.resolution, deadline - self._now)
+            self.advance(step)
+        return True
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        return self.scheduler.call_later(delay, callback, *args, **kwargs)
+
+
+_default_clock = SystemClock()
+
+
+def get_clock():
+    """Returns clock used by components created without explicit clock"""
+    return _default_clock
+
+
+def set_clock(clock):
+    """Sets clock used by components created without explicit clock"""
+    global _default_clock
+    _default_clock = clock
@@ -6,23 +6,105 @@
     by Gareth Davies and Zachary Igielman
 """
 #Import all modules/libraries
-import time
 import threading
 import os
-from pi2golite._helpers import validate_max
-
-try:
-    import RPi.GPIO as GPIO
-except ImportError:
-    import pi2golite.dummyGPIO as GPIO
+import fcntl
+from array import array
+from concurrent.futures import Future
+from pi2golite._helpers import validate_max, delegation_table
+from pi2golite.clock import get_clock
+from pi2golite.dispatch import get_dispatcher, PRIORITY_HIGH, PRIORITY_NORMAL
+from pi2golite.telemetry import get_recorder
+
+#Simulated backend can be selected by setting PI2GOLITE_GPIO=sim
+if os.environ.get('PI2GOLITE_GPIO') == 'sim':
+    import pi2golite.simGPIO as GPIO
+else:
+    try:
+        import RPi.GPIO as GPIO
+    except ImportError:
+        import pi2golite.dummyGPIO as GPIO
 
 #Set the mode here so that the classes can be possibly used without the
 #Pi2Go.Robot class
 GPIO.setmode(GPIO.BOARD)
 
 
+def use_gpio(backend):
+    """Replaces GPIO backend used by all components e.g. by an instance
+    of pi2golite.simGPIO.Simulation. Call it before components are initiated.
+    The backend is global - it is replaced for all components in the process.
+    Returns the previous backend so it can be restored"""
+    global GPIO
+    previous = GPIO
+    GPIO = backend
+    GPIO.setmode(GPIO.BOARD)
+    return previous
+
+
 #Classes
+class PWMChannel(object):
+    """
+    Wrapper of GPIO.PWM which remembers the last frequency and duty cycle
+    written to the channel and skips writes which would not change them.
+    Number of performed and skipped writes is counted. Performed duty
+    cycle writes are reported to the telemetry recorder
+    """
+    def __init__(self, pin, frequency):
+        self._pin = pin
+        self._pwm = GPIO.PWM(pin, frequency)
+        self._frequency = frequency
+        self._duty = None
+        self.writes = 0
+        self.saved_writes = 0
+
+    @property
+    def frequency(self):
+        return self._frequency
+
+    @property
+    def duty(self):
+        return self._duty
+
+    def start(self, duty):
+        self._pwm.start(duty)
+        self._duty = duty
+        self.writes += 1
+        recorder = get_recorder()
+        if recorder is not None:
+            recorder.record_pwm(self._pin, duty)
+
+    def set_frequency(self, frequency):
+        if frequency == self._frequency:
+            self.saved_writes += 1
+        else:
+            self._pwm.ChangeFrequency(frequency)
+            self._frequency = frequency
+            self.writes += 1
+
+    def set_duty(self, duty):
+        if duty == self._duty:
+            self.saved_writes += 1
+        else:
+            self._pwm.ChangeDutyCycle(duty)
+            self._duty = duty
+            self.writes += 1
+            recorder = get_recorder()
+            if recorder is not None:
+                recorder.record_pwm(self._pin, duty)
+
+
 class Motor(object):
+    """
+    Motor driven by two PWM channels - one for each direction.
+    Frequency and duty cycle for each whole speed are precomputed
+    including the direction correction
+
+    :param  fwdpin: pin for forward direction
+            revpin: pin for reverse direction
+            fwdcorr: percentage by which the forward speed is reduced
+            revcorr: percentage by which the reverse speed is reduced
+    """
     def __init__(self, fwdpin, revpin, fwdcorr=0, revcorr=0):
         self._pin_fwd = fwdpin
         self._pin_rev = revpin
@@ -30,15 +112,47 @@ class Motor(object):
         self._pwd_rev = None
         self._fwdcorr = 1 - (float(validate_max(fwdcorr)) / 100)
         self._revcorr = 1 - (float(validate_max(revcorr)) / 100)
+        self._fwd_table = self._build_table(self._fwdcorr)
+        self._rev_table = self._build_table(self._revcorr)
+        self._direction = 0
         self._initialized = False
 
+    @staticmethod
+    def _build_table(corr):
+        return [(speed + 5, speed * corr) for speed in range(101)]
+
+    @staticmethod
+    def _lookup(table, corr, speed):
+        if speed == int(speed):
+            return table[int(speed)]
+        return (speed + 5, speed * corr)
+
+    @property
+    def writes(self):
+        """Number of PWM writes actually sent to GPIO"""
+        if self._initialized:
+            return self._pwd_fwd.writes + self._pwd_rev.writes
+        return 0
+
+    @property
+    def saved_writes(self):
+        """Number of PWM writes skipped as they would not change the output"""
+        if self._initialized:
+            return self._pwd_fwd.saved_writes + self._pwd_rev.saved_writes
+        return 0
+
+    @property
+    def direction(self):
+        """Commanded direction - 1 forward, -1 reverse, 0 stopped"""
+        return self._direction
+
     def init(self, init_speed=20):
         if not self._initialized:
             init_speed = validate_max(init_speed)
             GPIO.setup(self._pin_fwd, GPIO.OUT)
             GPIO.setup(self._pin_rev, GPIO.OUT)
-            self._pwd_fwd = GPIO.PWM(self._pin_fwd, init_speed)
-            self._pwd_rev = GPIO.PWM(self._pin_rev, init_speed)
+            self._pwd_fwd = PWMChannel(self._pin_fwd, init_speed)
+            self._pwd_rev = PWMChannel(self._pin_rev, init_speed)
             self._pwd_fwd.start(0)
             self._pwd_rev.start(0)
             self._initialized = True
@@ -52,89 +166,140 @@ class Motor(object):
     def forward(self, speed):
         if self._initialized:
             speed = validate_max(speed)
-            self._pwd_fwd.ChangeFrequency(speed + 5)
-            self._pwd_fwd.ChangeDutyCycle(speed * self._fwdcorr)
-            self._pwd_rev.ChangeDutyCycle(0)
+            frequency, duty = self._lookup(self._fwd_table, self._fwdcorr, speed)
+            self._pwd_fwd.set_frequency(frequency)
+            self._pwd_fwd.set_duty(duty)
+            self._pwd_rev.set_duty(0)
+            self._direction = 1 if speed > 0 else 0
 
     def reverse(self, speed):
         if self._initialized:
             speed = validate_max(speed)
-            self._pwd_rev.ChangeFrequency(speed + 5)
-            self._pwd_rev.ChangeDutyCycle(speed * self._revcorr)
-            self._pwd_fwd.ChangeDutyCycle(0)
+            frequency, duty = self._lookup(self._rev_table, self._revcorr, speed)
+            self._pwd_rev.set_frequency(frequency)
+            self._pwd_rev.set_duty(duty)
+            self._pwd_fwd.set_duty(0)
+            self._direction = -1 if speed > 0 else 0
 
     def stop(self):
         if self._initialized:
-            self._pwd_rev.ChangeDutyCycle(0)
-            self._pwd_fwd.ChangeDutyCycle(0)
+            self._pwd_rev.set_duty(0)
+            self._pwd_fwd.set_duty(0)
+            self._direction = 0
 
 
 class Sensor(object):
-    def __init__(self, pin):
+    """
+    Digital (active low) sensor. Once initiated the sensor watches both
+    edges of its pin and keeps the state and time of its last change, so
+    reading activated does not access the hardware.
+
+    Registered callbacks are not run on the GPIO event thread - the edge
+    is passed to the dispatcher which calls them according to their
+    priority (see pi2golite.dispatch). Bouncetime of the callbacks is
+    applied in software from the edge timestamps. Callbacks registered
+    with timestamp=True get the timestamp of the edge as third argument,
+    as they may run later than the edge.
+
+    :param  pin: pin of the sensor
+            dispatcher: Dispatcher of callbacks, default one if None
+            clock: clock used for edge timestamps, default clock if None
+    """
+    def __init__(self, pin, dispatcher=None, clock=None):
         self._pin = pin
+        self._dispatcher = dispatcher if dispatcher is not None else get_dispatcher()
+        self._clock = clock if clock is not None else get_clock()
+        self._state = None
+        self._last_change = None
+        self._callbacks = []
         self._initialized = False
 
+    def _setup(self):
+        GPIO.setup(self._pin, GPIO.IN)
+
     def init(self):
         if not self._initialized:
-            GPIO.setup(self._pin, GPIO.IN)
+            self._setup()
+            self._state = GPIO.input(self._pin) == 0
+            self._last_change = self._clock.monotonic_ns()
+            GPIO.add_event_detect(self._pin, GPIO.BOTH, callback=self._on_edge)
             self._initialized = True
 
     def cleanup(self):
         if self._initialized:
             self.remove_callbacks()
+            GPIO.remove_event_detect(self._pin)
             GPIO.cleanup(self._pin)
             self._initialized = False
 
     @property
     def activated(self):
         if self._initialized:
-            if GPIO.input(self._pin) == 0:
-                return True
-            else:
-                return False
+            return self._state
 
-    def _generate_callback(self, callback):
-        def _call_callback(pin):
-            state = self.activated
-            callback(self._pin, state)
-        return _call_callback
+    @property
+    def last_change(self):
+        """Monotonic timestamp (ns) of the last change of the state"""
+        return self._last_change
+
+    def _on_edge(self, pin):
+        #State is read on the event thread at the time of the edge
+        timestamp = self._clock.monotonic_ns()
+        state = GPIO.input(self._pin) == 0
+        if state != self._state:
+            self._state = state
+            self._last_change = timestamp
+        recorder = get_recorder()
+        if recorder is not None:
+            recorder.record_edge(self._pin, 0 if state else 1)
+        #Activated sensor has low level - falling edge
+        edge = GPIO.FALLING if state else GPIO.RISING
+        for subscription in self._callbacks:
+            sub_edge, callback, priority, bouncetime, last, timestamped = subscription
+            if sub_edge != GPIO.BOTH and sub_edge != edge:
+                continue
+            if last is not None and timestamp - last < bouncetime:
+                continue
+            subscription[4] = timestamp
+            if timestamped:
+                self._dispatcher.dispatch(priority, callback, self._pin, state, timestamp)
+            else:
+                self._dispatcher.dispatch(priority, callback, self._pin, state)
 
-    def register_off_callback(self, callback, bouncetime=100):
-        if self._initialized:
-            fce_to_call = self._generate_callback(callback)
-            GPIO.add_event_detect(self._pin, GPIO.RISING, callback=fce_to_call,
-                                  bouncetime=bouncetime)
-            return True
-        else:
+    def _add_callback(self, edge, callback, bouncetime, priority, timestamp):
+        #bouncetime in ms, None disables debouncing
+        if not self._initialized:
             return False
+        bouncetime = int(bouncetime * 1e6) if bouncetime else 0
+        #Copy on write so the event thread can iterate without locking
+        self._callbacks = self._callbacks + [[edge, callback, priority,
+                                              bouncetime, None, timestamp]]
+        return True
 
-    def register_on_callback(self, callback, bouncetime=100):
-        if self._initialized:
-            fce_to_call = self._generate_callback(callback)
-            GPIO.add_event_detect(self._pin, GPIO.FALLING, callback=fce_to_call,
-                                  bouncetime=bouncetime)
-            return True
-        else:
-            return False
+    def register_off_callback(self, callback, bouncetime=100, priority=PRIORITY_NORMAL,
+                              timestamp=False):
+        return self._add_callback(GPIO.RISING, callback, bouncetime, priority, timestamp)
 
-    def register_both_callbacks(self, callback, bouncetime=100):
-        if self._initialized:
-            fce_to_call = self._generate_callback(callback)
-            GPIO.add_event_detect(self._pin, GPIO.BOTH, callback=fce_to_call,
-                                  bouncetime=bouncetime)
-            return True
-        else:
-            return False
+    def register_on_callback(self, callback, bouncetime=100, priority=PRIORITY_NORMAL,
+                             timestamp=False):
+        return self._add_callback(GPIO.FALLING, callback, bouncetime, priority, timestamp)
+
+    def register_both_callbacks(self, callback, bouncetime=100, priority=PRIORITY_NORMAL,
+                                timestamp=False):
+        return self._add_callback(GPIO.BOTH, callback, bouncetime, priority, timestamp)
+
+    def remove_callback(self, callback):
+        self._callbacks = [subscription for subscription in self._callbacks
+                           if subscription[1] != callback]
 
     def remove_callbacks(self):
         if self._initialized:
-            GPIO.remove_event_detect(self._pin)
+            self._callbacks = []
 
 
 class Switch(Sensor):
-    def init(self):
+    def _setup(self):
         GPIO.setup(self._pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        self._initialized = True
 
 
 class WheelSensor(object):
@@ -145,18 +310,29 @@ class WheelSensor(object):
 
     def __init__(self, line_sensor):
         self._line_sensor = line_sensor
+        #Delegated methods are resolved once and bound as instance attributes
+        methods, self._delegated_attrs = delegation_table(line_sensor,
+                                                          exclude=dir(type(self)))
+        self.__dict__.update(methods)
+
+    @property
+    def activated(self):
+        return self._line_sensor.activated
 
     def __getattr__(self, attrname):
-        if attrname in (name for name in dir(self._line_sensor) if not name.startswith('_')):
-            return getattr(self._line_sensor, attrname)
-        else:
-            raise AttributeError(attrname)
+        delegated = self.__dict__.get('_delegated_attrs')
+        if delegated and attrname in delegated:
+            target, name = delegated[attrname]
+            return getattr(target, name)
+        raise AttributeError(attrname)
 
 
 class WhiteLED(object):
-    def __init__(self, pin):
+    def __init__(self, pin, clock=None):
         self._pin = pin
+        self._clock = clock if clock is not None else get_clock()
         self._pwm = None
+        self._fade_job = None
         self._initialized = False
 
     def init(self):
@@ -168,10 +344,11 @@ class WhiteLED(object):
 
     def cleanup(self):
         if self._initialized:
+            self.stop_fade()
             self.off()
             GPIO.cleanup(self._pin)
             self._initialized = False
-    
+
     def on(self):
         self.set(100)
 
@@ -183,92 +360,336 @@ class WhiteLED(object):
             intensity = validate_max(100 - intensity)
             self._pwm.ChangeDutyCycle(intensity)
 
+    def _fade(self, levels, delay):
+        #Each step of the effect is run by the clock's scheduler so the
+        #call does not block. Returns the job which can be waited for
+        self.stop_fade()
+        levels = iter(levels)
+
+        def _fade_step():
+            level = next(levels, None)
+            if level is None:
+                return False
+            self.set(level)
+
+        self._fade_job = self._clock.scheduler.call_every(delay, _fade_step,
+                                                          name='led_fade')
+        return self._fade_job
+
+    def stop_fade(self):
+        if self._fade_job is not None:
+            self._fade_job.cancel()
+            self._fade_job = None
+
     def brighten(self, delay=0.1, step=5):
-        for dc in range(0, 101, step):
-            self.set(dc)
-            time.sleep(delay)
+        return self._fade(range(0, 101, step), delay)
 
     def dim(self, delay=0.1, step=5):
-        for dc in range(100, -1, step * -1):
-            self.set(dc)
-            time.sleep(delay)
+        return self._fade(range(100, -1, step * -1), delay)
 
 
 class DistanceSensor(object):
-    def __init__(self, pin):
+    """
+    Ultrasonic distance sensor using single pin for trigger and echo.
+    The echo pulse is timed from GPIO edge events (monotonic nanosecond
+    timestamps) so no CPU is consumed while the pulse is in flight.
+    Edge detection is armed once in init - arming it takes milliseconds on
+    RPi.GPIO, longer than the echo needs to start. Edges are told apart by
+    the level of the pin, so the edges of the trigger pulse are ignored.
+
+    :param  pin: pin used both for trigger and echo
+            timeout: maximal time in seconds to wait for the echo
+            clock: clock used for timing, default clock if None
+            dispatcher: Dispatcher of start_distance_measure callbacks,
+            default one if None
+    """
+    def __init__(self, pin, timeout=0.2, clock=None, dispatcher=None):
         self._pin = pin
+        self._timeout = timeout
+        self._clock = clock if clock is not None else get_clock()
+        self._dispatcher = dispatcher if dispatcher is not None else get_dispatcher()
         self.measure_running = threading.Event()
-        self._measure_thread = None
+        self._lock = threading.Lock()
+        self._pending = None
+        self._edges = []
+        self._listening = False
+        self._timeout_timer = None
+        self._cycle_job = None
+        self._echo_listeners = []
+        self._initialized = False
+        self.last_distance = None
 
     def init(self):
-        pass
+        if not self._initialized:
+            GPIO.setup(self._pin, GPIO.IN)
+            GPIO.add_event_detect(self._pin, GPIO.BOTH, callback=self._echo_edge)
+            self._initialized = True
 
     def cleanup(self):
-        if self.measure_running.is_set:
+        if self.measure_running.is_set():
             self.stop_distance_measure()
+        if self._initialized:
+            #Measurement in flight ends without echo
+            self._finish()
+            GPIO.remove_event_detect(self._pin)
+            self._initialized = False
+
+    def _echo_edge(self, pin):
+        #Rising edge is the start of the echo pulse, falling one its end
+        timestamp = self._clock.monotonic_ns()
+        level = GPIO.input(self._pin)
+        with self._lock:
+            if self._pending is None or not self._listening:
+                return
+            if level:
+                if not self._edges:
+                    self._edges.append(timestamp)
+                return
+            if not self._edges:
+                #Falling edge without start of the echo (trigger pulse)
+                return
+            self._edges.append(timestamp)
+        self._finish()
+
+    def add_echo_listener(self, callback):
+        """Calls callback(timestamp) as soon as a measurement ends - when the
+        end of the echo is captured or on timeout - before the distance is
+        computed and passed on. It is called from the edge callback so it
+        has to be short"""
+        #Copy on write so the event thread can iterate without locking
+        self._echo_listeners = self._echo_listeners + [callback]
+
+    def remove_echo_listener(self, callback):
+        self._echo_listeners = [listener for listener in self._echo_listeners
+                                if listener != callback]
+
+    def _finish(self):
+        with self._lock:
+            future = self._pending
+            if future is None:
+                return
+            edges = self._edges
+            self._pending = None
+            self._listening = False
+            self._edges = []
+            if self._timeout_timer is not None:
+                self._timeout_timer.cancel()
+                self._timeout_timer = None
+        if self._echo_listeners:
+            timestamp = edges[1] if len(edges) > 1 else self._clock.monotonic_ns()
+            for listener in self._echo_listeners:
+                listener(timestamp)
+        if len(edges) < 2:
+            #No echo received - report 0 as no object
+            distance = 0
+        else:
+            distance = round((edges[1] - edges[0]) / 1e9 * 17150, 2)
+        self.last_distance = distance
+        recorder = get_recorder()
+        if recorder is not None:
+            recorder.record_distance(self._pin, distance)
+        future.set_result(distance)
+
+    def measure_distance(self, callback=None, timeout=None):
+        """
+        Starts a measurement and returns immediately. Returns Future which
+        resolves to the distance in cm (0 if no echo was received). If
+        callback is provided it is called with the distance when done.
+        timeout overrides the sensor's timeout for this measurement.
+        When a measurement is already in flight its result is shared.
+        """
+        future = Future()
+        if callback is not None:
+            if not callable(callback):
+                raise AttributeError('callback is not callable')
+            future.add_done_callback(lambda fut: callback(fut.result()))
+
+        self.init()
+        with self._lock:
+            if self._pending is not None:
+                self._pending.add_done_callback(
+                    lambda fut: future.set_result(fut.result()))
+                return future
+            self._pending = future
+            self._edges = []
 
-    def _distance_measure(self, callback, delay=1):
-        if delay < 0.2:
-            delay = 0.2
-        while self.measure_running.is_set():
-            distance = self.get_distance()
-            callback(distance)
-            time.sleep(delay)
-        GPIO.cleanup(self._pin)
+        GPIO.setup(self._pin, GPIO.OUT)
+        # Send 10us pulse to trigger
+        GPIO.output(self._pin, True)
+        self._clock.sleep(0.00001)
+        GPIO.output(self._pin, False)
 
-    def start_distance_measure(self, callback, delay=1):
+        GPIO.setup(self._pin, GPIO.IN)
+        with self._lock:
+            if self._pending is future:
+                self._listening = True
+                if GPIO.input(self._pin):
+                    #Echo started before listening - its rising edge was missed
+                    self._edges.append(self._clock.monotonic_ns())
+                if timeout is None:
+                    timeout = self._timeout
+                self._timeout_timer = self._clock.call_later(timeout, self._finish,
+                                                             name='distance_timeout')
+        return future
+
+    def get_distance(self):
+        """Blocking measurement - waits for the echo without busy looping.
+        The wait has its own deadline instead of relying on the timeout job,
+        so it does not deadlock when called from a job of the scheduler"""
+        future = self.measure_distance()
+        done = threading.Event()
+        future.add_done_callback(lambda fut: done.set())
+        if not self._clock.wait(done, self._timeout):
+            #Scheduler may be blocked by this call - end it without echo
+            self._finish()
+        return future.result()
+
+    def _measure_cycle(self, callback, priority):
+        def _cycle_done(distance):
+            if self.measure_running.is_set():
+                self._dispatcher.dispatch(priority, callback, distance)
+
+        self.measure_distance(_cycle_done)
+
+    def start_distance_measure(self, callback, delay=1, priority=PRIORITY_NORMAL):
+        """Measures the distance every delay seconds and passes it to callback.
+        Measurements are a periodic job of the clock's scheduler, callbacks
+        are called by the dispatcher with given priority"""
         if not self.measure_running.is_set():
             if callable(callback):
-                self._measure_thread = threading.Thread(target=self._distance_measure,
-                                                        args=(callback, delay))
+                if delay < 0.2:
+                    delay = 0.2
                 self.measure_running.set()
-                self._measure_thread.start()
+                self._cycle_job = self._clock.scheduler.call_every(
+                    delay, self._measure_cycle, callback, priority,
+                    name='distance_measure')
             else:
                 raise AttributeError()
 
     def stop_distance_measure(self):
         if self.measure_running.is_set():
             self.measure_running.clear()
+            job = self._cycle_job
+            if job is not None:
+                job.cancel()
+                self._cycle_job = None
+                GPIO.cleanup(self._pin)
 
-    def get_distance(self):
-        GPIO.setup(self._pin, GPIO.OUT)
-        # Send 10us pulse to trigger
-        GPIO.output(self._pin, True)
-        time.sleep(0.00001)
-        GPIO.output(self._pin, False)
 
-        GPIO.setup(self._pin, GPIO.IN)
-        pulse_start = time.time()
-        count = time.time()
-        pulse_end = count
-        while GPIO.input(self._pin) == 0 and time.time() - count < 0.1:
-            pulse_start = time.time()
-
-        count = time.time()
-        while GPIO.input(self._pin) == 1 and time.time() - count < 0.1:
-            pulse_end = time.time()
+class ServoBlaster(object):
+    """
+    Output backend for servoblaster. Instead of starting a shell for each
+    command it keeps the device (or FIFO or existing file given by path)
+    open. Commands are coalesced per pin - only the last position of each
+    servo is kept - and written to the device in one batch on flush. When
+    the device is not there (servod not running) or writing to it fails
+    the commands are dropped and the device is opened again on the next
+    flush
+
+    :param  path: path to servoblaster device
+    """
+    def __init__(self, path='/dev/servoblaster'):
+        self._path = path
+        self._file = None
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._reported = False
 
-        pulse_duration = pulse_end - pulse_start
-        distance = pulse_duration * 17150
-        return round(distance, 2)
+    @property
+    def is_open(self):
+        return self._file is not None
+
+    def open(self):
+        with self._lock:
+            if self._file is None:
+                self._open()
+
+    def _open(self):
+        #Without O_CREAT a missing device is not created as a regular file.
+        #Non blocking so a FIFO without reader fails instead of blocking
+        try:
+            fd = os.open(self._path, os.O_WRONLY | os.O_APPEND | os.O_NONBLOCK)
+        except OSError as error:
+            self._report('Cannot open %s - is servod running? %s' % (self._path, error))
+            return False
+        flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+        fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+        #Unbuffered so a failed write leaves nothing to be written on close
+        self._file = os.fdopen(fd, 'ab', 0)
+        self._reported = False
+        return True
+
+    def _drop(self):
+        #Closes the device after an error, next flush opens it again
+        try:
+            self._file.close()
+        except OSError:
+            pass
+        self._file = None
+
+    def _report(self, message):
+        #Reported once until the device is opened
+        if not self._reported:
+            print(message)
+            self._reported = True
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._drop()
+            self._pending.clear()
+
+    def set_steps(self, pin, steps, flush=True):
+        with self._lock:
+            self._pending[pin] = steps
+        if flush:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            if self._file is None and not self._open():
+                self._pending.clear()
+                return
+            commands = ''.join('P1-%s=%s\n' % (pin, steps)
+                               for pin, steps in self._pending.items())
+            self._pending.clear()
+            try:
+                self._file.write(commands.encode('ascii'))
+            except OSError as error:
+                #servod or the reader of the FIFO went away
+                self._report('Writing to %s failed: %s' % (self._path, error))
+                self._drop()
 
 
 class Servo(object):
-    def __init__(self, pin, min_steps, max_steps, max_angle):
+    def __init__(self, pin, min_steps, max_steps, max_angle, blaster=None):
         self._pin = pin
         self._min_steps = min_steps
         self._max_steps = max_steps
         self._max_angle = max_angle
         self._curr_angle = 0
+        self._own_blaster = blaster is None
+        self._blaster = ServoBlaster() if blaster is None else blaster
+        #Angle to steps table - angles are quantized to whole degrees
+        self._steps_table = [int(min_steps + (angle * (max_steps - min_steps) / max_angle))
+                             for angle in range(int(max_angle) + 1)]
         self._initialized = False
-        
-    def set_angle(self, angle):
+
+    @property
+    def current_angle(self):
+        return self._curr_angle
+
+    def set_angle(self, angle, flush=True):
         if self._initialized:
             angle = validate_max(angle, self._max_angle)
             self._curr_angle = angle
-            steps = int(self._min_steps + (self._curr_angle * (self._max_steps - self._min_steps) / self._max_angle))
-            command = 'echo P1-%s=%s > /dev/servoblaster' % (self._pin, steps) 
-            os.system(command) 
+            steps = self._steps_table[int(round(angle))]
+            self._blaster.set_steps(self._pin, steps, flush)
+            recorder = get_recorder()
+            if recorder is not None:
+                recorder.record_servo(self._pin, angle)
 
     def increase_angle(self, increment=10):
         self.set_angle(self._curr_angle + increment)
@@ -279,27 +700,34 @@ class Servo(object):
         return self._curr_angle
 
     def init(self):
+        self._blaster.open()
         self._initialized = True
 
     def cleanup(self):
+        if self._own_blaster:
+            self._blaster.close()
         self._initialized = False
 
 class ServosDriver(object):
     """
     Class which starts the servod blaster and configures it
     It also initiates servos which are connected (pan and tilt)
+    Both servos share one ServoBlaster writer so moves of both servos
+    can be written in a single batch using set_angles
     """
     def __init__(self, panpin, tiltpin, idletimeout, minsteps,
-                 maxsteps, panmaxangle, tiltmaxangle):
+                 maxsteps, panmaxangle, tiltmaxangle,
+                 servoblaster='/dev/servoblaster'):
         self._panpin = panpin
         self._tiltpin = tiltpin
         self._idletimeout = idletimeout
         self._minsteps = minsteps
         self._maxsteps = maxsteps
+        self._blaster = ServoBlaster(servoblaster)
         self.pan_servo = Servo(self._panpin, self._minsteps,
-                               self._maxsteps, panmaxangle)
+                               self._maxsteps, panmaxangle, self._blaster)
         self.tilt_servo = Servo(self._tiltpin, self._minsteps,
-                                self._maxsteps, tiltmaxangle)
+                                self._maxsteps, tiltmaxangle, self._blaster)
         self._initialized = False
 
     def init(self):
@@ -316,60 +744,227 @@ class ServosDriver(object):
             self.tilt_servo.init()
             self._initialized = True
 
+    def set_angles(self, pan_angle=None, tilt_angle=None):
+        """Moves both servos with one write to servoblaster"""
+        if pan_angle is not None:
+            self.pan_servo.set_angle(pan_angle, flush=False)
+        if tilt_angle is not None:
+            self.tilt_servo.set_angle(tilt_angle, flush=False)
+        self._blaster.flush()
+
     def cleanup(self):
         """Stops the servod"""
         if self._initialized:
             self.pan_servo.cleanup()
             self.tilt_servo.cleanup()
+            self._blaster.close()
             os.system('sudo killall servod')
             self._initialized = False
 
 class WheelCounter(object):
-    """ 
-        
     """
-    def __init__(self, whlsensor):
+    Counts edges of a wheel sensor and calls the finish callback as soon
+    as the target count is reached. The callback is called directly from
+    the edge callback so the motor can be stopped with minimal latency
+
+    Edges are debounced in software from edge timestamps instead of the
+    fixed GPIO bouncetime. An edge is rejected when it comes sooner than
+    ratio of the expected edge interval, which is the smaller one of the
+    measured (averaged) interval and the interval expected for the
+    commanded speed, but never sooner than min_interval
+
+    Once initiated the counter listens to the sensor all the time and
+    records timestamps of accepted edges in a fixed size ring buffer
+    which is used to estimate the wheel velocity
+
+    :param  whlsensor: instance of WheelSensor
+            clock: clock used for edge timestamps, default clock if None
+            max_rate: expected number of edges per second at speed 100
+            min_interval: shortest accepted edge interval in seconds
+            ratio: part of the expected interval under which edges are rejected
+            history: number of edge timestamps kept in the ring buffer
+            stall_time: time in seconds without edge after which the wheel
+            is considered stopped
+    """
+    def __init__(self, whlsensor, clock=None, max_rate=100, min_interval=0.001,
+                 ratio=0.3, history=64, stall_time=0.5):
         self._whlsensor = whlsensor
+        self._clock = clock if clock is not None else get_clock()
+        self._max_rate = max_rate
+        self._min_interval = int(min_interval * 1e9)
+        self._ratio = ratio
+        self._stall_time = int(stall_time * 1e9)
+        self._listening = False
         self._counting = False
         self._count = 0
         self._target = 0
         self._finish_callback = None
+        self._lock = threading.Lock()
+        self._speed = 0
+        self._last_edge = None
+        self._interval = None
+        self._accepted = 0
+        self._rejected = 0
+        self._edges = array('q', [0]) * history
+        self._edges_size = history
+        self._edges_head = 0
+        self._edge_listeners = []
 
     @property
     def count(self):
         return self._count
 
+    @property
+    def max_rate(self):
+        return self._max_rate
+
+    @property
+    def counting(self):
+        return self._counting
+
+    @property
+    def accepted_edges(self):
+        return self._accepted
+
+    @property
+    def rejected_edges(self):
+        return self._rejected
+
+    def set_speed(self, speed):
+        """Commanded speed of the wheel (0 - 100) used for debouncing"""
+        self._speed = validate_max(speed)
+
     def init(self):
-        pass
+        if not self._listening:
+            self._listening = self._whlsensor.register_both_callbacks(
+                self._callback, None, PRIORITY_HIGH, timestamp=True)
 
     def cleanup(self):
         if self._counting:
-            self._stop
+            self._stop()
+        if self._listening:
+            #Only own callback - the sensor is shared with other subscribers
+            self._whlsensor.remove_callback(self._callback)
+            self._listening = False
 
-    def start(self, target, callback):
+    def start(self, target, callback, speed=None):
 
         if self._counting:
             print('Already running')
         else:
             if not callable(callback):
                 raise AttributeError('callback is not callable')
-            self._finish_callback = callback
-            self._count = 0
-            self._target = int(round(target))
-            res = self._whlsensor.register_both_callbacks(self._callback, 20)
-            if res:
-                self._counting = True
-            else:
+            self.init()
+            if not self._listening:
                 print('Sensor not initiated')
+                return
+            #Last edge is kept so that bounce of the previous move's last
+            #edge is not counted as first step of this one
+            self._interval = None
+            if speed is not None:
+                self.set_speed(speed)
+            with self._lock:
+                self._finish_callback = callback
+                self._count = 0
+                self._target = int(round(target))
+                self._counting = True
 
-    def _stop(self):
-        if self._counting:
-            self._whlsensor.remove_callbacks()
-            self._finish_callback()
+    def cancel(self):
+        """Stops counting without calling the finish callback"""
+        with self._lock:
             self._finish_callback = None
             self._counting = False
 
-    def _callback(self, pin, state):
-        self._count += 1
-        if self._count >= self._target:
-            self._stop()
+    def _stop(self):
+        with self._lock:
+            if not self._counting:
+                return
+            callback = self._finish_callback
+            self._finish_callback = None
+            self._counting = False
+        callback()
+
+    def add_edge_listener(self, callback):
+        """Calls callback(timestamp) on every accepted edge. It is called
+        from the edge callback so it has to be short"""
+        #Copy on write so the event thread can iterate without locking
+        self._edge_listeners = self._edge_listeners + [callback]
+
+    def remove_edge_listener(self, callback):
+        self._edge_listeners = [listener for listener in self._edge_listeners
+                                if listener != callback]
+
+    def edge_times(self, window=None):
+        """Timestamps (ns) of recorded edges, oldest first. If window in
+        seconds is given only edges not older than window are returned"""
+        size = self._edges_size
+        head = self._edges_head
+        count = min(self._accepted, size)
+        times = [self._edges[(head - count + i) % size] for i in range(count)]
+        if window is not None:
+            oldest = self._clock.monotonic_ns() - int(window * 1e9)
+            times = [t for t in times if t >= oldest]
+        return times
+
+    def velocity(self, window=None):
+        """
+        Wheel velocity in steps per second. Without window it is the
+        instantaneous velocity from the last edge interval (decaying when
+        the next edge is late). With window in seconds it is the number of
+        edges within the window divided by the window
+        """
+        now = self._clock.monotonic_ns()
+        if window is not None:
+            oldest = now - int(window * 1e9)
+            size = self._edges_size
+            head = self._edges_head
+            count = 0
+            for i in range(1, min(self._accepted, size) + 1):
+                if self._edges[(head - i) % size] < oldest:
+                    break
+                count += 1
+            return count / float(window)
+
+        if self._accepted < 2:
+            return 0.0
+        last = self._edges[(self._edges_head - 1) % self._edges_size]
+        previous = self._edges[(self._edges_head - 2) % self._edges_size]
+        since_last = now - last
+        if since_last > self._stall_time:
+            return 0.0
+        interval = max(last - previous, since_last)
+        if interval <= 0:
+            return 0.0
+        return 1e9 / interval
+
+    def _reject_interval(self):
+        expected = self._interval
+        if self._speed > 0:
+            speed_interval = 1e9 / (self._max_rate * self._speed / 100.0)
+            if expected is None or speed_interval < expected:
+                expected = speed_interval
+        if expected is None:
+            return self._min_interval
+        return max(self._min_interval, expected * self._ratio)
+
+    def _callback(self, pin, state, timestamp):
+        #Timestamp of the edge - the callback may be dispatched later
+        if self._last_edge is not None:
+            interval = timestamp - self._last_edge
+            if interval < self._reject_interval():
+                self._rejected += 1
+                return
+            if self._interval is None:
+                self._interval = interval
+            else:
+                self._interval += (interval - self._interval) / 4.0
+        self._last_edge = timestamp
+        self._edges[self._edges_head] = timestamp
+        self._edges_head = (self._edges_head + 1) % self._edges_size
+        self._accepted += 1
+        for listener in self._edge_listeners:
+            listener(timestamp)
+        if self._counting:
+            self._count += 1
+            if self._count >= self._target:
+                self._stop()
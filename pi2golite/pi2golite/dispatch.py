@@ -0,0 +1,137 @@
+"""
+Dispatching of sensor callbacks away from the GPIO event thread.
+
+Edge callbacks of RPi.GPIO all run on one event thread so a slow user
+callback (e.g. sending data to a web client) would delay every other edge,
+wheel counting included. Sensor therefore only puts the edge to a bounded
+queue of its priority lane and the lane's worker thread calls the user
+callback. Lanes are independent so callbacks of a higher priority are
+never delayed behind UI notifications.
+
+PRIORITY_HIGH is meant for short, non-blocking callbacks like wheel
+counters and safety stops. By default it is dispatched inline on the
+event thread so the edge timestamps and motor stops are not delayed by
+a thread switch.
+
+Author: Radek Pribyl
+"""
+from __future__ import print_function
+import collections
+import threading
+import traceback
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+PRIORITY_NAMES = {PRIORITY_HIGH: 'high', PRIORITY_NORMAL: 'normal',
+                  PRIORITY_LOW: 'low'}
+
+
+class _Lane(object):
+    """Bounded queue of one priority with its worker thread. The queue is
+    a deque whose append and popleft are atomic so producers never lock.
+    When the queue is full the oldest event is dropped"""
+    def __init__(self, name, maxsize):
+        self.name = name
+        self.maxsize = maxsize
+        self._queue = collections.deque(maxlen=maxsize)
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self.enqueued = 0
+        self.dispatched = 0
+        self.dropped = 0
+        self.max_depth = 0
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def put(self, callback, args):
+        depth = len(self._queue)
+        if depth >= self.maxsize:
+            self.dropped += 1
+        else:
+            depth += 1
+            if depth > self.max_depth:
+                self.max_depth = depth
+        self._queue.append((callback, args))
+        self.enqueued += 1
+        if self._thread is None:
+            self._start()
+        self._wakeup.set()
+
+    def _start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='dispatch-' + self.name)
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        queue = self._queue
+        while True:
+            self._wakeup.wait()
+            self._wakeup.clear()
+            while True:
+                try:
+                    callback, args = queue.popleft()
+                except IndexError:
+                    break
+                _call(callback, args)
+                self.dispatched += 1
+
+    def stats(self):
+        return {'depth': len(self._queue), 'max_depth': self.max_depth,
+                'enqueued': self.enqueued, 'dispatched': self.dispatched,
+                'dropped': self.dropped}
+
+
+def _call(callback, args):
+    try:
+        callback(*args)
+    except Exception:
+        traceback.print_exc()
+
+
+class Dispatcher(object):
+    """
+    Dispatches callbacks through priority lanes
+
+    :param  maxsize: capacity of each lane queue
+            inline_high: dispatch PRIORITY_HIGH directly on the calling thread
+            synchronous: dispatch everything on the calling thread - used
+            with VirtualClock so simulations stay deterministic
+    """
+    def __init__(self, maxsize=256, inline_high=True, synchronous=False):
+        self.synchronous = synchronous
+        self.inline_high = inline_high
+        self._lanes = dict((priority, _Lane(name, maxsize))
+                           for priority, name in PRIORITY_NAMES.items())
+
+    def dispatch(self, priority, callback, *args):
+        if self.synchronous or (priority == PRIORITY_HIGH and self.inline_high):
+            _call(callback, args)
+        else:
+            self._lanes[priority].put(callback, args)
+
+    def stats(self):
+        """Queue depth, maximal depth and number of enqueued, dispatched
+        and dropped events per lane"""
+        return dict((lane.name, lane.stats()) for lane in self._lanes.values())
+
+
+_default_dispatcher = Dispatcher()
+
+
+def get_dispatcher():
+    """Returns dispatcher used by sensors created without explicit dispatcher"""
+    return _default_dispatcher
+
+
+def set_dispatcher(dispatcher):
+    """Sets dispatcher used by sensors created without explicit dispatcher"""
+    global _default_dispatcher
+    _default_dispatcher = dispatcher
@@ -0,0 +1,370 @@
+"""
+Headless simulation of a fleet of Pi2Go Lite robots for tuning behaviours
+and controller gains on many robots at once.
+
+One FleetSimulation is the GPIO backend of all the robots. Pins of robot i
+are the board pins of Pi2GoLiteConfig moved by i * pin_stride, so every
+robot is an ordinary Robot with real components and the production
+Steering, StepSteering and MeasureSteering - only its configuration
+differs (see config and robots).
+
+State of all robots is kept in NumPy arrays: motor duty cycles, wheel
+travel, poses, encoder and obstacle sensor levels and sonar ranges are
+computed for the whole fleet in every tick. Python code runs per robot
+only for the pin changes which have an edge detection - those are fired
+to the components exactly like on the real robot.
+
+The fleet is driven by a VirtualClock (it never runs in real time), robots
+do not see each other and the switch is never pressed. While its robots
+run the fleet is the global GPIO backend of the process (see robots). Models and units
+are those of pi2golite.simGPIO.Simulation.
+
+Requires numpy.
+
+Author: Radek Pribyl
+"""
+import math
+import threading
+import numpy as np
+from pi2golite import Pi2GoLiteConfig, Robot
+from pi2golite.clock import VirtualClock
+from pi2golite.components import use_gpio
+from pi2golite.dispatch import Dispatcher
+from pi2golite.simGPIO import LOW, HIGH, OUT, PUD_OFF, SPEED_OF_SOUND, \
+    DEFAULT_PINS, GPIOConstants, SimPWM, World, detect_edge
+
+#Columns of the duty array
+_MOTOR_PINS = ('left_fwd', 'left_rev', 'right_fwd', 'right_rev')
+#Columns of the input level array
+_INPUT_PINS = ('left_encoder', 'right_encoder', 'obstacle_left', 'obstacle_right')
+#Angles of IR obstacle sensors relative to the heading
+_OBSTACLE_ANGLES = (0.35, -0.35)
+#Config keys holding pin numbers
+_PIN_KEYS = ('pin', 'fwdpin', 'revpin')
+
+
+class FleetSimulation(GPIOConstants):
+    """
+    Simulated fleet of Pi2Go Lite robots exposing one RPi.GPIO interface
+
+    :param  size: number of robots
+            world: instance of pi2golite.simGPIO.World shared by all robots
+            clock: VirtualClock driving the fleet, new one if None
+            step: integration step in seconds
+            max_speed: wheel speed in cm/s at 100 % duty cycle
+            wheel_gain: multipliers of left and right wheel speed - either
+            one pair for all robots or array of shape (size, 2)
+            whl_diameter, robot_width, numsteps: robot geometry
+            sonar_range: maximal range of ultrasonic sensor in cm
+            obstacle_range: range of IR obstacle sensors in cm
+            pins: dictionary overriding default pin assignment of a robot
+            pin_stride: difference of pin numbers of consecutive robots
+    """
+    default_pins = DEFAULT_PINS
+
+    def __init__(self, size, world=None, clock=None, step=0.001, max_speed=40.0,
+                 wheel_gain=(1.0, 1.0), whl_diameter=6.5, robot_width=12,
+                 numsteps=16, sonar_range=400.0, obstacle_range=15.0, pins=None,
+                 pin_stride=100):
+        self.size = int(size)
+        self.world = world if world is not None else World()
+        self.step = step
+        self.max_speed = max_speed
+        self.robot_width = robot_width
+        self.step_dist = math.pi * whl_diameter / numsteps
+        self.sonar_range = sonar_range
+        self.obstacle_range = obstacle_range
+        self.pin_stride = pin_stride
+        self.pins = dict(self.default_pins)
+        if pins:
+            self.pins.update(pins)
+        if max(self.pins.values()) >= pin_stride:
+            raise AttributeError('pin_stride has to be higher than all pins')
+        self._motor_columns = dict((self.pins[name], column)
+                                   for column, name in enumerate(_MOTOR_PINS))
+        self._input_columns = dict((self.pins[name], column)
+                                   for column, name in enumerate(_INPUT_PINS))
+        self._input_pins = np.array([self.pins[name] for name in _INPUT_PINS])
+
+        self.ticks = 0
+        self.edges = 0
+        self.now = 0.0
+        self._gain = np.empty((self.size, 2))
+        self._gain[:] = wheel_gain
+        self._x = np.zeros(self.size)
+        self._y = np.zeros(self.size)
+        self._heading = np.zeros(self.size)
+        self.sonar_angles = np.zeros(self.size)
+        self._duty = np.zeros((self.size, 4))
+        self._travel = np.zeros((self.size, 2))
+        self._levels = np.zeros((self.size, 4), 'i1')
+        self._ranges = np.full(self.size, np.inf)
+
+        self._lock = threading.RLock()
+        self._modes = {}
+        self._outputs = {}
+        self._sonar_levels = {}
+        self._detects = {}
+        self._clock = None
+        self.previous_gpio = None
+        self.attach_clock(clock if clock is not None else VirtualClock())
+        self._update_inputs()
+
+    #Fleet control
+    @property
+    def clock(self):
+        return self._clock
+
+    def attach_clock(self, clock):
+        """Lets the virtual clock drive the fleet"""
+        with self._lock:
+            if self._clock is not None:
+                self._clock.remove_listener(self.advance_to)
+            self._clock = clock
+            self.now = clock.time()
+            clock.add_listener(self.advance_to)
+
+    @property
+    def poses(self):
+        """Array of shape (size, 3) with x, y and heading of all robots"""
+        return np.column_stack((self._x, self._y, self._heading))
+
+    def set_pose(self, index, x, y, heading=0.0):
+        """Sets pose of robot index - index can be also a slice or an index
+        array with x, y and heading arrays"""
+        with self._lock:
+            self._x[index] = x
+            self._y[index] = y
+            self._heading[index] = heading
+            self._update_inputs()
+
+    @property
+    def wheel_travel(self):
+        """Array of shape (size, 2) with absolute distance travelled by
+        left and right wheels"""
+        return self._travel.copy()
+
+    @property
+    def sonar_ranges(self):
+        """Distances the sonars of all robots see in the last tick, inf
+        where there is no wall within sonar_range"""
+        return self._ranges.copy()
+
+    def wheel_speeds(self):
+        """Array of shape (size, 2) with speeds of left and right wheels in cm/s"""
+        duty = self._duty
+        speeds = duty[:, 0::2] - duty[:, 1::2]
+        speeds *= self._gain
+        speeds *= self.max_speed / 100.0
+        return speeds
+
+    @property
+    def robot_steps(self):
+        """Number of ticks simulated for all robots"""
+        return self.ticks * self.size
+
+    def config(self, index, cfg=None):
+        """Returns copy of Pi2GoLiteConfig cfg (default one if None) with
+        pins of robot index and wheel sensors available"""
+        if cfg is None:
+            cfg = Pi2GoLiteConfig()
+        robot_cfg = Pi2GoLiteConfig()
+        offset = index * self.pin_stride
+        for name in dir(cfg):
+            value = getattr(cfg, name)
+            if name.startswith('_') or not isinstance(value, dict):
+                continue
+            value = dict(value)
+            for key in _PIN_KEYS:
+                if key in value:
+                    value[key] += offset
+            setattr(robot_cfg, name, value)
+        robot_cfg.wheelsensors = dict(robot_cfg.wheelsensors, avail=True)
+        #Servos are not simulated
+        robot_cfg.servos = dict(robot_cfg.servos, avail=False)
+        return robot_cfg
+
+    def robots(self, cfg=None, init=True):
+        """
+        Makes the fleet the GPIO backend and returns list of Robot, one
+        for every simulated robot, sharing the fleet's clock and one
+        synchronous dispatcher
+
+        The GPIO backend is global (see pi2golite.components.use_gpio) -
+        the fleet replaces it for every component in the process and it has
+        to stay the backend while the robots run. Other robots can not be
+        used at the same time. The replaced backend is kept in
+        previous_gpio so it can be restored with use_gpio afterwards
+
+        :param  cfg: Pi2GoLiteConfig used for all robots (see config)
+                init: if True the robots are initialized
+        """
+        previous = use_gpio(self)
+        if previous is not self:
+            self.previous_gpio = previous
+        dispatcher = Dispatcher(synchronous=True)
+        robots = []
+        for index in range(self.size):
+            robot = Robot(self.config(index, cfg), self._clock, dispatcher)
+            if init:
+                robot.init(parallel=False)
+            robots.append(robot)
+        return robots
+
+    def advance(self, duration):
+        """Advances the fleet by duration seconds of its clock"""
+        self._clock.advance(duration)
+
+    def advance_to(self, target):
+        """Advances the fleet up to time target. Edge callbacks are fired
+        from the calling thread"""
+        while True:
+            with self._lock:
+                if self.now >= target:
+                    return
+                end = min(self.now + self.step, target)
+                self._integrate(end - self.now)
+                self.now = end
+                self.ticks += 1
+                fired = self._update_inputs()
+            for callback, pin in fired:
+                callback(pin)
+
+    def _integrate(self, dt):
+        speeds = self.wheel_speeds()
+        self._travel += np.abs(speeds) * dt
+        speed = (speeds[:, 0] + speeds[:, 1]) * (dt / 2.0)
+        turn = (speeds[:, 1] - speeds[:, 0]) * (dt / self.robot_width)
+        heading = self._heading + turn / 2.0
+        self._x += speed * np.cos(heading)
+        self._y += speed * np.sin(heading)
+        self._heading += turn
+        np.mod(self._heading, 2 * math.pi, out=self._heading)
+
+    def _update_inputs(self):
+        #New levels of all inputs - returns callbacks of the changed pins
+        heading = self._heading[:, None]
+        angles = np.concatenate((heading + _OBSTACLE_ANGLES,
+                                 heading + self.sonar_angles[:, None]), axis=1)
+        distances = self.world.ray_distances(self._x, self._y, angles)
+        self._ranges = np.where(distances[:, 2] <= self.sonar_range, distances[:, 2], np.inf)
+
+        levels = np.empty_like(self._levels)
+        levels[:, :2] = (self._travel / self.step_dist).astype('i8') & 1
+        #IR sensors are active low
+        levels[:, 2:] = distances[:, :2] > self.obstacle_range
+        changed = np.nonzero(levels != self._levels)
+        self._levels = levels
+        if not len(changed[0]):
+            return []
+        pins = changed[0] * self.pin_stride + self._input_pins[changed[1]]
+        fired = []
+        for pin, level in zip(pins.tolist(), levels[changed].tolist()):
+            callback = self._detected(pin, level)
+            if callback is not None:
+                fired.append((callback, pin))
+        return fired
+
+    def _detected(self, pin, level):
+        #Callback of edge detection of pin which changed to level
+        detect = self._detects.get(pin)
+        if detect is None:
+            return None
+        callback = detect_edge(detect, level, self.now)
+        if callback is not None:
+            self.edges += 1
+        return callback
+
+    def _echo(self, pin):
+        #Trigger finished - schedule echo pulse according to the last tick
+        distance = self._ranges[pin // self.pin_stride]
+        if not np.isfinite(distance):
+            return
+        self._clock.call_later(0.0004, self._set_sonar, pin, HIGH, name='fleet_echo')
+        self._clock.call_later(0.0004 + 2 * distance / SPEED_OF_SOUND,
+                               self._set_sonar, pin, LOW, name='fleet_echo')
+
+    def _set_sonar(self, pin, level):
+        with self._lock:
+            previous = self._sonar_levels.get(pin, LOW)
+            self._sonar_levels[pin] = level
+            callback = None
+            if previous != level:
+                callback = self._detected(pin, level)
+        if callback is not None:
+            callback(pin)
+
+    def _set_duty(self, pin, duty):
+        column = self._motor_columns.get(pin % self.pin_stride)
+        if column is not None:
+            with self._lock:
+                self._duty[pin // self.pin_stride, column] = duty
+
+    def _input_level(self, pin):
+        robot, local = divmod(pin, self.pin_stride)
+        column = self._input_columns.get(local)
+        if column is not None:
+            return int(self._levels[robot, column])
+        if local == self.pins['switch']:
+            return HIGH
+        if local == self.pins['sonar']:
+            return self._sonar_levels.get(pin, LOW)
+        return LOW
+
+    #RPi.GPIO interface
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=PUD_OFF, initial=None):
+        with self._lock:
+            self._modes[pin] = mode
+            if mode == OUT:
+                self._outputs[pin] = initial if initial is not None else LOW
+
+    def input(self, pin):
+        with self._lock:
+            if self._modes.get(pin) == OUT:
+                return self._outputs.get(pin, LOW)
+            return self._input_level(pin)
+
+    def output(self, pin, value):
+        with self._lock:
+            value = HIGH if value else LOW
+            previous = self._outputs.get(pin, LOW)
+            self._outputs[pin] = value
+            if (pin % self.pin_stride == self.pins['sonar'] and previous == HIGH
+                    and value == LOW):
+                self._echo(pin)
+
+    def cleanup(self, pin=None):
+        with self._lock:
+            pins = list(self._modes) if pin is None else [pin]
+            for channel in pins:
+                self._modes.pop(channel, None)
+                self._outputs.pop(channel, None)
+                self._detects.pop(channel, None)
+                self._set_duty(channel, 0)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self._lock:
+            if pin in self._detects:
+                raise RuntimeError('Conflicting edge detection already enabled '
+                                   'for this GPIO channel')
+            bounce = (bouncetime or 0) / 1000.0
+            self._detects[pin] = [edge, callback, bounce, None]
+
+    def add_event_callback(self, pin, callback):
+        with self._lock:
+            if pin not in self._detects:
+                raise RuntimeError('Add event detection using add_event_detect first')
+            self._detects[pin][1] = callback
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._detects.pop(pin, None)
+
+    def PWM(self, pin, frequency):
+        return SimPWM(self, pin, frequency)
@@ -0,0 +1,255 @@
+"""
+Occupancy grid mapping of Pi2Go Lite surroundings from ultrasonic range
+readings placed by the robot pose (see pi2golite.odometry).
+
+The grid stores log-odds of occupancy per cell: cells crossed by a ray get
+l_free added, the cell where the echo came from gets l_occ added. All rays
+of an update are traced together with NumPy - samples along all rays are
+computed as one array and each touched cell is updated once per update.
+
+The grid is split to square tiles which are created when a ray reaches
+them, so the map grows in any direction. The map can be saved to a
+memory-mapped file and loaded from it - tiles of a loaded map stay in the
+file and are paged in by the OS only when used.
+
+Requires numpy.
+
+Author: Radek Pribyl
+"""
+import os
+import numpy as np
+
+#Cell indices within +-2 ** 30 are packed to one int64
+_OFFSET = 2 ** 30
+_MASK = 2 ** 32 - 1
+
+
+def _pack(columns, rows):
+    return ((columns + _OFFSET) << 32) | (rows + _OFFSET)
+
+
+def _unpack(packed):
+    return (packed >> 32) - _OFFSET, (packed & _MASK) - _OFFSET
+
+
+class OccupancyGrid(object):
+    """
+    Log-odds occupancy grid growing in tiles
+
+    :param  resolution: size of a cell in distance units (cm)
+            tile_size: number of cells of a tile side
+            max_range: maximal range of the sensor - readings without echo
+            clear cells up to this range
+            l_occ: log-odds added to the cell of an echo
+            l_free: log-odds added to cells a ray passed through
+            l_min, l_max: limits of the log-odds of a cell
+            beam_width: full width of the sensor beam in radians
+            beam_rays: number of rays a reading is traced as across the beam
+    """
+    def __init__(self, resolution=2.0, tile_size=64, max_range=150.0, l_occ=0.85,
+                 l_free=-0.4, l_min=-5.0, l_max=5.0, beam_width=0.26, beam_rays=5):
+        self.resolution = float(resolution)
+        self.tile_size = int(tile_size)
+        self.max_range = float(max_range)
+        self.l_occ = l_occ
+        self.l_free = l_free
+        self.l_min = l_min
+        self.l_max = l_max
+        self.beam_width = beam_width
+        self.beam_rays = beam_rays
+        self._tiles = {}
+        self._file_tiles = None
+        self._file_path = None
+        self._file_mode = None
+        #Incremented by every change so derived data can be cached
+        self.version = 0
+
+    @property
+    def tiles(self):
+        """Keys (column, row) of existing tiles"""
+        return sorted(self._tiles)
+
+    def _tile(self, key):
+        tile = self._tiles.get(key)
+        if tile is None:
+            tile = self._tiles[key] = np.zeros((self.tile_size, self.tile_size), 'f4')
+        return tile
+
+    def cell(self, x, y):
+        """Cell indices (column, row) of point x, y"""
+        return (int(np.floor(x / self.resolution)), int(np.floor(y / self.resolution)))
+
+    def log_odds(self, x, y):
+        """Log-odds of the cell containing point x, y - 0 if unknown"""
+        column, row = self.cell(x, y)
+        tile = self._tiles.get((column // self.tile_size, row // self.tile_size))
+        if tile is None:
+            return 0.0
+        return float(tile[row % self.tile_size, column % self.tile_size])
+
+    def probability(self, x, y):
+        return 1.0 - 1.0 / (1.0 + np.exp(self.log_odds(x, y)))
+
+    def update(self, pose, angles, ranges):
+        """
+        Adds range readings to the map
+
+        :param  pose: (x, y, heading) of the robot - either one pose or
+                arrays with pose of each reading
+                angles: angles of the readings relative to the heading
+                ranges: measured ranges, 0 or NaN if there was no echo
+        """
+        x, y, heading = [np.asarray(value, 'f8') for value in pose[-3:]]
+        angles = np.atleast_1d(np.asarray(angles, 'f8'))
+        ranges = np.atleast_1d(np.asarray(ranges, 'f8'))
+        x, y, heading, angles, ranges = np.broadcast_arrays(x, y, heading, angles, ranges)
+        if not ranges.size:
+            return
+
+        hit = np.isfinite(ranges) & (ranges > 0) & (ranges < self.max_range)
+        lengths = np.where(hit, ranges, self.max_range)
+        lengths = np.nan_to_num(lengths, nan=self.max_range)
+
+        #Every reading becomes beam_rays rays spread across the beam
+        if self.beam_rays > 1:
+            spread = np.linspace(-self.beam_width / 2, self.beam_width / 2, self.beam_rays)
+        else:
+            spread = np.zeros(1)
+        ray_angles = (heading + angles)[:, None] + spread[None, :]
+        ray_x = np.repeat(x, len(spread))
+        ray_y = np.repeat(y, len(spread))
+        ray_angles = ray_angles.ravel()
+        ray_lengths = np.repeat(lengths, len(spread))
+        ray_hit = np.repeat(hit, len(spread))
+        cos_a = np.cos(ray_angles)
+        sin_a = np.sin(ray_angles)
+
+        #Samples along all rays at half of the cell size
+        step = self.resolution / 2.0
+        dist = np.arange(0.0, ray_lengths.max(), step)
+        inside = dist[None, :] < (ray_lengths[:, None] - step)
+        free_x = (ray_x[:, None] + dist[None, :] * cos_a[:, None])[inside]
+        free_y = (ray_y[:, None] + dist[None, :] * sin_a[:, None])[inside]
+        free = self._cells(free_x, free_y)
+
+        occupied = self._cells(ray_x[ray_hit] + ray_lengths[ray_hit] * cos_a[ray_hit],
+                               ray_y[ray_hit] + ray_lengths[ray_hit] * sin_a[ray_hit])
+        free = np.setdiff1d(free, occupied, assume_unique=True)
+        self._add(free, self.l_free)
+        self._add(occupied, self.l_occ)
+
+    def update_scan(self, scan, pose):
+        """
+        Adds scan of pi2golite.scanner.SweepScanner to the map. pose is
+        either (x, y, heading) of the robot during the scan or Odometry
+        instance - then the pose at the time of each reading is used
+        """
+        if hasattr(pose, 'pose_at'):
+            poses = [pose.pose_at(timestamp) or pose.pose for timestamp in scan['timestamp']]
+            pose = np.array([current[1:] for current in poses]).T
+        self.update(pose, scan['angle'], scan['range'])
+
+    def add_reading(self, pose, distance, angle=0.0):
+        """Adds single reading of DistanceSensor pointing at angle"""
+        self.update(pose, angle, distance)
+
+    def _cells(self, xs, ys):
+        #Unique cells packed to one int64 each
+        columns = np.floor(xs / self.resolution).astype('i8')
+        rows = np.floor(ys / self.resolution).astype('i8')
+        return np.unique(_pack(columns, rows))
+
+    def _add(self, cells, value):
+        if not len(cells):
+            return
+        columns, rows = _unpack(cells)
+        size = self.tile_size
+        #Group cells by tile so every tile is updated with one fancy index
+        keys = _pack(columns // size, rows // size)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        columns = columns[order] % size
+        rows = rows[order] % size
+        starts = np.flatnonzero(np.r_[True, keys[1:] != keys[:-1]])
+        ends = np.r_[starts[1:], len(keys)]
+        tile_columns, tile_rows = _unpack(keys[starts])
+        for start, end, column, row in zip(starts, ends, tile_columns, tile_rows):
+            tile = self._tile((int(column), int(row)))
+            index = (rows[start:end], columns[start:end])
+            tile[index] = np.clip(tile[index] + value, self.l_min, self.l_max)
+        self.version += 1
+
+    def to_array(self):
+        """
+        Returns dense log-odds array of all tiles (rows are y) and world
+        coordinates of the corner of its first cell. Unknown cells are 0
+        """
+        size = self.tile_size
+        if not self._tiles:
+            return np.zeros((0, 0), 'f4'), (0.0, 0.0)
+        keys = np.array(list(self._tiles))
+        low = keys.min(axis=0)
+        high = keys.max(axis=0) + 1
+        grid = np.zeros(((high[1] - low[1]) * size, (high[0] - low[0]) * size), 'f4')
+        for (column, row), tile in self._tiles.items():
+            top = (row - low[1]) * size
+            left = (column - low[0]) * size
+            grid[top:top + size, left:left + size] = tile
+        return grid, (low[0] * size * self.resolution, low[1] * size * self.resolution)
+
+    def save(self, path):
+        """
+        Saves the map to memory-mapped .npy file path with tiles and
+        path + '.meta.npz' with tile keys and parameters. The files are
+        written as temporary files first and then replace the old ones, so
+        the map can be saved also to the file it was loaded from. Saved
+        tiles are then used from the file as if the map was loaded from it
+        """
+        keys = sorted(self._tiles)
+        shape = (len(keys), self.tile_size, self.tile_size)
+        tiles = np.lib.format.open_memmap(path + '.tmp', mode='w+', dtype='f4', shape=shape)
+        for index, key in enumerate(keys):
+            tiles[index] = self._tiles[key]
+        tiles.flush()
+        del tiles
+        meta_path = path + '.meta.npz'
+        with open(meta_path + '.tmp', 'wb') as meta:
+            np.savez(meta, keys=np.array(keys, 'i8').reshape(-1, 2),
+                     params=np.array([self.resolution, self.tile_size, self.max_range,
+                                      self.l_occ, self.l_free, self.l_min, self.l_max,
+                                      self.beam_width, self.beam_rays]))
+        os.replace(path + '.tmp', path)
+        os.replace(meta_path + '.tmp', meta_path)
+        if keys:
+            #Tiles in memory or mapping the replaced file are mapped from the saved one
+            self._map_tiles(path, self._file_mode or 'r+', keys)
+
+    def _map_tiles(self, path, mode, keys):
+        tiles = np.load(path, mmap_mode=mode)
+        self._file_tiles = tiles
+        self._file_path = os.path.abspath(path)
+        self._file_mode = mode
+        for index, (column, row) in enumerate(keys):
+            self._tiles[(int(column), int(row))] = tiles[index]
+
+    @classmethod
+    def load(cls, path, mode='r+'):
+        """
+        Loads map saved by save. Tiles stay in the memory-mapped file -
+        with mode 'r+' updates of them are written to the file, 'c' keeps
+        them in memory only
+        """
+        with np.load(path + '.meta.npz') as meta:
+            keys = meta['keys']
+            params = meta['params']
+        grid = cls(resolution=params[0], tile_size=int(params[1]), max_range=params[2],
+                   l_occ=params[3], l_free=params[4], l_min=params[5], l_max=params[6],
+                   beam_width=params[7], beam_rays=int(params[8]))
+        if len(keys):
+            grid._map_tiles(path, mode, keys)
+        return grid
+
+    def flush(self):
+        """Writes changes of memory-mapped tiles to the file"""
+        if self._file_tiles is not None and hasattr(self._file_tiles, 'flush'):
+            self._file_tiles.flush()
@@ -0,0 +1,227 @@
+"""
+Dead reckoning of Pi2Go Lite robot from its wheel counters.
+
+Every accepted edge of a wheel counter is one step of that wheel. The step
+is signed by the direction the motor of the wheel is driven in (or was
+driven last when the wheel coasts) and integrated into the pose right on
+the edge callback - one update is a constant amount of work. The position
+of the other wheel at the time of the edge is interpolated from its last
+edge interval - otherwise a wheel whose edges always come just before the
+other wheel's would bias the heading by half a step. Uncertainty
+of the pose is propagated as 3x3 covariance matrix using error of each
+wheel step proportional to its length.
+
+The pose is x and y in distance units of the robot geometry (cm for the
+default configuration) and heading in radians counter clockwise, 0 being
+the direction of x axis.
+
+Author: Radek Pribyl
+"""
+import math
+import threading
+from array import array
+from collections import namedtuple
+from pi2golite.clock import get_clock
+
+#Pose of the robot at monotonic time (ns) - see Odometry
+Pose = namedtuple('Pose', ['timestamp', 'x', 'y', 'heading'])
+
+
+class Odometry(object):
+    """
+    Pose estimation from wheel counters. Listens to both counters from
+    construction and keeps history of poses in a fixed size ring buffer
+    which can be queried by time (see pose_at)
+
+    :param  lf_counter: WheelCounter of left wheel
+            rg_counter: WheelCounter of right wheel
+            lf_motor: Motor of left wheel giving the direction of steps
+            rg_motor: Motor of right wheel
+            step_distance: distance travelled by the wheel per step
+            robot_width: distance between the wheels
+            clock: clock used for timestamps, default clock if None
+            history: number of poses kept in the ring buffer
+            step_error: variance of a step per unit of its length
+    """
+    def __init__(self, lf_counter, rg_counter, lf_motor, rg_motor, step_distance,
+                 robot_width, clock=None, history=256, step_error=0.05):
+        self._clock = clock if clock is not None else get_clock()
+        self._motors = (lf_motor, rg_motor)
+        self._step = float(step_distance)
+        self._width = float(robot_width)
+        self._step_error = step_error
+        self._last_dirs = [1, 1]
+        self._stall_time = int(0.5e9)
+        self._lock = threading.Lock()
+        self._size = history
+        self._times = array('q', [0]) * history
+        self._xs = array('d', [0.0]) * history
+        self._ys = array('d', [0.0]) * history
+        self._headings = array('d', [0.0]) * history
+        self._head = 0
+        self._count = 0
+        self.steps = [0, 0]
+        self.reset()
+        lf_counter.add_edge_listener(lambda timestamp: self._on_step(0, timestamp))
+        rg_counter.add_edge_listener(lambda timestamp: self._on_step(1, timestamp))
+
+    def reset(self, x=0.0, y=0.0, heading=0.0):
+        """Sets the pose, clears covariance and history"""
+        with self._lock:
+            self._x = float(x)
+            self._y = float(y)
+            self._heading = float(heading)
+            self._cov = [[0.0] * 3 for _ in range(3)]
+            #Per wheel time and interval of the last edge and the position
+            #(in steps) already integrated into the pose
+            self._edge_times = [None, None]
+            self._intervals = [None, None]
+            self._applied = [0.0, 0.0]
+            self._head = 0
+            self._count = 0
+            self._record(self._clock.monotonic_ns())
+
+    @property
+    def pose(self):
+        with self._lock:
+            return Pose(self._times[(self._head - 1) % self._size],
+                        self._x, self._y, self._heading)
+
+    @property
+    def covariance(self):
+        """Covariance of x, y and heading as 3x3 list of lists"""
+        with self._lock:
+            return [row[:] for row in self._cov]
+
+    def _direction(self, wheel):
+        direction = self._motors[wheel].direction
+        if direction:
+            self._last_dirs[wheel] = direction
+            return direction
+        #Coasting wheel keeps its last direction
+        return self._last_dirs[wheel]
+
+    def _on_step(self, wheel, timestamp):
+        #Called from wheel counter edge callback
+        direction = self._direction(wheel)
+        with self._lock:
+            last = self._edge_times[wheel]
+            if last is not None and timestamp - last < self._stall_time:
+                self._intervals[wheel] = timestamp - last
+            else:
+                self._intervals[wheel] = None
+            self._edge_times[wheel] = timestamp
+            self.steps[wheel] += direction
+
+            positions = [self.steps[0], self.steps[1]]
+            other = 1 - wheel
+            positions[other] += self._fraction(other, timestamp)
+            dist_lf = (positions[0] - self._applied[0]) * self._step
+            dist_rg = (positions[1] - self._applied[1]) * self._step
+            self._applied = positions
+
+            dist = (dist_lf + dist_rg) / 2.0
+            dtheta = (dist_rg - dist_lf) / self._width
+            angle = self._heading + dtheta / 2.0
+            cos_a = math.cos(angle)
+            sin_a = math.sin(angle)
+            self._x += dist * cos_a
+            self._y += dist * sin_a
+            self._heading = (self._heading + dtheta + math.pi) % (2 * math.pi) - math.pi
+            self._propagate(dist, dist_lf, dist_rg, cos_a, sin_a)
+            self._record(timestamp)
+
+    def _fraction(self, wheel, timestamp):
+        #Signed part of the next step the wheel made since its last edge
+        direction = self._motors[wheel].direction
+        if not direction:
+            return 0.0
+        interval = self._intervals[wheel]
+        if interval is None or direction != self._last_dirs[wheel]:
+            #Just started - the phase of the wheel is not known yet
+            return 0.5 * direction
+        return direction * min(float(timestamp - self._edge_times[wheel]) / interval, 1.0)
+
+    def _propagate(self, dist, dist_lf, dist_rg, cos_a, sin_a):
+        #P = F P F' + J Q J' with F jacobian by pose and J by wheel travels
+        cov = self._cov
+        fx = -dist * sin_a
+        fy = dist * cos_a
+        c00, c01, c02 = cov[0]
+        c11, c12 = cov[1][1], cov[1][2]
+        c22 = cov[2][2]
+        n00 = c00 + 2 * fx * c02 + fx * fx * c22
+        n01 = c01 + fx * c12 + fy * c02 + fx * fy * c22
+        n02 = c02 + fx * c22
+        n11 = c11 + 2 * fy * c12 + fy * fy * c22
+        n12 = c12 + fy * c22
+        arm = dist / (2 * self._width)
+        for sign, travel in ((1, dist_rg), (-1, dist_lf)):
+            q = self._step_error * abs(travel)
+            if not q:
+                continue
+            jx = 0.5 * cos_a - sign * arm * sin_a
+            jy = 0.5 * sin_a + sign * arm * cos_a
+            jt = sign / self._width
+            n00 += jx * jx * q
+            n01 += jx * jy * q
+            n02 += jx * jt * q
+            n11 += jy * jy * q
+            n12 += jy * jt * q
+            c22 += jt * jt * q
+        self._cov = [[n00, n01, n02], [n01, n11, n12], [n02, n12, c22]]
+
+    def _record(self, timestamp):
+        head = self._head
+        self._times[head] = timestamp
+        self._xs[head] = self._x
+        self._ys[head] = self._y
+        self._headings[head] = self._heading
+        self._head = (head + 1) % self._size
+        if self._count < self._size:
+            self._count += 1
+
+    def history(self):
+        """Recorded poses, oldest first"""
+        with self._lock:
+            start = self._head - self._count
+            return [self._pose(start + i) for i in range(self._count)]
+
+    def _pose(self, index):
+        index %= self._size
+        return Pose(self._times[index], self._xs[index], self._ys[index],
+                    self._headings[index])
+
+    def pose_at(self, timestamp):
+        """
+        Pose at monotonic time timestamp (ns) interpolated between the
+        recorded poses. Returns None if timestamp is older than the history
+        and the current pose if it is newer than the last step
+        """
+        with self._lock:
+            start = self._head - self._count
+            times = self._times
+            size = self._size
+            #Binary search over the ring in logical order
+            low, high = 0, self._count
+            while low < high:
+                middle = (low + high) // 2
+                if times[(start + middle) % size] <= timestamp:
+                    low = middle + 1
+                else:
+                    high = middle
+            if low == 0:
+                return None
+            before = self._pose(start + low - 1)
+            if low == self._count or before.timestamp == timestamp:
+                return before
+            after = self._pose(start + low)
+        #After a longer pause the robot stood still until shortly before the step
+        moving_since = max(before.timestamp, after.timestamp - self._stall_time)
+        if timestamp <= moving_since:
+            return Pose(timestamp, before.x, before.y, before.heading)
+        ratio = float(timestamp - moving_since) / (after.timestamp - moving_since)
+        turn = (after.heading - before.heading + math.pi) % (2 * math.pi) - math.pi
+        heading = (before.heading + ratio * turn + math.pi) % (2 * math.pi) - math.pi
+        return Pose(timestamp, before.x + ratio * (after.x - before.x),
+                    before.y + ratio * (after.y - before.y), heading)
@@ -0,0 +1,269 @@
+"""
+Path planning over pi2golite.mapping.OccupancyGrid.
+
+The occupancy grid is downsampled (a coarse cell is blocked if any of its
+cells is occupied) and a distance field to the nearest obstacle is
+computed with NumPy. Cells closer to an obstacle than the robot radius are
+blocked (inflation) and cells near obstacles cost more so paths keep
+clearance. The cost grid is cached until the map changes, so replanning
+between motion segments only runs A*.
+
+The found path is simplified to straight lines and turned to spin and
+forward segments of MeasureSteering quantised to whole encoder steps -
+each segment is computed from the pose the previous quantised segments
+lead to, so rounding errors do not accumulate. The segments can be run
+directly by MotionQueue.
+
+Requires numpy.
+
+Author: Radek Pribyl
+"""
+import heapq
+import math
+import numpy as np
+
+_SQRT2 = math.sqrt(2)
+_OCTILE = _SQRT2 - 1
+_NEIGHBOURS = ((-1, -1, _SQRT2), (-1, 0, 1.0), (-1, 1, _SQRT2), (0, -1, 1.0),
+               (0, 1, 1.0), (1, -1, _SQRT2), (1, 0, 1.0), (1, 1, _SQRT2))
+
+
+class PathPlanner(object):
+    """
+    A* planner on downsampled and inflated occupancy grid
+
+    :param  grid: instance of OccupancyGrid
+            robot_radius: radius of the robot in distance units
+            downsample: number of map cells merged to one planning cell per side
+            occupied: log-odds above which a map cell is an obstacle
+            clearance: distance from obstacles (beyond robot_radius) where
+            cells cost more
+            clearance_weight: extra cost of a cell touching the inflated obstacle
+            measure_steering: MeasureSteering used for step quantisation
+            of primitives - step_distance and robot_width can be given instead
+    """
+    def __init__(self, grid, robot_radius=8.0, downsample=2, occupied=0.5,
+                 clearance=10.0, clearance_weight=2.0, measure_steering=None,
+                 step_distance=None, robot_width=None):
+        self.grid = grid
+        self.robot_radius = robot_radius
+        self.downsample = int(downsample)
+        self.occupied = occupied
+        self.clearance = clearance
+        self.clearance_weight = clearance_weight
+        if measure_steering is not None:
+            step_distance = measure_steering.step_distance
+            robot_width = measure_steering.robot_width
+        self.step_distance = step_distance
+        self.robot_width = robot_width
+        self._cache = None
+
+    @property
+    def cell_size(self):
+        return self.grid.resolution * self.downsample
+
+    def cost_grid(self):
+        """
+        Returns cached (cost, distance, origin) of the planning grid.
+        cost is float array with inf for blocked cells, distance is the
+        distance field to the nearest obstacle in distance units
+        """
+        key = (self.grid.version, len(self.grid.tiles))
+        if self._cache is None or self._cache[0] != key:
+            self._cache = (key,) + self._build_cost_grid()
+        return self._cache[1:]
+
+    def _build_cost_grid(self):
+        log_odds, origin = self.grid.to_array()
+        factor = self.downsample
+        rows = -(-log_odds.shape[0] // factor)
+        columns = -(-log_odds.shape[1] // factor)
+        padded = np.zeros((rows * factor, columns * factor), bool)
+        padded[:log_odds.shape[0], :log_odds.shape[1]] = log_odds > self.occupied
+        obstacles = padded.reshape(rows, factor, columns, factor).any(axis=(1, 3))
+
+        cell = self.cell_size
+        max_dist = (self.robot_radius + self.clearance) / cell
+        distance = _distance_field(obstacles, max_dist) * cell
+        cost = 1.0 + self.clearance_weight * np.clip(
+            1.0 - (distance - self.robot_radius) / self.clearance, 0.0, 1.0)
+        cost[distance < self.robot_radius] = np.inf
+        return cost, distance, origin
+
+    def _to_cell(self, point, origin):
+        cell = self.cell_size
+        return (int(math.floor((point[1] - origin[1]) / cell)),
+                int(math.floor((point[0] - origin[0]) / cell)))
+
+    def plan(self, start, goal):
+        """
+        Returns list of (x, y) waypoints from start to goal with the
+        start and goal points at its ends, or None if there is no path.
+        Only the x and y of start / goal are used so Pose can be passed
+        """
+        start = tuple(start[-3:-1]) if len(start) > 2 else tuple(start)
+        goal = tuple(goal[-3:-1]) if len(goal) > 2 else tuple(goal)
+        cost, _, origin = self.cost_grid()
+        start_cell = self._to_cell(start, origin)
+        goal_cell = self._to_cell(goal, origin)
+        if not (_inside(start_cell, cost.shape) and _inside(goal_cell, cost.shape)):
+            return None
+        cells = _astar(cost, start_cell, goal_cell)
+        if cells is None:
+            return None
+        cell = self.cell_size
+        points = [(origin[0] + (column + 0.5) * cell, origin[1] + (row + 0.5) * cell)
+                  for row, column in self._simplify(cells, cost)]
+        return [start] + points[1:-1] + [goal]
+
+    def _simplify(self, cells, cost):
+        #Keeps only cells where the straight line from the last kept one
+        #would cross a cell more expensive than the path it replaces
+        kept = [cells[0]]
+        anchor = 0
+        limit = cost[cells[0]]
+        for index in range(1, len(cells)):
+            limit = max(limit, cost[cells[index]])
+            if index > 1 and not _line_free(cost, cells[anchor], cells[index], limit):
+                anchor = index - 1
+                kept.append(cells[anchor])
+                limit = max(cost[cells[anchor]], cost[cells[index]])
+        kept.append(cells[-1])
+        return kept
+
+    def primitives(self, start, waypoints):
+        """
+        Turns waypoints to list of MeasureSteering segments - spins in
+        degrees and forward moves in distance units - quantised to whole
+        encoder steps. start is (x, y, heading) or Pose
+        """
+        x, y, heading = start[-3:]
+        step = self.step_distance
+        #Heading change of a spin step (both wheels make one step)
+        spin_step = 2.0 * step / self.robot_width
+        segments = []
+        #Goal is repeated to correct the miss caused by quantised last turn
+        for target_x, target_y in list(waypoints) + list(waypoints[-1:]):
+            dx = target_x - x
+            dy = target_y - y
+            length = math.hypot(dx, dy)
+            if length < step / 2.0:
+                continue
+            turn = (math.atan2(dy, dx) - heading + math.pi) % (2 * math.pi) - math.pi
+            turn_steps = int(round(abs(turn) / spin_step))
+            if turn_steps:
+                angle = turn_steps * spin_step
+                segments.append(('spin_left' if turn > 0 else 'spin_right',
+                                 math.degrees(angle)))
+                heading += angle if turn > 0 else -angle
+            #Distance along the quantised heading closest to the target
+            along = dx * math.cos(heading) + dy * math.sin(heading)
+            forward_steps = int(round(along / step))
+            if forward_steps > 0:
+                dist = forward_steps * step
+                if segments and segments[-1][0] == 'forward':
+                    segments[-1] = ('forward', segments[-1][1] + dist)
+                else:
+                    segments.append(('forward', dist))
+                x += dist * math.cos(heading)
+                y += dist * math.sin(heading)
+        return segments
+
+    def plan_moves(self, start, goal):
+        """Plans path from start pose to goal point and returns MeasureSteering
+        segments (see primitives) or None if there is no path"""
+        waypoints = self.plan(start, goal)
+        if waypoints is None:
+            return None
+        return self.primitives(start, waypoints[1:])
+
+
+def _inside(cell, shape):
+    return 0 <= cell[0] < shape[0] and 0 <= cell[1] < shape[1]
+
+
+def _distance_field(obstacles, max_dist):
+    #Distance (in cells) to the nearest obstacle up to max_dist. Obstacle
+    #map is shifted by every offset within max_dist, nearest offsets first
+    rows, columns = obstacles.shape
+    distance = np.full(obstacles.shape, max_dist, 'f8')
+    distance[obstacles] = 0.0
+    reach = int(math.ceil(max_dist))
+    offsets = [(math.hypot(dy, dx), dy, dx) for dy in range(-reach, reach + 1)
+               for dx in range(-reach, reach + 1) if 0 < math.hypot(dy, dx) < max_dist]
+    for length, dy, dx in sorted(offsets):
+        source = obstacles[max(dy, 0):rows + min(dy, 0), max(dx, 0):columns + min(dx, 0)]
+        target = distance[max(-dy, 0):rows + min(-dy, 0), max(-dx, 0):columns + min(-dx, 0)]
+        np.minimum(target, np.where(source, length, max_dist), out=target)
+    return distance
+
+
+def _line_free(cost, start, end, limit):
+    #Straight line is free when no cell on it costs more than limit
+    count = max(abs(end[0] - start[0]), abs(end[1] - start[1])) * 2 + 1
+    rows = np.rint(np.linspace(start[0], end[0], count)).astype(int)
+    columns = np.rint(np.linspace(start[1], end[1], count)).astype(int)
+    return bool(np.all(cost[rows, columns] <= limit))
+
+
+def _astar(cost, start, goal):
+    #Grid is padded by blocked border so neighbours need no bounds checks
+    padded = np.full((cost.shape[0] + 2, cost.shape[1] + 2), np.inf)
+    padded[1:-1, 1:-1] = cost
+    columns = padded.shape[1]
+    flat_cost = padded.ravel().tolist()
+    inf = float('inf')
+    start_index = (start[0] + 1) * columns + start[1] + 1
+    goal_index = (goal[0] + 1) * columns + goal[1] + 1
+    if flat_cost[goal_index] == inf:
+        return None
+    #Robot may stand in inflated area - it is allowed to leave it
+    flat_cost[start_index] = 1.0
+    neighbours = [(d_row * columns + d_column, length)
+                  for d_row, d_column, length in _NEIGHBOURS]
+    goal_row, goal_column = divmod(goal_index, columns)
+    best = [inf] * len(flat_cost)
+    parents = [-1] * len(flat_cost)
+    closed = bytearray(len(flat_cost))
+    best[start_index] = 0.0
+    #Ties of estimate are broken by longer distance travelled
+    heap = [(0.0, 0.0, start_index)]
+    push = heapq.heappush
+    pop = heapq.heappop
+    while heap:
+        _, dist, index = pop(heap)
+        dist = -dist
+        if index == goal_index:
+            break
+        if closed[index]:
+            continue
+        closed[index] = 1
+        here = flat_cost[index]
+        for offset, length in neighbours:
+            neighbour = index + offset
+            step_cost = flat_cost[neighbour]
+            if step_cost == inf or closed[neighbour]:
+                continue
+            new_dist = dist + length * (here + step_cost) * 0.5
+            if new_dist < best[neighbour]:
+                best[neighbour] = new_dist
+                parents[neighbour] = index
+                #Octile distance - admissible as the cheapest cell costs 1
+                n_row, n_column = divmod(neighbour, columns)
+                delta_row = abs(goal_row - n_row)
+                delta_column = abs(goal_column - n_column)
+                if delta_row > delta_column:
+                    estimate = delta_row + _OCTILE * delta_column
+                else:
+                    estimate = delta_column + _OCTILE * delta_row
+                push(heap, (new_dist + estimate, -new_dist, neighbour))
+    else:
+        return None
+    path = []
+    index = goal_index
+    while index != -1:
+        row, column = divmod(index, columns)
+        path.append((row - 1, column - 1))
+        index = parents[index]
+    path.reverse()
+    return path
@@ -0,0 +1,337 @@
+"""
+Replay of a telemetry recording (see pi2golite.telemetry) through the
+pi2golite stack.
+
+ReplayGPIO stands in for RPi.GPIO. The replayed robot runs on its
+VirtualClock which starts at the time of the first record. The recorded
+commands are called on the robot and the recorded sensor edges are fired
+to the edge detection callbacks at their recorded times - events of the
+same time in their recorded order (by sequence number). Every distance
+measurement gets an echo of the next recorded distance of its pin. While
+replaying ReplayGPIO is also the telemetry recorder, so the duty cycle
+writes and servo angles the stack issues are compared with the recorded
+ones - per pin in order - and every difference is reported as Divergence.
+
+    replay = ReplayGPIO('telemetry')
+    use_gpio(replay)
+    robot = Robot(cfg, replay.clock)
+    report = replay.run(robot, speed=None)
+    print(report.summary())
+
+The replay runs in real time (speed 1), N times faster (speed N) or as
+fast as possible (speed None).
+
+Author: Radek Pribyl
+"""
+import os
+import time
+from collections import namedtuple
+from pi2golite.clock import VirtualClock
+from pi2golite.simGPIO import LOW, HIGH, OUT, PUD_OFF, RISING, FALLING, \
+    GPIOConstants, SimPWM
+from pi2golite.telemetry import get_recorder, set_recorder, read_ring, \
+    decode_command_args
+
+#Difference of actuator command number index (per channel and pin) -
+#expected or actual is None when the command is missing or extra
+Divergence = namedtuple('Divergence', ['timestamp', 'channel', 'pin', 'index',
+                                       'expected', 'actual', 'expected_timestamp'])
+
+#Compared actuator channels
+_ACTUATORS = ('pwm', 'servo')
+#Kinds of replayed events
+_COMMAND = 0
+_EDGE = 1
+
+
+def _earliest(divergence):
+    #Late command diverges already at the time it was expected
+    if divergence.expected_timestamp is None:
+        return divergence.timestamp
+    return min(divergence.timestamp, divergence.expected_timestamp)
+
+
+class ReplayReport(object):
+    """Result of ReplayGPIO.run. unrecorded is list of (timestamp, name)
+    of commands which were skipped as their arguments were not recorded"""
+    def __init__(self, divergences, compared, commands, edges, duration, unrecorded=()):
+        self.divergences = divergences
+        self.compared = compared
+        self.commands = commands
+        self.edges = edges
+        self.duration = duration
+        self.unrecorded = list(unrecorded)
+
+    @property
+    def ok(self):
+        return not self.divergences and not self.unrecorded
+
+    @property
+    def first_divergence(self):
+        if self.divergences:
+            return min(self.divergences, key=_earliest)
+
+    def summary(self, limit=10):
+        """Text report with the first limit divergences in order of time.
+        Commands are compared in order so the first divergence is usually
+        the cause of the following ones"""
+        lines = ['replayed %d commands and %d edges in %.3f s, compared %d actuator '
+                 'commands, %d divergences' % (self.commands, self.edges, self.duration,
+                                               self.compared, len(self.divergences))]
+        for timestamp, name in self.unrecorded[:limit]:
+            lines.append('  %.6f s command %s skipped - arguments not recorded'
+                         % (timestamp / 1e9, name))
+        for divergence in sorted(self.divergences, key=_earliest)[:limit]:
+            expected = divergence.expected
+            if expected is not None:
+                expected = '%s at %.6f s' % (expected, divergence.expected_timestamp / 1e9)
+            lines.append('  %.6f s %s pin %d #%d: expected %s, actual %s'
+                         % (divergence.timestamp / 1e9, divergence.channel, divergence.pin,
+                            divergence.index, expected, divergence.actual))
+        return '\n'.join(lines)
+
+
+class ReplayGPIO(GPIOConstants):
+    """
+    GPIO backend replaying telemetry recorded to directory
+
+    :param  directory: directory of the ring files of TelemetryRecorder
+            value_tolerance: allowed difference of duty cycle or angle
+            time_tolerance: allowed difference of command times in seconds
+    """
+    def __init__(self, directory, value_tolerance=0.01, time_tolerance=0.05):
+        self.directory = directory
+        self.value_tolerance = value_tolerance
+        self.time_tolerance = int(time_tolerance * 1e9)
+        records = dict((channel, self._read(channel))
+                       for channel in ('edge', 'distance', 'command') + _ACTUATORS)
+        events = [(timestamp, sequence, _EDGE, pin, level)
+                  for timestamp, sequence, pin, level in records['edge']]
+        for timestamp, sequence, name, encoded in records['command']:
+            events.append((timestamp, sequence, _COMMAND, name.rstrip(b'\0').decode('ascii'),
+                           decode_command_args(encoded)))
+        #Sequence numbers keep the recorded order of events of the same time
+        events.sort(key=lambda event: (event[0], event[1]))
+        self._events = events
+        self._distances = {}
+        for _, _, pin, distance in records['distance']:
+            self._distances.setdefault(pin, []).append(distance)
+        self._expected = {}
+        for channel in _ACTUATORS:
+            for timestamp, _, pin, value in records[channel]:
+                self._expected.setdefault((channel, pin), []).append((timestamp, value))
+        times = [record[0] for channel_records in records.values()
+                 for record in channel_records[:1]]
+        self.start = min(times) if times else 0
+        self.end = max([record[0] for channel_records in records.values()
+                        for record in channel_records[-1:]] or [0])
+        self.clock = VirtualClock(start=self.start / 1e9)
+
+        self._levels = {}
+        self._modes = {}
+        self._outputs = {}
+        self._detects = {}
+        self._duty = {}
+        self._reset()
+
+    def _read(self, channel):
+        path = os.path.join(self.directory, channel + '.ring')
+        return read_ring(path) if os.path.exists(path) else []
+
+    def _reset(self):
+        self._robot = None
+        self._next = 0
+        self._actual = {}
+        self._divergences = []
+        self._compared = 0
+        self._commands = 0
+        self._unrecorded = []
+        self._edges = 0
+        self._echoes = dict((pin, list(distances))
+                            for pin, distances in self._distances.items())
+        #Pins start at the level before their first recorded edge
+        self._levels = {}
+        for _, _, kind, pin, level in self._events:
+            if kind == _EDGE and pin not in self._levels:
+                self._levels[pin] = HIGH - level
+
+    def run(self, robot, speed=None, init=True, tail=1.0):
+        """
+        Replays the recording on robot built with this backend and the
+        replay clock. Returns ReplayReport
+
+        :param  robot: Robot to replay the commands on
+                speed: 1 for real time, N for N times faster, None as fast
+                as possible
+                init: initialize the robot at the start of the recording
+                tail: seconds replayed after the last record
+        """
+        self._reset()
+        self._robot = robot
+        previous = get_recorder()
+        set_recorder(self)
+        wall_start = time.perf_counter()
+        try:
+            if init:
+                robot.init(parallel=False)
+            self._schedule_next()
+            end = self.end / 1e9 + tail
+            if speed is None:
+                self.clock.advance(max(end - self.clock.time(), 0))
+            else:
+                origin = self.clock.time()
+                while self.clock.time() < end:
+                    self.clock.advance(min(self.clock.resolution * 10, end - self.clock.time()))
+                    delay = (self.clock.time() - origin) / speed - \
+                        (time.perf_counter() - wall_start)
+                    if delay > 0:
+                        time.sleep(delay)
+        finally:
+            set_recorder(previous)
+            self._robot = None
+        #Recorded commands the stack did not issue
+        for key, expected in self._expected.items():
+            for index in range(len(self._actual.get(key, ())), len(expected)):
+                timestamp, value = expected[index]
+                self._divergences.append(Divergence(timestamp, key[0], key[1], index,
+                                                    value, None, timestamp))
+        return ReplayReport(self._divergences, self._compared, self._commands,
+                            self._edges, time.perf_counter() - wall_start,
+                            self._unrecorded)
+
+    def _schedule_next(self):
+        if self._next < len(self._events):
+            delay = self._events[self._next][0] / 1e9 - self.clock.time()
+            self.clock.call_later(max(delay, 0), self._replay_event, name='replay')
+
+    def _replay_event(self):
+        #Runs all events due now and schedules the next one
+        now = self.clock.monotonic_ns()
+        while self._next < len(self._events) and self._events[self._next][0] <= now:
+            timestamp, _, kind, target, value = self._events[self._next]
+            self._next += 1
+            if kind == _COMMAND:
+                self._commands += 1
+                if value is None:
+                    #Arguments were not recorded - the command cannot be replayed
+                    self._unrecorded.append((timestamp, target))
+                    continue
+                args, kwargs = value
+                getattr(self._robot, target)(*args, **kwargs)
+            else:
+                self._edges += 1
+                self._set_level(target, value, always=True)
+        self._schedule_next()
+
+    def _set_level(self, pin, level, always=False):
+        #Recorded edges are fired even if the level did not change (bounce)
+        previous = self._levels.get(pin, LOW)
+        self._levels[pin] = level
+        detect = self._detects.get(pin)
+        if detect is None or (previous == level and not always):
+            return
+        edge, callback = detect
+        if edge == RISING and level == LOW or edge == FALLING and level == HIGH:
+            return
+        if callback is not None:
+            callback(pin)
+
+    def _echo(self, pin):
+        #Trigger finished - echo pulse of the next recorded distance
+        distances = self._echoes.get(pin)
+        if not distances:
+            return
+        distance = distances.pop(0)
+        if distance <= 0:
+            return
+        self.clock.call_later(0.0004, self._set_level, pin, HIGH, name='replay_echo')
+        self.clock.call_later(0.0004 + distance / 17150.0, self._set_level, pin, LOW,
+                              name='replay_echo')
+
+    def _compare(self, channel, pin, value):
+        key = (channel, pin)
+        actual = self._actual.setdefault(key, [])
+        index = len(actual)
+        timestamp = self.clock.monotonic_ns()
+        actual.append((timestamp, value))
+        expected = self._expected.get(key, ())
+        if index >= len(expected):
+            self._divergences.append(Divergence(timestamp, channel, pin, index,
+                                                None, value, None))
+            return
+        self._compared += 1
+        expected_timestamp, expected_value = expected[index]
+        if (abs(expected_value - value) > self.value_tolerance
+                or abs(expected_timestamp - timestamp) > self.time_tolerance):
+            self._divergences.append(Divergence(timestamp, channel, pin, index,
+                                                expected_value, value,
+                                                expected_timestamp))
+
+    #Telemetry recorder interface - actuator commands of the replayed stack
+    def record_pwm(self, pin, duty):
+        self._compare('pwm', pin, duty)
+
+    def record_servo(self, pin, angle):
+        self._compare('servo', pin, angle)
+
+    def record_edge(self, pin, level):
+        pass
+
+    def record_distance(self, pin, distance):
+        pass
+
+    def record_command(self, name, *args, **kwargs):
+        pass
+
+    def _set_duty(self, pin, duty):
+        self._duty[pin] = duty
+
+    #RPi.GPIO interface
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=PUD_OFF, initial=None):
+        self._modes[pin] = mode
+        if mode == OUT:
+            self._outputs[pin] = initial if initial is not None else LOW
+
+    def input(self, pin):
+        if self._modes.get(pin) == OUT:
+            return self._outputs.get(pin, LOW)
+        #Echo is low until the pulse, active low sensors are high when idle
+        return self._levels.get(pin, LOW if pin in self._distances else HIGH)
+
+    def output(self, pin, value):
+        value = HIGH if value else LOW
+        previous = self._outputs.get(pin, LOW)
+        self._outputs[pin] = value
+        if previous == HIGH and value == LOW and pin in self._distances:
+            self._echo(pin)
+
+    def cleanup(self, pin=None):
+        pins = list(self._modes) if pin is None else [pin]
+        for channel in pins:
+            self._modes.pop(channel, None)
+            self._outputs.pop(channel, None)
+            self._detects.pop(channel, None)
+            self._duty.pop(channel, None)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        if pin in self._detects:
+            raise RuntimeError('Conflicting edge detection already enabled '
+                               'for this GPIO channel')
+        self._detects[pin] = [edge, callback]
+
+    def add_event_callback(self, pin, callback):
+        if pin not in self._detects:
+            raise RuntimeError('Add event detection using add_event_detect first')
+        self._detects[pin][1] = callback
+
+    def remove_event_detect(self, pin):
+        self._detects.pop(pin, None)
+
+    def PWM(self, pin, frequency):
+        return SimPWM(self, pin, frequency)
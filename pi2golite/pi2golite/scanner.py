@@ -0,0 +1,239 @@
+"""
+Range scans of Pi2Go Lite surroundings made by sweeping the ultrasonic
+distance sensor with the pan servo.
+
+The sweep is event driven and pipelined: the move of the servo to the
+next angle is commanded as soon as the end of the current echo is
+captured (see DistanceSensor.add_echo_listener), so the servo moves and
+settles while the distance is computed and stored, while the scan is
+finished and while the scan callbacks run. The next measurement is a
+scheduler job run once the servo has settled, so no thread waits for the
+servo or the echo. A point without echo costs only the echo time of
+max_range instead of the sensor timeout. Consecutive scans sweep in
+alternating directions so the servo never returns to the start.
+
+Scans are NumPy structured arrays with fields angle (radians, 0 is the
+robot heading, positive to the left), range (cm, NaN when there was no
+echo) and timestamp (monotonic ns of the measurement) sorted by angle.
+
+Requires numpy.
+
+Author: Radek Pribyl
+"""
+import threading
+from concurrent.futures import Future
+import numpy as np
+from pi2golite.clock import get_clock
+
+SCAN_DTYPE = np.dtype([('angle', 'f8'), ('range', 'f8'), ('timestamp', 'i8')])
+
+#Servo angle increment in degrees of the scan modes
+SCAN_MODES = {'sparse': 30, 'dense': 5}
+
+#Time in seconds from the trigger to the start of the echo pulse
+ECHO_DELAY = 0.002
+
+
+class SweepScanner(object):
+    """
+    Polar range scanner using pan servo and distance sensor
+
+    :param  pan_servo: Servo turning the distance sensor
+            distance_sensor: instance of DistanceSensor
+            clock: clock used for timing, default clock if None
+            mode: 'sparse' or 'dense' (see SCAN_MODES)
+            angles: servo angles in degrees to scan instead of the mode
+            settle_time: time in seconds the servo needs to settle after any move
+            servo_speed: servo speed in degrees per second added to settle_time
+            max_angle: maximal servo angle, its middle points forward
+            direction: 1 if increasing servo angle turns the sensor left, -1 if right
+            max_range: range in cm beyond which a point counts as no echo -
+            the measurement ends after the echo time of this range
+    """
+    def __init__(self, pan_servo, distance_sensor, clock=None, mode='sparse',
+                 angles=None, settle_time=0.02, servo_speed=600, max_angle=180,
+                 direction=1, max_range=400):
+        self._servo = pan_servo
+        self._sensor = distance_sensor
+        self._clock = clock if clock is not None else get_clock()
+        self._settle_time = settle_time
+        self._servo_speed = float(servo_speed)
+        self._max_angle = max_angle
+        self._direction = direction
+        #Trigger to echo start delay and the echo of max_range
+        self._echo_timeout = ECHO_DELAY + max_range / 17150.0
+        self._lock = threading.Lock()
+        self._scan = None
+        self._continuous = None
+        self._reverse = False
+        self.set_mode(mode, angles)
+        self.reset_stats()
+        self._sensor.add_echo_listener(self._echo_captured)
+
+    def close(self):
+        """Stops scanning and detaches from the distance sensor"""
+        self.stop()
+        self._sensor.remove_echo_listener(self._echo_captured)
+
+    @property
+    def angles(self):
+        """Servo angles of a scan in degrees"""
+        return self._angles.copy()
+
+    @property
+    def scanning(self):
+        return self._scan is not None
+
+    def set_mode(self, mode='sparse', angles=None):
+        """Sets the scan mode or explicit servo angles used by next scans"""
+        if angles is None:
+            if mode not in SCAN_MODES:
+                raise AttributeError('unknown scan mode %s' % mode)
+            angles = np.arange(0, self._max_angle + 1, SCAN_MODES[mode])
+            self.mode = mode
+        else:
+            self.mode = 'custom'
+        angles = np.unique(np.clip(np.asarray(angles, dtype='f8'), 0, self._max_angle))
+        self._angles = angles
+        #Scan angles in radians relative to the robot heading
+        self._radians = np.radians(angles - self._max_angle / 2.0) * self._direction
+
+    def reset_stats(self):
+        self.scan_count = 0
+        self.scan_time = 0.0
+        self.last_duration = None
+
+    @property
+    def scans_per_second(self):
+        """Achieved scan rate of the finished scans"""
+        if not self.scan_time:
+            return 0.0
+        return self.scan_count / self.scan_time
+
+    def scan_async(self, callback=None):
+        """
+        Starts a scan and returns concurrent.futures.Future resolved with
+        the scan. Optional callback is called with the scan when done.
+        A running scan is shared
+        """
+        with self._lock:
+            if self._scan is not None:
+                future = self._scan['future']
+            else:
+                future = self._start_scan()
+        if callback is not None:
+            future.add_done_callback(lambda fut: callback(fut.result()))
+        return future
+
+    def scan(self):
+        """Blocking scan - returns the scan when done"""
+        future = self.scan_async()
+        done = threading.Event()
+        future.add_done_callback(lambda fut: done.set())
+        self._clock.wait(done)
+        return future.result()
+
+    def start(self, callback):
+        """Scans continuously and passes every scan to callback"""
+        if not callable(callback):
+            raise AttributeError('callback is not callable')
+        with self._lock:
+            self._continuous = callback
+            if self._scan is None:
+                self._start_scan()
+
+    def stop(self):
+        """Stops continuous scanning after the running scan"""
+        with self._lock:
+            self._continuous = None
+
+    def _start_scan(self):
+        order = np.arange(len(self._angles))
+        if self._reverse:
+            order = order[::-1]
+        self._reverse = not self._reverse
+        self._scan = {'future': Future(), 'order': order, 'index': 0,
+                      'angles': self._angles, 'radians': self._radians,
+                      'ranges': np.empty(len(order)), 'times': np.empty(len(order), 'i8'),
+                      'start': self._clock.time(), 'measuring': False}
+        self._schedule_measure(self._scan, self._move(self._scan))
+        return self._scan['future']
+
+    def _move(self, scan):
+        #Commands the servo to the angle of the current point and returns
+        #the time it settles
+        angle = scan['angles'][scan['order'][scan['index']]]
+        delta = abs(angle - self._servo.current_angle)
+        self._servo.set_angle(angle)
+        settled = self._clock.time()
+        if delta:
+            settled += self._settle_time + delta / self._servo_speed
+        return settled
+
+    def _schedule_measure(self, scan, settled):
+        delay = max(settled - self._clock.time(), 0)
+        self._clock.call_later(delay, self._measure, scan, name='scan_measure')
+
+    def _measure(self, scan):
+        index = scan['index']
+        scan['times'][scan['order'][index]] = self._clock.monotonic_ns()
+        scan['measuring'] = True
+        self._sensor.measure_distance(lambda distance: self._measured(scan, index, distance),
+                                      timeout=self._echo_timeout)
+
+    def _echo_captured(self, timestamp):
+        #Echo of the current point ended - the servo starts to move to the
+        #next point before the distance is processed
+        scan = self._scan
+        if scan is None or not scan['measuring']:
+            return
+        scan['measuring'] = False
+        if scan['index'] + 1 < len(scan['order']):
+            scan['index'] += 1
+            scan['settled'] = self._move(scan)
+
+    def _measured(self, scan, index, distance):
+        scan['ranges'][scan['order'][index]] = distance if distance > 0 else np.nan
+        if index + 1 < len(scan['order']):
+            if scan['index'] == index:
+                #Shared measurement ended without the echo listener
+                scan['measuring'] = False
+                scan['index'] = index + 1
+                scan['settled'] = self._move(scan)
+            self._schedule_measure(scan, scan['settled'])
+            return
+
+        duration = self._clock.time() - scan['start']
+        with self._lock:
+            self.scan_count += 1
+            self.scan_time += duration
+            self.last_duration = duration
+            self._scan = None
+            callback = self._continuous
+            if callback is not None:
+                #Next scan starts before this one is processed
+                self._start_scan()
+        result = np.empty(len(scan['order']), SCAN_DTYPE)
+        result['angle'] = scan['radians']
+        result['range'] = scan['ranges']
+        result['timestamp'] = scan['times']
+        scan['future'].set_result(result)
+        if callback is not None:
+            callback(result)
+
+
+def to_points(scan, pose=None):
+    """
+    Converts scan to array of x, y points of the echoes (scans without
+    echo are left out). Points are relative to the robot unless pose
+    (x, y, heading) or odometry Pose is given
+    """
+    valid = scan[~np.isnan(scan['range'])]
+    angles = valid['angle']
+    ranges = valid['range']
+    if pose is not None:
+        x, y, heading = pose[-3:]
+        angles = angles + heading
+    else:
+        x = y = 0.0
+    return np.column_stack((x + ranges * np.cos(angles), y + ranges * np.sin(angles)))
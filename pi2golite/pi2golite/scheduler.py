@@ -0,0 +1,201 @@
+"""
+Central scheduler of periodic and one-shot jobs for Pi2Go Lite robot.
+All timed work of the components and behaviours (distance measurements,
+LED effects, control loops, timeouts) is registered as a job so the
+number of threads stays the same however many of them are active.
+
+Each clock owns one scheduler: SystemClock runs it on a single thread,
+VirtualClock runs due jobs while it is being advanced.
+
+Author: Radek Pribyl
+"""
+from __future__ import print_function
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+class JobStats(object):
+    """Execution statistics of all jobs sharing a name"""
+    __slots__ = ('name', 'runs', 'total_time', 'max_time', 'overruns',
+                 'lateness_sum', 'lateness_max')
+
+    def __init__(self, name):
+        self.name = name
+        self.runs = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.overruns = 0
+        self.lateness_sum = 0.0
+        self.lateness_max = 0.0
+
+    def as_dict(self):
+        runs = max(self.runs, 1)
+        return {'name': self.name, 'runs': self.runs,
+                'total_time': self.total_time,
+                'mean_time': self.total_time / runs,
+                'max_time': self.max_time, 'overruns': self.overruns,
+                'mean_lateness': self.lateness_sum / runs,
+                'max_lateness': self.lateness_max}
+
+
+class Job(object):
+    """
+    Job registered with Scheduler. One-shot job has interval None.
+    The job can be cancelled and waited for (until it runs or is cancelled)
+    """
+    def __init__(self, scheduler, when, interval, callback, args, stats):
+        self._scheduler = scheduler
+        self.when = when
+        self.interval = interval
+        self._callback = callback
+        self._args = args
+        self.stats = stats
+        self.lateness = 0.0
+        self.cancelled = False
+        self._done = threading.Event()
+
+    @property
+    def name(self):
+        return self.stats.name
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def cancel(self):
+        self.cancelled = True
+        self._done.set()
+
+    def wait(self, timeout=None):
+        return self._scheduler.clock.wait(self._done, timeout)
+
+
+class Scheduler(object):
+    """
+    Runs jobs at their due time in order. Periodic jobs run at a fixed
+    rate - when a run is so late that the next slot(s) have already
+    passed they are skipped and counted as overrun.
+
+    :param  clock: clock providing the time
+            threaded: if True jobs are run by a single background thread
+            started on the first registered job. Otherwise run_due has
+            to be called (which VirtualClock does)
+    """
+    def __init__(self, clock, threaded=True):
+        self.clock = clock
+        self._threaded = threaded
+        self._jobs = []
+        self._counter = itertools.count()
+        self._stats = {}
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def call_later(self, delay, callback, *args, **kwargs):
+        """Runs callback(*args) once after delay seconds. Optional keyword
+        name groups the statistics of the job"""
+        return self._add(delay, None, callback, args, kwargs.get('name'))
+
+    def call_every(self, interval, callback, *args, **kwargs):
+        """Runs callback(*args) every interval seconds, first after
+        keyword delay (default 0). The job stops when callback returns
+        False. Optional keyword name groups the statistics of the job"""
+        delay = kwargs.get('delay', 0)
+        return self._add(delay, interval, callback, args, kwargs.get('name'))
+
+    def stats(self):
+        """List of statistics dictionaries of all job names"""
+        with self._condition:
+            return [stats.as_dict() for stats in self._stats.values()]
+
+    @property
+    def pending_jobs(self):
+        with self._condition:
+            return sum(1 for entry in self._jobs if not entry[2].cancelled)
+
+    def next_due(self):
+        """Due time of the next job or None"""
+        with self._condition:
+            self._drop_cancelled()
+            return self._jobs[0][0] if self._jobs else None
+
+    def run_due(self, now):
+        """Runs all jobs due at time now"""
+        while True:
+            with self._condition:
+                self._drop_cancelled()
+                if not self._jobs or self._jobs[0][0] > now:
+                    return
+                job = heapq.heappop(self._jobs)[2]
+            self._run(job)
+
+    def _add(self, delay, interval, callback, args, name):
+        if name is None:
+            name = getattr(callback, '__qualname__', repr(callback))
+        with self._condition:
+            stats = self._stats.get(name)
+            if stats is None:
+                stats = self._stats[name] = JobStats(name)
+            job = Job(self, self.clock.time() + delay, interval, callback, args, stats)
+            self._push(job)
+            if self._threaded and self._thread is None:
+                self._thread = threading.Thread(target=self._run_forever)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+        return job
+
+    def _push(self, job):
+        heapq.heappush(self._jobs, (job.when, next(self._counter), job))
+
+    def _drop_cancelled(self):
+        while self._jobs and self._jobs[0][2].cancelled:
+            heapq.heappop(self._jobs)
+
+    def _run(self, job):
+        if job.cancelled:
+            return
+        job.lateness = max(self.clock.time() - job.when, 0.0)
+        start = time.perf_counter()
+        try:
+            result = job._callback(*job._args)
+        except Exception:
+            traceback.print_exc()
+            result = None
+        elapsed = time.perf_counter() - start
+
+        with self._condition:
+            stats = job.stats
+            stats.runs += 1
+            stats.total_time += elapsed
+            stats.max_time = max(stats.max_time, elapsed)
+            stats.lateness_sum += job.lateness
+            stats.lateness_max = max(stats.lateness_max, job.lateness)
+            if job.interval is None or result is False or job.cancelled:
+                job._done.set()
+                return
+            job.when += job.interval
+            now = self.clock.time()
+            if job.when <= now:
+                stats.overruns += 1
+                missed = int((now - job.when) / job.interval) + 1
+                job.when += missed * job.interval
+            self._push(job)
+            self._condition.notify()
+
+    def _run_forever(self):
+        while True:
+            with self._condition:
+                while True:
+                    self._drop_cancelled()
+                    if self._jobs:
+                        delay = self._jobs[0][0] - self.clock.time()
+                        if delay <= 0:
+                            job = heapq.heappop(self._jobs)[2]
+                            break
+                        self._condition.wait(delay)
+                    else:
+                        self._condition.wait()
+            self._run(job)
@@ -0,0 +1,549 @@
+"""
+Simulated GPIO backend for Pi2Go Lite robot. It can be used instead of
+RPi.GPIO to run pi2golite off the robot - either by setting environment
+variable PI2GOLITE_GPIO=sim before pi2golite is imported or by passing
+a Simulation instance to pi2golite.components.use_gpio.
+
+The simulation is deterministic. It models two differential drive wheels
+driven by the PWM duty cycles of the motor pins, slotted wheel encoders on
+the line sensor pins, IR obstacle sensors and ultrasonic echo on the sonar
+pin, all inside a 2D world made of walls. Edge callbacks registered with
+add_event_detect are fired when the simulated pin levels change.
+
+Units are centimeters, seconds and radians. Heading 0 points along x axis.
+
+Author: Radek Pribyl
+"""
+import math
+import threading
+import time
+
+#Constants matching RPi.GPIO
+LOW = 0
+HIGH = 1
+OUT = 0
+IN = 1
+BOARD = 10
+BCM = 11
+PUD_OFF = 20
+PUD_DOWN = 21
+PUD_UP = 22
+RISING = 31
+FALLING = 32
+BOTH = 33
+
+SPEED_OF_SOUND = 34300.0
+
+#Board pins of Pi2GoLiteConfig used by the simulated robot
+DEFAULT_PINS = {'left_fwd': 26, 'left_rev': 24, 'right_fwd': 19,
+                'right_rev': 21, 'left_encoder': 12, 'right_encoder': 13,
+                'obstacle_left': 7, 'obstacle_right': 11, 'sonar': 8,
+                'switch': 23}
+
+
+class GPIOConstants(object):
+    """Constants of the RPi.GPIO interface for backend classes"""
+    LOW = LOW
+    HIGH = HIGH
+    OUT = OUT
+    IN = IN
+    BOARD = BOARD
+    BCM = BCM
+    PUD_OFF = PUD_OFF
+    PUD_DOWN = PUD_DOWN
+    PUD_UP = PUD_UP
+    RISING = RISING
+    FALLING = FALLING
+    BOTH = BOTH
+
+
+def detect_edge(detect, level, now):
+    """
+    Returns callback of edge detection detect - list [edge, callback,
+    bouncetime, last] of add_event_detect - for a pin changed to level at
+    time now, or None if the change is not detected. The time of the
+    detected edge is stored to the detection for the bouncetime
+    """
+    edge, callback, bouncetime, last = detect
+    if edge == RISING and level == LOW or edge == FALLING and level == HIGH:
+        return None
+    if last is not None and now - last < bouncetime:
+        return None
+    detect[3] = now
+    return callback
+
+
+def _ray_hit(qx, qy, dx, dy, sx, sy, denom):
+    #Distance along the ray and position on the wall (0 - 1 within the
+    #wall) of their intersection. Works with floats as well as NumPy arrays
+    return (qx * sy - qy * sx) / denom, (qx * dy - qy * dx) / denom
+
+
+class World(object):
+    """
+    2D world for the simulation defined by list of walls. Each wall is
+    a segment given as tuple (x1, y1, x2, y2)
+    """
+    def __init__(self, walls=None):
+        self.walls = list(walls) if walls else []
+        self._arrays = None
+        self._array_count = -1
+
+    @classmethod
+    def box(cls, width, height):
+        """World with four walls with corners at (0, 0) and (width, height)"""
+        return cls([(0, 0, width, 0), (width, 0, width, height),
+                    (width, height, 0, height), (0, height, 0, 0)])
+
+    def add_wall(self, x1, y1, x2, y2):
+        self.walls.append((x1, y1, x2, y2))
+
+    def ray_distance(self, x, y, heading, max_range):
+        """Distance to the nearest wall along the ray or None if no wall
+        is closer than max_range"""
+        dx = math.cos(heading)
+        dy = math.sin(heading)
+        nearest = None
+        for x1, y1, x2, y2 in self.walls:
+            sx = x2 - x1
+            sy = y2 - y1
+            denom = dx * sy - dy * sx
+            if denom == 0:
+                continue
+            dist, seg = _ray_hit(x1 - x, y1 - y, dx, dy, sx, sy, denom)
+            if dist >= 0 and 0 <= seg <= 1:
+                if nearest is None or dist < nearest:
+                    nearest = dist
+        if nearest is not None and nearest <= max_range:
+            return nearest
+        return None
+
+    def ray_distances(self, x, y, angles):
+        """
+        Distances to the nearest wall along rays of many robots at once.
+        Requires numpy
+
+        :param  x, y: arrays of shape (robots,) with the ray origins
+                angles: array of shape (robots, rays) with the ray angles
+        Returns array of shape (robots, rays), inf where no wall is hit
+        """
+        import numpy as np
+        walls, sx, sy = self._wall_arrays()
+        if not len(walls):
+            return np.full(angles.shape, np.inf)
+        dx = np.cos(angles)[:, :, None]
+        dy = np.sin(angles)[:, :, None]
+        qx = (walls[:, 0] - x[:, None])[:, None, :]
+        qy = (walls[:, 1] - y[:, None])[:, None, :]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            denom = dx * sy - dy * sx
+            dist, seg = _ray_hit(qx, qy, dx, dy, sx, sy, denom)
+        hit = (denom != 0) & (dist >= 0) & (seg >= 0) & (seg <= 1)
+        return np.where(hit, dist, np.inf).min(axis=2)
+
+    def _wall_arrays(self):
+        #Walls converted once (and again when a wall is added)
+        if self._array_count != len(self.walls):
+            import numpy as np
+            walls = np.array(self.walls, 'f8').reshape(-1, 4)
+            self._arrays = (walls, walls[:, 2] - walls[:, 0], walls[:, 3] - walls[:, 1])
+            self._array_count = len(self.walls)
+        return self._arrays
+
+
+class SimPWM(object):
+    """PWM channel of the simulation with the RPi.GPIO.PWM interface"""
+    def __init__(self, sim, pin, frequency):
+        self._sim = sim
+        self.pin = pin
+        self.frequency = frequency
+        self.duty = 0
+
+    def start(self, duty):
+        self.ChangeDutyCycle(duty)
+
+    def stop(self):
+        self.ChangeDutyCycle(0)
+
+    def ChangeFrequency(self, frequency):
+        self.frequency = frequency
+
+    def ChangeDutyCycle(self, duty):
+        self.duty = duty
+        self._sim._set_duty(self.pin, duty)
+
+
+class Simulation(GPIOConstants):
+    """
+    Simulated Pi2Go Lite robot exposing the RPi.GPIO interface.
+    Pin numbers default to the Pi2GoLiteConfig board pins.
+
+    :param  world: instance of World, defaults to empty world
+            realtime: if True a background thread advances the simulation
+            with the wall clock once a pin is set up. Otherwise it is
+            advanced only by calling advance
+            step: integration step in seconds
+            max_speed: wheel speed in cm/s at 100 % duty cycle
+            wheel_gain: tuple of multipliers of left and right wheel speed
+            to simulate imperfect motors
+            whl_diameter, robot_width, numsteps: robot geometry
+            sonar_range: maximal range of ultrasonic sensor in cm
+            obstacle_range: range of IR obstacle sensors in cm
+            encoder_bounce: if not 0 every encoder edge is followed by
+            a bounce (two extra edges) this many seconds apart
+            detect_delay: time in seconds edge detection takes to arm after
+            add_event_detect (RPi.GPIO exports the pin in sysfs)
+            pins: dictionary overriding default pin assignment
+            clock: optional pi2golite.clock.VirtualClock driving the
+            simulation instead of the wall clock
+    """
+    default_pins = DEFAULT_PINS
+
+    def __init__(self, world=None, realtime=True, step=0.001, max_speed=40.0,
+                 wheel_gain=(1.0, 1.0), whl_diameter=6.5, robot_width=12,
+                 numsteps=16, sonar_range=400.0, obstacle_range=15.0,
+                 encoder_bounce=0, detect_delay=0.0, pins=None, clock=None):
+        self.world = world if world is not None else World()
+        self.realtime = realtime
+        self.step = step
+        self.max_speed = max_speed
+        self.wheel_gain = wheel_gain
+        self.robot_width = robot_width
+        self.step_dist = math.pi * whl_diameter / numsteps
+        self.sonar_range = sonar_range
+        self.obstacle_range = obstacle_range
+        self.encoder_bounce = encoder_bounce
+        self.detect_delay = detect_delay
+        self.pins = dict(self.default_pins)
+        if pins:
+            self.pins.update(pins)
+
+        self.x = 0.0
+        self.y = 0.0
+        self.heading = 0.0
+        self.sonar_angle = 0.0
+        self.switch_pressed = False
+        self.now = 0.0
+
+        self._lock = threading.RLock()
+        self._modes = {}
+        self._outputs = {}
+        self._duty = {}
+        self._levels = {}
+        self._true_levels = {}
+        self._detects = {}
+        self._armed = {}
+        self._pending = []
+        self._travel = [0.0, 0.0]
+        self._runner = None
+        self._wakeup = threading.Event()
+        self._clock = None
+        if clock is not None:
+            self.attach_clock(clock)
+
+    #Simulation control
+    def attach_clock(self, clock):
+        """Lets the virtual clock drive the simulation. The simulation then
+        follows the clock instead of running in real time"""
+        with self._lock:
+            self._clock = clock
+            self.realtime = False
+            self.now = clock.time()
+            clock.add_listener(self.advance_to)
+            for when, pin, level in self._pending:
+                clock.call_later(when - self.now, self.advance_to, when,
+                                 name='simulation')
+
+    @property
+    def pose(self):
+        return (self.x, self.y, self.heading)
+
+    def set_pose(self, x, y, heading=0.0):
+        with self._lock:
+            self.x = x
+            self.y = y
+            self.heading = heading
+
+    @property
+    def wheel_travel(self):
+        """Absolute distance travelled by left and right wheel"""
+        return tuple(self._travel)
+
+    def wheel_speeds(self):
+        """Current speed of left and right wheel in cm/s"""
+        pins = self.pins
+        duty = self._duty
+        left = duty.get(pins['left_fwd'], 0) - duty.get(pins['left_rev'], 0)
+        right = duty.get(pins['right_fwd'], 0) - duty.get(pins['right_rev'], 0)
+        return (left * self.max_speed * self.wheel_gain[0] / 100.0,
+                right * self.max_speed * self.wheel_gain[1] / 100.0)
+
+    def advance(self, duration):
+        """Advances the simulation by duration seconds"""
+        self.advance_to(self.now + duration)
+
+    def advance_to(self, target):
+        """Advances the simulation up to time target. Edge callbacks are
+        fired from the calling thread"""
+        while True:
+            with self._lock:
+                if self.now >= target:
+                    return
+                end = min(self.now + self.step, target)
+                fired = self._run_pending(end)
+                self._integrate(end - self.now)
+                self.now = end
+                fired.extend(self._update_inputs())
+            for callback, pin in fired:
+                callback(pin)
+
+    def _integrate(self, dt):
+        v_left, v_right = self.wheel_speeds()
+        self._travel[0] += abs(v_left) * dt
+        self._travel[1] += abs(v_right) * dt
+        speed = (v_left + v_right) / 2.0
+        omega = (v_right - v_left) / self.robot_width
+        heading = self.heading + omega * dt / 2.0
+        self.x += speed * math.cos(heading) * dt
+        self.y += speed * math.sin(heading) * dt
+        self.heading = (self.heading + omega * dt) % (2 * math.pi)
+
+    def _run_pending(self, end):
+        #Pending events are level changes at exact times (sonar echo)
+        fired = []
+        while self._pending and self._pending[0][0] <= end:
+            when, pin, level = self._pending.pop(0)
+            if when > self.now:
+                self._integrate(when - self.now)
+                self.now = when
+            fired.extend(self._set_level(pin, level))
+        return fired
+
+    def _schedule(self, when, pin, level):
+        self._pending.append((when, pin, level))
+        self._pending.sort()
+        self._wakeup.set()
+        if self._clock is not None:
+            #Wake up the clock exactly at the time of the level change
+            self._clock.call_later(when - self.now, self.advance_to, when,
+                                   name='simulation')
+
+    def _encoder_level(self, wheel):
+        return int(self._travel[wheel] / self.step_dist) % 2
+
+    def _obstacle_level(self, side):
+        #IR sensors are active low
+        angle = 0.35 if side == 'left' else -0.35
+        dist = self.world.ray_distance(self.x, self.y, self.heading + angle,
+                                       self.obstacle_range)
+        return LOW if dist is not None else HIGH
+
+    def _input_level(self, pin):
+        pins = self.pins
+        if pin == pins['left_encoder']:
+            return self._encoder_level(0)
+        if pin == pins['right_encoder']:
+            return self._encoder_level(1)
+        if pin == pins['obstacle_left']:
+            return self._obstacle_level('left')
+        if pin == pins['obstacle_right']:
+            return self._obstacle_level('right')
+        if pin == pins['switch']:
+            return LOW if self.switch_pressed else HIGH
+        return self._levels.get(pin, LOW)
+
+    def _update_inputs(self):
+        fired = []
+        encoders = (self.pins['left_encoder'], self.pins['right_encoder'])
+        for pin in list(self._detects):
+            if pin != self.pins['sonar'] and self._modes.get(pin) == IN:
+                level = self._input_level(pin)
+                if not self.encoder_bounce or pin not in encoders:
+                    fired.extend(self._set_level(pin, level))
+                    continue
+                previous = self._true_levels.get(pin, self._levels.get(pin, LOW))
+                if level != previous:
+                    #Chatter of the slotted sensor right after the real edge
+                    self._true_levels[pin] = level
+                    fired.extend(self._set_level(pin, level))
+                    self._schedule(self.now + self.encoder_bounce, pin, previous)
+                    self._schedule(self.now + 2 * self.encoder_bounce, pin, level)
+        return fired
+
+    def _set_level(self, pin, level):
+        previous = self._levels.get(pin, LOW)
+        self._levels[pin] = level
+        if previous == level:
+            return []
+        detect = self._detects.get(pin)
+        if detect is None or self.now < self._armed.get(pin, 0.0):
+            return []
+        callback = detect_edge(detect, level, self.now)
+        if callback is None:
+            return []
+        return [(callback, pin)]
+
+    def _echo(self):
+        #Trigger finished - schedule echo pulse according to the world
+        dist = self.world.ray_distance(self.x, self.y,
+                                       self.heading + self.sonar_angle,
+                                       self.sonar_range)
+        if dist is None:
+            return
+        start = self.now + 0.0004
+        self._schedule(start, self.pins['sonar'], HIGH)
+        self._schedule(start + 2 * dist / SPEED_OF_SOUND, self.pins['sonar'], LOW)
+
+    def _set_duty(self, pin, duty):
+        with self._lock:
+            self._duty[pin] = duty
+
+    def _run_realtime(self):
+        origin = time.monotonic() - self.now
+        while True:
+            with self._lock:
+                wake = self.now + self.step
+                if self._pending:
+                    wake = min(wake, self._pending[0][0])
+            delay = wake + origin - time.monotonic()
+            if delay > 0:
+                #Woken up earlier when new pending event is scheduled
+                self._wakeup.wait(delay)
+                self._wakeup.clear()
+            self.advance_to(time.monotonic() - origin)
+
+    def _start_realtime(self):
+        if self.realtime and self._runner is None:
+            self._runner = threading.Thread(target=self._run_realtime)
+            self._runner.daemon = True
+            self._runner.start()
+
+    #RPi.GPIO interface
+    def setmode(self, mode):
+        pass
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, mode, pull_up_down=PUD_OFF, initial=None):
+        with self._lock:
+            self._modes[pin] = mode
+            if mode == OUT:
+                self._outputs[pin] = initial if initial is not None else LOW
+            elif pin != self.pins['sonar']:
+                self._levels[pin] = self._input_level(pin)
+        self._start_realtime()
+
+    def input(self, pin):
+        with self._lock:
+            if self._modes.get(pin) == OUT:
+                return self._outputs.get(pin, LOW)
+            if pin == self.pins['sonar'] or pin in self._detects:
+                return self._levels.get(pin, LOW)
+            return self._input_level(pin)
+
+    def output(self, pin, value):
+        with self._lock:
+            value = HIGH if value else LOW
+            previous = self._outputs.get(pin, LOW)
+            self._outputs[pin] = value
+            #Edge detection sees the output level too
+            fired = self._set_level(pin, value) if pin in self._detects else []
+            if pin == self.pins['sonar'] and previous == HIGH and value == LOW:
+                self._echo()
+        for callback, channel in fired:
+            callback(channel)
+
+    def cleanup(self, pin=None):
+        with self._lock:
+            pins = list(self._modes) if pin is None else [pin]
+            for channel in pins:
+                self._modes.pop(channel, None)
+                self._outputs.pop(channel, None)
+                self._detects.pop(channel, None)
+                self._duty.pop(channel, None)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self._lock:
+            if pin in self._detects:
+                raise RuntimeError('Conflicting edge detection already enabled '
+                                   'for this GPIO channel')
+            bounce = (bouncetime or 0) / 1000.0
+            if pin != self.pins['sonar']:
+                self._levels[pin] = self._input_level(pin)
+            self._detects[pin] = [edge, callback, bounce, None]
+            self._armed[pin] = self.now + self.detect_delay
+
+    def add_event_callback(self, pin, callback):
+        with self._lock:
+            if pin not in self._detects:
+                raise RuntimeError('Add event detection using add_event_detect first')
+            self._detects[pin][1] = callback
+
+    def remove_event_detect(self, pin):
+        with self._lock:
+            self._detects.pop(pin, None)
+
+    def PWM(self, pin, frequency):
+        return SimPWM(self, pin, frequency)
+
+
+class SimServoBlaster(object):
+    """
+    Replacement of pi2golite.components.ServoBlaster turning the sonar of
+    the simulation. Pass it as blaster to Servo (or ServosDriver servos)
+
+    :param  simulation: Simulation instance
+            pin: pin of the pan servo
+            min_steps, max_steps, max_angle: servo configuration - middle
+            of the range points forward and higher angles turn left
+    """
+    def __init__(self, simulation, pin=18, min_steps=50, max_steps=250, max_angle=180):
+        self._simulation = simulation
+        self._pin = pin
+        self._min_steps = min_steps
+        self._max_steps = max_steps
+        self._max_angle = max_angle
+        self._pending = {}
+        self._open = False
+        self.writes = 0
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def open(self):
+        self._open = True
+
+    def close(self):
+        self.flush()
+        self._open = False
+
+    def set_steps(self, pin, steps, flush=True):
+        self._pending[pin] = steps
+        if flush:
+            self.flush()
+
+    def flush(self):
+        steps = self._pending.pop(self._pin, None)
+        self._pending.clear()
+        if steps is None:
+            return
+        self.writes += 1
+        angle = (float(steps - self._min_steps) / (self._max_steps - self._min_steps)
+                 * self._max_angle)
+        self._simulation.sonar_angle = math.radians(angle - self._max_angle / 2.0)
+
+
+#Module level interface so that the module can replace RPi.GPIO directly
+simulation = Simulation()
+setmode = simulation.setmode
+setwarnings = simulation.setwarnings
+setup = simulation.setup
+input = simulation.input
+output = simulation.output
+cleanup = simulation.cleanup
+add_event_detect = simulation.add_event_detect
+add_event_callback = simulation.add_event_callback
+remove_event_detect = simulation.remove_event_detect
+PWM = simulation.PWM
@@ -0,0 +1,355 @@
+"""
+Parameter sweeps of Pi2Go Lite behaviours against the simulated backend.
+
+Every trial builds a Robot with the trial parameters on its own
+pi2golite.simGPIO.Simulation driven by a VirtualClock, runs a list of
+MotionQueue segments and scores the run by the error of the simulated
+poses at the ends of the segments (path error) and the simulated time the
+segments took (completion time). Trials run in a ProcessPoolExecutor so a
+sweep uses all cores - the GPIO backend is global so each process
+simulates one robot at a time.
+
+Results are streamed to a columnar store - a directory with one file of
+raw float64 values per column - a row as soon as a trial finishes. When
+the sweep is run again with the same trials the finished ones are skipped,
+so an interrupted sweep resumes where it stopped.
+
+    trials = grid(whl_diameter=[6.3, 6.5, 6.7], robot_width=[11, 12, 13])
+    sweep = ParameterSweep('sweep_results', trials)
+    sweep.run()
+    print(sweep.best(3))
+
+Author: Radek Pribyl
+"""
+import itertools
+import json
+import math
+import os
+import random
+from array import array
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pi2golite import Pi2GoLiteConfig, Robot
+from pi2golite.clock import VirtualClock
+from pi2golite.components import use_gpio
+from pi2golite.simGPIO import Simulation
+
+#Swept parameters and where they are in Pi2GoLiteConfig - section, sub
+#dictionary and key. Parameters of speed_control and speed_ramp enable them
+PARAMETERS = {
+    'whl_diameter': ('wheelsensors', 'measure_param', 'whl_diameter'),
+    'robot_width': ('wheelsensors', 'measure_param', 'robot_width'),
+    'numsteps': ('wheelsensors', 'measure_param', 'numsteps'),
+    'max_speed': ('wheelsensors', None, 'max_speed'),
+    'max_rate': ('wheelsensors', 'counter_param', 'max_rate'),
+    'left_fwdcorr': ('motor_left', None, 'fwdcorr'),
+    'left_revcorr': ('motor_left', None, 'revcorr'),
+    'right_fwdcorr': ('motor_right', None, 'fwdcorr'),
+    'right_revcorr': ('motor_right', None, 'revcorr'),
+    'kp': ('speed_control', 'param', 'kp'),
+    'ki': ('speed_control', 'param', 'ki'),
+    'kd': ('speed_control', 'param', 'kd'),
+    'control_rate': ('speed_control', 'param', 'rate'),
+    'acceleration': ('speed_ramp', 'param', 'acceleration'),
+    'jerk': ('speed_ramp', 'param', 'jerk'),
+}
+#Speed of Steering is set on the robot, not in the configuration
+SPEED = 'speed'
+
+#Columns of a trial score
+SCORE_COLUMNS = ('score', 'path_error', 'heading_error', 'completion_time', 'completed')
+
+DEFAULT_SEGMENTS = [('forward', 40), ('spin_left', 90)] * 4
+
+
+def grid(**values):
+    """List of trials with all combinations of the parameter values,
+    e.g. grid(whl_diameter=[6.3, 6.5], kp=[0.2, 0.5])"""
+    names = sorted(values)
+    return [dict(zip(names, combination))
+            for combination in itertools.product(*[values[name] for name in names])]
+
+
+def random_search(count, seed=None, **ranges):
+    """
+    List of count trials with random parameter values. A range is either
+    tuple (low, high) - integers if both are integers - or list of choices
+
+    :param  count: number of trials
+            seed: seed of the random generator so the trials can be repeated
+    """
+    generator = random.Random(seed)
+    names = sorted(ranges)
+    trials = []
+    for _ in range(count):
+        trial = {}
+        for name in names:
+            value = ranges[name]
+            if isinstance(value, list):
+                trial[name] = generator.choice(value)
+            elif isinstance(value[0], int) and isinstance(value[1], int):
+                trial[name] = generator.randint(value[0], value[1])
+            else:
+                trial[name] = generator.uniform(value[0], value[1])
+        trials.append(trial)
+    return trials
+
+
+def make_config(params):
+    """Pi2GoLiteConfig with wheel sensors and the trial parameters"""
+    cfg = Pi2GoLiteConfig()
+    cfg.wheelsensors = dict(cfg.wheelsensors, avail=True)
+    for name, value in params.items():
+        if name == SPEED:
+            continue
+        if name not in PARAMETERS:
+            raise AttributeError('unknown parameter %s' % name)
+        section, sub, key = PARAMETERS[name]
+        #Class level dictionaries are copied before they are changed
+        section_value = dict(getattr(cfg, section))
+        if section in ('speed_control', 'speed_ramp'):
+            section_value['avail'] = True
+        if sub is None:
+            section_value[key] = value
+        else:
+            section_value[sub] = dict(section_value[sub])
+            section_value[sub][key] = value
+        setattr(cfg, section, section_value)
+    return cfg
+
+
+def ideal_poses(segments, start=(0.0, 0.0, 0.0), robot_width=12):
+    """Poses (x, y, heading) at the end of each segment of a robot moving
+    exactly as commanded"""
+    x, y, heading = start
+    poses = []
+    for action, value in segments:
+        if action in ('forward', 'reverse'):
+            dist = value if action == 'forward' else -value
+            x += dist * math.cos(heading)
+            y += dist * math.sin(heading)
+        else:
+            angle = math.radians(value)
+            if action in ('spin_right', 'turn_right', 'turn_rev_left'):
+                angle = -angle
+            if not action.startswith('spin'):
+                #Turn pivots around the stopped wheel
+                side = 1 if action in ('turn_left', 'turn_rev_left') else -1
+                pivot_x = x - side * robot_width / 2.0 * math.sin(heading)
+                pivot_y = y + side * robot_width / 2.0 * math.cos(heading)
+                cos_a = math.cos(angle)
+                sin_a = math.sin(angle)
+                x, y = (pivot_x + (x - pivot_x) * cos_a - (y - pivot_y) * sin_a,
+                        pivot_y + (x - pivot_x) * sin_a + (y - pivot_y) * cos_a)
+            heading += angle
+        poses.append((x, y, heading))
+    return poses
+
+
+def run_trial(params, segments=None, sim_param=None, timeout=60, time_weight=0.1):
+    """
+    Runs segments on a simulated robot configured with params and returns
+    dictionary with SCORE_COLUMNS. path_error is RMS of the position error
+    at the ends of the segments, heading_error the final heading error in
+    radians and score is path_error + time_weight * completion_time
+    (inf when the segments did not finish within timeout seconds)
+
+    :param  params: dictionary of PARAMETERS (and speed) values
+            segments: MotionQueue segments, DEFAULT_SEGMENTS if None
+            sim_param: keyword arguments of Simulation - the true robot
+    """
+    segments = DEFAULT_SEGMENTS if segments is None else segments
+    sim_param = dict(sim_param or {})
+    clock = VirtualClock()
+    sim = Simulation(realtime=False, clock=clock, **sim_param)
+    use_gpio(sim)
+    robot = Robot(make_config(params), clock)
+    robot.init(parallel=False)
+    if SPEED in params:
+        robot.set_speed(params[SPEED])
+    ends = []
+    start = clock.time()
+    try:
+        run = robot.motion_queue.run(segments, lambda run: ends.append(sim.pose))
+        completed = run.wait(timeout)
+        duration = clock.time() - start
+    finally:
+        robot.motion_queue.cancel()
+        robot.cleanup()
+
+    expected = ideal_poses(segments, robot_width=sim.robot_width)
+    if not completed or len(ends) < len(expected):
+        return {'score': float('inf'), 'path_error': float('inf'),
+                'heading_error': float('inf'), 'completion_time': float('inf'),
+                'completed': 0.0}
+    squares = [(x - ideal[0]) ** 2 + (y - ideal[1]) ** 2
+               for (x, y, _), ideal in zip(ends, expected)]
+    path_error = math.sqrt(sum(squares) / len(squares))
+    turn = ends[-1][2] - expected[-1][2]
+    heading_error = abs((turn + math.pi) % (2 * math.pi) - math.pi)
+    return {'score': path_error + time_weight * duration, 'path_error': path_error,
+            'heading_error': heading_error, 'completion_time': duration,
+            'completed': 1.0}
+
+
+class ColumnStore(object):
+    """
+    Append only columnar table of floats. The store is a directory with
+    columns.json describing it and one file of raw float64 values per
+    column. Rows are appended to all column files - a row written only
+    partially (interrupted process) is dropped when the store is opened
+
+    :param  path: directory of the store
+            columns: names of the columns - needed when the store is created
+            meta: JSON serializable data stored with the columns
+    """
+    def __init__(self, path, columns=None, meta=None):
+        self.path = path
+        description = os.path.join(path, 'columns.json')
+        if os.path.exists(description):
+            with open(description) as desc_file:
+                stored = json.load(desc_file)
+            self.columns = stored['columns']
+            self.meta = stored.get('meta')
+            if columns is not None and list(columns) != self.columns:
+                raise AttributeError('store %s has different columns' % path)
+        else:
+            if columns is None:
+                raise AttributeError('columns needed to create store %s' % path)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+            self.columns = list(columns)
+            with open(description, 'w') as desc_file:
+                json.dump({'columns': self.columns, 'meta': meta}, desc_file)
+            #Same form as when the store is opened again
+            self.meta = json.loads(json.dumps(meta))
+        self._files = None
+        self._repair()
+
+    def _column_path(self, column):
+        return os.path.join(self.path, column + '.f8')
+
+    def _repair(self):
+        #Truncates columns to the number of complete rows
+        itemsize = array('d').itemsize
+        sizes = []
+        for column in self.columns:
+            column_path = self._column_path(column)
+            size = os.path.getsize(column_path) if os.path.exists(column_path) else 0
+            sizes.append(size // itemsize)
+        self._rows = min(sizes)
+        for column in self.columns:
+            with open(self._column_path(column), 'ab') as column_file:
+                column_file.truncate(self._rows * itemsize)
+
+    def __len__(self):
+        return self._rows
+
+    def append(self, row):
+        """Appends row given as dictionary - missing columns are NaN"""
+        if self._files is None:
+            self._files = [open(self._column_path(column), 'ab') for column in self.columns]
+        nan = float('nan')
+        for column, column_file in zip(self.columns, self._files):
+            array('d', [row.get(column, nan)]).tofile(column_file)
+        for column_file in self._files:
+            column_file.flush()
+        self._rows += 1
+
+    def read(self, column):
+        """Values of column as array('d')"""
+        values = array('d')
+        with open(self._column_path(column), 'rb') as column_file:
+            values.fromfile(column_file, self._rows)
+        return values
+
+    def read_all(self):
+        """Dictionary of all columns"""
+        return dict((column, self.read(column)) for column in self.columns)
+
+    def close(self):
+        if self._files is not None:
+            for column_file in self._files:
+                column_file.close()
+            self._files = None
+
+
+class ParameterSweep(object):
+    """
+    Runs trials (see grid and random_search) in a process pool and streams
+    their scores to ColumnStore at path. Trials already in the store are
+    skipped, so run can be repeated after an interruption. The store
+    remembers the trials and refuses to resume a different sweep
+
+    :param  path: directory of the results
+            trials: list of dictionaries of parameter values
+            segments: MotionQueue segments of every trial, DEFAULT_SEGMENTS if None
+            sim_param: keyword arguments of Simulation - the true robot
+            workers: number of processes, number of CPUs if None
+            timeout: simulated seconds after which a trial is failed
+            time_weight: weight of completion time in the score
+    """
+    def __init__(self, path, trials, segments=None, sim_param=None, workers=None,
+                 timeout=60, time_weight=0.1):
+        self.trials = [dict(trial) for trial in trials]
+        self.segments = [tuple(segment) for segment in
+                         (DEFAULT_SEGMENTS if segments is None else segments)]
+        self.sim_param = dict(sim_param or {})
+        self.workers = workers
+        self.timeout = timeout
+        self.time_weight = time_weight
+        self.parameters = sorted(set(itertools.chain(*self.trials)))
+        columns = ['trial'] + self.parameters + list(SCORE_COLUMNS)
+        meta = {'trials': self.trials, 'segments': self.segments,
+                'sim_param': self.sim_param, 'time_weight': time_weight}
+        self.store = ColumnStore(path, columns, meta)
+        if json.loads(json.dumps(meta)) != self.store.meta:
+            raise AttributeError('results in %s belong to another sweep' % path)
+
+    @property
+    def finished(self):
+        """Indices of the trials in the store"""
+        return set(int(index) for index in self.store.read('trial'))
+
+    def run(self, callback=None):
+        """
+        Runs the trials which are not in the store yet and returns the
+        results (see results). Optional callback(index, params, scores) is
+        called for every finished trial
+        """
+        finished = self.finished
+        pending = [index for index in range(len(self.trials)) if index not in finished]
+        if not pending:
+            return self.results()
+        executor = ProcessPoolExecutor(max_workers=self.workers)
+        try:
+            futures = dict((executor.submit(run_trial, self.trials[index], self.segments,
+                                            self.sim_param, self.timeout,
+                                            self.time_weight), index)
+                           for index in pending)
+            for future in as_completed(futures):
+                index = futures[future]
+                try:
+                    scores = future.result()
+                except Exception as exc:
+                    print('Trial %d %s failed: %s' % (index, self.trials[index], exc))
+                    scores = dict((column, float('inf')) for column in SCORE_COLUMNS)
+                    scores['completed'] = 0.0
+                row = dict(self.trials[index], trial=index, **scores)
+                self.store.append(row)
+                if callback is not None:
+                    callback(index, self.trials[index], scores)
+        finally:
+            #Interrupted sweep leaves the running trials, resume reruns them
+            executor.shutdown(wait=True, cancel_futures=True)
+            self.store.close()
+        return self.results()
+
+    def results(self):
+        """Dictionary of result columns as array('d') in order of completion"""
+        return self.store.read_all()
+
+    def best(self, count=1):
+        """count trials with the lowest score as list of (score, params)"""
+        results = self.results()
+        ranked = sorted(zip(results['score'], results['trial']))[:count]
+        return [(score, self.trials[int(index)]) for score, index in ranked]
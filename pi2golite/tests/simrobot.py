@@ -0,0 +1,32 @@
+"""
+Helpers of the tests running the pi2golite stack against the simulated
+GPIO backend driven by a VirtualClock
+
+Author: Radek Pribyl
+"""
+from pi2golite import Pi2GoLiteConfig, Robot, VirtualClock, use_gpio
+from pi2golite.simGPIO import Simulation
+
+
+def wheel_config(**sections):
+    """Pi2GoLiteConfig with wheel sensors. Keyword arguments enable the
+    optional sections (e.g. speed_control=True) or replace their parameters
+    (e.g. speed_control={'kp': 0.3})"""
+    cfg = Pi2GoLiteConfig()
+    cfg.wheelsensors = dict(cfg.wheelsensors, avail=True)
+    for name, value in sections.items():
+        section = dict(getattr(cfg, name), avail=bool(value))
+        if isinstance(value, dict):
+            section['param'] = dict(section['param'], **value)
+        setattr(cfg, name, section)
+    return cfg
+
+
+def sim_robot(cfg=None, **sim_param):
+    """Initiated Robot on a new Simulation. Returns (robot, sim, clock)"""
+    clock = VirtualClock()
+    sim = Simulation(realtime=False, clock=clock, **sim_param)
+    use_gpio(sim)
+    robot = Robot(cfg if cfg is not None else wheel_config(), clock)
+    robot.init(parallel=False)
+    return robot, sim, clock
@@ -0,0 +1,91 @@
+import asyncio
+import unittest
+from pi2golite.aio import AsyncRobot
+from pi2golite.simGPIO import World
+from tests.simrobot import sim_robot
+
+
+def run(clock, coroutine):
+    """Runs coroutine while a task advances the virtual clock"""
+    async def _drive():
+        while True:
+            clock.advance(0.001)
+            await asyncio.sleep(0)
+
+    async def _main():
+        driver = asyncio.ensure_future(_drive())
+        try:
+            return await asyncio.wait_for(coroutine, 10)
+        finally:
+            driver.cancel()
+    return asyncio.run(_main())
+
+
+class AsyncRobotTest(unittest.TestCase):
+    def setUp(self):
+        self.robot, self.sim, self.clock = sim_robot(world=World.box(200, 200))
+        self.addCleanup(self.robot.cleanup)
+        self.sim.set_pose(100, 100)
+        self.clock.advance(0.01)
+        self.arobot = AsyncRobot(self.robot)
+
+    def test_move_completes(self):
+        self.robot.set_speed(50)
+        self.assertTrue(run(self.clock, self.arobot.meas_forward(20)))
+        self.assertAlmostEqual(self.sim.wheel_travel[0], 20, delta=2)
+        self.assertEqual(self.sim.wheel_speeds(), (0, 0))
+
+    def test_cancelled_task_cancels_move(self):
+        self.robot.set_speed(50)
+
+        async def _cancel():
+            task = asyncio.ensure_future(self.arobot.meas_forward(100))
+            await self.arobot.sleep(0.5)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        run(self.clock, _cancel())
+        self.assertEqual(self.sim.wheel_speeds(), (0, 0))
+        self.assertLess(self.sim.wheel_travel[0], 20)
+        self.assertIsNone(self.robot.step_steering.current_move)
+
+    def test_sleep_uses_robot_clock(self):
+        start = self.clock.time()
+        run(self.clock, self.arobot.sleep(0.5))
+        self.assertAlmostEqual(self.clock.time() - start, 0.5, delta=0.01)
+
+    def test_distances(self):
+        async def _distances():
+            distances = []
+            async for distance in self.arobot.distances(0.1):
+                distances.append(distance)
+                if len(distances) == 3:
+                    return distances
+        distances = run(self.clock, _distances())
+        for distance in distances:
+            self.assertAlmostEqual(distance, 100, delta=1)
+
+    def test_obstacle_events(self):
+        async def _obstacles():
+            events = []
+            async for event in self.arobot.obstacles():
+                events.append(event)
+                if len(events) == 2:
+                    #Drive to the wall
+                    self.sim.set_pose(190, 100)
+                if len(events) == 4:
+                    return events
+        events = run(self.clock, _obstacles())
+        self.assertEqual([(event.side, event.activated) for event in events[:2]],
+                         [('left', False), ('right', False)])
+        self.assertEqual(sorted((event.side, event.activated) for event in events[2:]),
+                         [('left', True), ('right', True)])
+
+    def test_other_methods_pass_through(self):
+        speed = run(self.clock, self.arobot.increase_speed())
+        self.assertEqual(speed, self.robot.steering.current_speed)
+        self.assertIs(self.arobot.components, self.robot.components)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import math
+import threading
+import unittest
+from tests.simrobot import sim_robot, wheel_config
+
+
+def heading_error(sim):
+    return abs(math.atan2(math.sin(sim.heading), math.cos(sim.heading)))
+
+
+class SpeedControlTest(unittest.TestCase):
+    def drive_straight(self, cfg, duration=5.0):
+        #Right motor is 20 % weaker than the left one
+        robot, sim, clock = sim_robot(cfg, wheel_gain=(1.0, 0.8))
+        self.addCleanup(robot.cleanup)
+        robot.set_speed(50)
+        robot.forward()
+        clock.advance(duration)
+        robot.stop()
+        return robot, sim
+
+    def test_open_loop_drifts(self):
+        _, sim = self.drive_straight(wheel_config())
+        self.assertGreater(heading_error(sim), 1.0)
+
+    def test_holds_heading_with_unbalanced_motor(self):
+        robot, sim = self.drive_straight(wheel_config(speed_control=True))
+        self.assertLess(heading_error(sim), 0.15)
+        left, right = sim.wheel_travel
+        self.assertAlmostEqual(right / left, 1.0, delta=0.03)
+        #Speed 50 is half of the wheel speed at speed 100 (40 cm/s)
+        self.assertAlmostEqual(left, 100, delta=5)
+        stats = robot.steering.speed_control.stats
+        self.assertLess(stats['left_error']['mean'], 5)
+        self.assertLess(stats['right_error']['mean'], 5)
+
+    def test_holds_heading_while_ramping(self):
+        _, sim = self.drive_straight(wheel_config(speed_control=True, speed_ramp=True))
+        self.assertLess(heading_error(sim), 0.15)
+
+    def test_ramp_keeps_loop_output(self):
+        robot, _, clock = sim_robot(wheel_config(speed_control=True),
+                                    wheel_gain=(1.0, 0.8))
+        self.addCleanup(robot.cleanup)
+        robot.set_speed(50)
+        robot.forward()
+        clock.advance(2)
+        speed_control = robot.steering.speed_control
+        outputs = list(speed_control.outputs)
+        #Weak right wheel needs more than the feed forward
+        self.assertGreater(outputs[1], 55)
+        speed_control.set_setpoints(51, 51)
+        self.assertEqual(speed_control.outputs, outputs)
+        speed_control.set_setpoints(0, 0)
+        self.assertEqual(speed_control.outputs, [0, 0])
+        speed_control.set_setpoints(-50, -50)
+        self.assertEqual(speed_control.outputs, [50, 50])
+
+
+class MotionQueueTest(unittest.TestCase):
+    segments = [('forward', 30), ('spin_left', 90), ('forward', 20)]
+
+    def setUp(self):
+        self.robot, self.sim, self.clock = sim_robot()
+        self.addCleanup(self.robot.cleanup)
+        self.sim.set_pose(100, 100)
+        self.robot.set_speed(50)
+
+    def test_runs_segments_back_to_back(self):
+        poses = []
+        run = self.robot.motion_queue.run(self.segments,
+                                          lambda run: poses.append(self.sim.pose))
+        self.assertTrue(run.wait(30))
+        self.assertFalse(run.cancelled)
+        self.assertEqual(run.segment, 3)
+        self.assertEqual(run.progress, 1.0)
+        self.assertEqual(len(poses), 3)
+        x, y, heading = self.sim.pose
+        self.assertAlmostEqual(x, 130, delta=3)
+        self.assertAlmostEqual(y, 120, delta=3)
+        self.assertAlmostEqual(heading, math.pi / 2, delta=0.15)
+        self.assertEqual(self.sim.wheel_speeds(), (0, 0))
+
+    def test_cancel_stops_motors(self):
+        run = self.robot.motion_queue.run(self.segments)
+        self.clock.advance(1)
+        self.assertFalse(run.done)
+        progress = run.progress
+        self.assertTrue(0 < progress < 1)
+        run.cancel()
+        self.assertTrue(run.done)
+        self.assertTrue(run.cancelled)
+        self.assertIsNone(self.robot.motion_queue.current_run)
+        self.assertEqual(self.sim.wheel_speeds(), (0, 0))
+        self.clock.advance(1)
+        self.assertEqual(run.progress, progress)
+
+    def test_step_move_replaces_run(self):
+        run = self.robot.motion_queue.run(self.segments)
+        self.clock.advance(1)
+        move = self.robot.meas_forward(10)
+        self.assertTrue(run.done)
+        self.assertTrue(run.cancelled)
+        self.assertTrue(move.wait(10))
+        self.assertFalse(move.cancelled)
+
+    def test_move_callbacks_run_without_steering_lock(self):
+        step_steering = self.robot.step_steering
+        acquired = []
+
+        def try_lock():
+            #Other thread can take the lock only if the finishing one released it
+            if step_steering._lock.acquire(False):
+                step_steering._lock.release()
+                acquired.append(True)
+
+        def done(move):
+            thread = threading.Thread(target=try_lock)
+            thread.start()
+            thread.join()
+
+        move = step_steering.run_segment('spin_right', 5, 5)
+        move.add_done_callback(done)
+        self.assertTrue(move.wait(10))
+        self.assertEqual(acquired, [True])
+
+    def test_ramped_square_keeps_pose(self):
+        square = [('forward', 30), ('turn_left', 90)] * 4
+
+        def drive(queued):
+            robot, sim, clock = sim_robot(wheel_config(speed_ramp=True))
+            self.addCleanup(robot.cleanup)
+            sim.set_pose(100, 100)
+            robot.set_speed(50)
+            start = clock.time()
+            if queued:
+                self.assertTrue(robot.motion_queue.run(square).wait(60))
+            else:
+                for action, value in square:
+                    self.assertTrue(getattr(robot, 'meas_' + action)(value).wait(30))
+            return clock.time() - start, sim
+
+        queued_time, sim = drive(True)
+        blocking_time, _ = drive(False)
+        self.assertLess(queued_time, blocking_time - 0.5)
+        x, y, _ = sim.pose
+        self.assertAlmostEqual(x, 100, delta=3)
+        self.assertAlmostEqual(y, 100, delta=3)
+        self.assertLess(heading_error(sim), 0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,230 @@
+import os
+import shutil
+import tempfile
+import unittest
+from pi2golite import Robot, VirtualClock, use_gpio
+from pi2golite.components import ServoBlaster
+from pi2golite.simGPIO import Simulation, World
+from tests.simrobot import sim_robot, wheel_config
+
+
+class DeferredDispatcher(object):
+    """Dispatcher which keeps the callbacks until run is called"""
+    def __init__(self):
+        self.calls = []
+
+    def dispatch(self, priority, callback, *args):
+        self.calls.append((callback, args))
+
+    def run(self):
+        calls, self.calls = self.calls, []
+        for callback, args in calls:
+            callback(*args)
+
+
+class MotorTest(unittest.TestCase):
+    def test_repeated_command_is_not_written(self):
+        robot, sim, clock = sim_robot()
+        self.addCleanup(robot.cleanup)
+        motor = robot.components['left_motor']
+        robot.set_speed(50)
+        robot.forward()
+        writes = motor.writes
+        saved = motor.saved_writes
+        for _ in range(10):
+            robot.forward()
+        #Frequency and duty of the forward channel and duty of the reverse one
+        self.assertEqual(motor.writes, writes)
+        self.assertEqual(motor.saved_writes, saved + 10 * 3)
+        self.assertAlmostEqual(sim.wheel_speeds()[0], sim.max_speed / 2, delta=1)
+        robot.set_speed(60)
+        robot.forward()
+        self.assertGreater(motor.writes, writes)
+        self.assertAlmostEqual(sim.wheel_speeds()[0], sim.max_speed * 0.6, delta=1)
+
+
+class DistanceSensorTest(unittest.TestCase):
+    def _sensor(self, world, **sim_param):
+        robot, sim, clock = sim_robot(world=world, **sim_param)
+        self.addCleanup(robot.cleanup)
+        sim.set_pose(100, 100)
+        return robot.components['distance_sensor'], clock
+
+    def test_future_resolves_with_distance(self):
+        #Edge detection sees also the trigger pulse which has to be ignored
+        sensor, clock = self._sensor(World.box(200, 200))
+        distances = []
+        future = sensor.measure_distance(distances.append)
+        self.assertFalse(future.done())
+        clock.advance(0.05)
+        self.assertAlmostEqual(future.result(), 100, delta=1)
+        self.assertEqual(distances, [future.result()])
+
+    def test_delayed_arming(self):
+        #Edge detection takes longer to arm than the echo needs to start
+        sensor, clock = self._sensor(World.box(200, 200), detect_delay=0.005)
+        clock.advance(0.01)
+        for _ in range(3):
+            future = sensor.measure_distance()
+            clock.advance(0.05)
+            self.assertAlmostEqual(future.result(), 100, delta=1)
+
+    def test_measurement_in_flight_is_shared(self):
+        sensor, clock = self._sensor(World.box(200, 200))
+        first = sensor.measure_distance()
+        second = sensor.measure_distance()
+        clock.advance(0.05)
+        self.assertEqual(second.result(), first.result())
+
+    def test_no_echo_times_out(self):
+        sensor, clock = self._sensor(World())
+        future = sensor.measure_distance()
+        clock.advance(0.19)
+        self.assertFalse(future.done())
+        clock.advance(0.02)
+        self.assertEqual(future.result(), 0)
+
+    def test_timeout_of_measurement(self):
+        sensor, clock = self._sensor(World())
+        future = sensor.measure_distance(timeout=0.03)
+        clock.advance(0.031)
+        self.assertEqual(future.result(), 0)
+
+
+class WheelCounterTest(unittest.TestCase):
+    def test_bounce_is_rejected(self):
+        #Every encoder edge chatters twice 0.5 ms after the real one
+        robot, sim, clock = sim_robot(encoder_bounce=0.0005)
+        self.addCleanup(robot.cleanup)
+        robot.set_speed(50)
+        move = robot.meas_forward(30)
+        self.assertTrue(move.wait(10))
+        counter = robot.components['wheelcounter_left']
+        self.assertEqual(counter.accepted_edges, 24)
+        #Bounce of the last edge may come after the move finished
+        self.assertGreaterEqual(counter.rejected_edges, 2 * 23)
+        self.assertAlmostEqual(sim.wheel_travel[0], 30, delta=2)
+
+    def test_cleanup_keeps_other_subscribers(self):
+        robot, sim, clock = sim_robot()
+        self.addCleanup(robot.cleanup)
+        sensor = robot.components['wheelsensor_left']
+        edges = []
+        sensor.register_both_callbacks(lambda pin, state: edges.append(state), None)
+        robot.components['wheelcounter_left'].cleanup()
+        robot.set_speed(50)
+        robot.forward()
+        clock.advance(1)
+        robot.stop()
+        self.assertGreater(len(edges), 10)
+
+    def test_velocity_from_edge_ring(self):
+        robot, sim, clock = sim_robot()
+        self.addCleanup(robot.cleanup)
+        counter = robot.components['wheelcounter_left']
+        edges = []
+        counter.add_edge_listener(edges.append)
+        robot.set_speed(50)
+        robot.forward()
+        clock.advance(5)
+        #Ring keeps the newest 64 edges
+        self.assertGreater(len(edges), 64)
+        self.assertEqual(counter.edge_times(), edges[-64:])
+        self.assertEqual(counter.edge_times(0.5), [t for t in edges
+                                                   if t >= clock.monotonic_ns() - 5e8])
+        interval = (edges[-1] - edges[-2]) / 1e9
+        self.assertAlmostEqual(counter.velocity(), 1 / interval, delta=1)
+        self.assertAlmostEqual(counter.velocity(1.0), 1 / interval, delta=2)
+        robot.stop()
+        clock.advance(1)
+        self.assertEqual(counter.velocity(), 0)
+        self.assertEqual(counter.velocity(0.5), 0)
+
+    def test_deferred_callback_keeps_edge_time(self):
+        clock = VirtualClock()
+        sim = Simulation(realtime=False, clock=clock)
+        use_gpio(sim)
+        dispatcher = DeferredDispatcher()
+        robot = Robot(wheel_config(), clock, dispatcher=dispatcher)
+        robot.init(parallel=False)
+        self.addCleanup(robot.cleanup)
+        edges = []
+        robot.components['wheelsensor_left'].register_both_callbacks(
+            lambda pin, state, timestamp: edges.append(timestamp), None, timestamp=True)
+        robot.set_speed(50)
+        robot.forward()
+        clock.advance(1)
+        robot.stop()
+        #Callbacks run long after the edges
+        dispatcher.run()
+        counter = robot.components['wheelcounter_left']
+        self.assertGreater(len(edges), 10)
+        self.assertEqual(counter.edge_times(), edges)
+        self.assertAlmostEqual(counter.velocity(0.5), len(edges) / 1.0, delta=2)
+
+
+class ServoBlasterTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_missing_device_is_not_created(self):
+        path = os.path.join(self.directory, 'servoblaster')
+        blaster = ServoBlaster(path)
+        blaster.open()
+        blaster.set_steps(18, 150)
+        self.assertFalse(blaster.is_open)
+        self.assertFalse(os.path.exists(path))
+
+    def test_existing_file_receives_commands(self):
+        path = os.path.join(self.directory, 'servoblaster')
+        open(path, 'w').close()
+        blaster = ServoBlaster(path)
+        blaster.open()
+        self.addCleanup(blaster.close)
+        blaster.set_steps(18, 150)
+        self.assertTrue(blaster.is_open)
+        with open(path) as commands:
+            self.assertEqual(commands.read(), 'P1-18=150\n')
+
+    def test_fifo_receives_commands(self):
+        path = os.path.join(self.directory, 'servoblaster')
+        os.mkfifo(path)
+        blaster = ServoBlaster(path)
+        #No reader yet - the commands are dropped
+        blaster.set_steps(18, 100)
+        self.assertFalse(blaster.is_open)
+        reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.addCleanup(os.close, reader)
+        blaster.set_steps(18, 150, flush=False)
+        blaster.set_steps(22, 120)
+        self.addCleanup(blaster.close)
+        self.assertTrue(blaster.is_open)
+        self.assertEqual(sorted(os.read(reader, 100).decode('ascii').split()),
+                         ['P1-18=150', 'P1-22=120'])
+
+    def test_fifo_reader_goes_away(self):
+        path = os.path.join(self.directory, 'servoblaster')
+        os.mkfifo(path)
+        reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        blaster = ServoBlaster(path)
+        blaster.open()
+        blaster.set_steps(18, 100)
+        os.close(reader)
+        #Broken pipe drops the command and closes the device
+        blaster.set_steps(18, 150)
+        self.assertFalse(blaster.is_open)
+        blaster.set_steps(18, 160)
+        self.assertFalse(blaster.is_open)
+        #Reopened once there is a reader again
+        reader = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+        self.addCleanup(os.close, reader)
+        blaster.set_steps(18, 170)
+        self.assertTrue(blaster.is_open)
+        self.assertEqual(os.read(reader, 100), b'P1-18=170\n')
+        blaster.close()
+        self.assertFalse(blaster.is_open)
+
+
+if __name__ == '__main__':
+    unittest.main()
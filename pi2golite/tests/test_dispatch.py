@@ -0,0 +1,78 @@
+import threading
+import unittest
+from pi2golite.dispatch import Dispatcher, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+
+
+class DispatcherTest(unittest.TestCase):
+    def test_high_priority_runs_inline(self):
+        dispatcher = Dispatcher()
+        threads = []
+        dispatcher.dispatch(PRIORITY_HIGH, lambda: threads.append(threading.current_thread()))
+        self.assertEqual(threads, [threading.current_thread()])
+
+    def test_lanes_run_off_the_calling_thread(self):
+        dispatcher = Dispatcher()
+        names = {}
+        done = threading.Event()
+
+        def _record(priority):
+            names[priority] = threading.current_thread().name
+            if len(names) == 2:
+                done.set()
+
+        dispatcher.dispatch(PRIORITY_NORMAL, _record, PRIORITY_NORMAL)
+        dispatcher.dispatch(PRIORITY_LOW, _record, PRIORITY_LOW)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(names, {PRIORITY_NORMAL: 'dispatch-normal',
+                                 PRIORITY_LOW: 'dispatch-low'})
+
+    def test_blocked_low_lane_does_not_delay_normal(self):
+        dispatcher = Dispatcher()
+        release = threading.Event()
+        normal = threading.Event()
+        self.addCleanup(release.set)
+        dispatcher.dispatch(PRIORITY_LOW, release.wait)
+        dispatcher.dispatch(PRIORITY_NORMAL, normal.set)
+        self.assertTrue(normal.wait(2))
+        self.assertFalse(release.is_set())
+
+    def test_lane_keeps_order_and_drops_oldest_when_full(self):
+        dispatcher = Dispatcher(maxsize=4)
+        release = threading.Event()
+        started = threading.Event()
+        calls = []
+        done = threading.Event()
+
+        def _block():
+            started.set()
+            release.wait()
+
+        dispatcher.dispatch(PRIORITY_NORMAL, _block)
+        self.assertTrue(started.wait(2))
+        for index in range(6):
+            dispatcher.dispatch(PRIORITY_NORMAL, calls.append, index)
+        dispatcher.dispatch(PRIORITY_NORMAL, done.set)
+        release.set()
+        self.assertTrue(done.wait(2))
+        self.assertEqual(calls, [3, 4, 5])
+        stats = dispatcher.stats()['normal']
+        self.assertEqual(stats['dropped'], 3)
+        self.assertEqual(stats['max_depth'], 4)
+
+    def test_failing_callback_does_not_stop_lane(self):
+        dispatcher = Dispatcher()
+        done = threading.Event()
+        dispatcher.dispatch(PRIORITY_NORMAL, lambda: 1 / 0)
+        dispatcher.dispatch(PRIORITY_NORMAL, done.set)
+        self.assertTrue(done.wait(2))
+
+    def test_synchronous_runs_every_priority_inline(self):
+        dispatcher = Dispatcher(synchronous=True)
+        calls = []
+        for priority in (PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH):
+            dispatcher.dispatch(priority, calls.append, priority)
+        self.assertEqual(calls, [PRIORITY_LOW, PRIORITY_NORMAL, PRIORITY_HIGH])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import unittest
+from pi2golite import components, use_gpio
+from pi2golite.fleet import FleetSimulation
+from pi2golite.simGPIO import World
+from tests.simrobot import sim_robot
+
+
+class FleetSimulationTest(unittest.TestCase):
+    def test_robots_follow_single_simulation(self):
+        robot, sim, clock = sim_robot(world=World.box(200, 200))
+        sim.set_pose(100, 100)
+        robot.meas_forward(30)
+        clock.advance(3)
+        robot.meas_spin_left(90)
+        clock.advance(3)
+        robot.cleanup()
+
+        fleet = FleetSimulation(3, World.box(200, 200))
+        fleet.set_pose(slice(None), 100, 100, 0)
+        robots = fleet.robots()
+        self.addCleanup(use_gpio, fleet.previous_gpio)
+        for fleet_robot in robots:
+            fleet_robot.meas_forward(30)
+        fleet.advance(3)
+        for fleet_robot in robots:
+            fleet_robot.meas_spin_left(90)
+        fleet.advance(3)
+        for pose in fleet.poses:
+            for value, expected in zip(pose, sim.pose):
+                self.assertAlmostEqual(value, expected, places=6)
+        for fleet_robot in robots:
+            fleet_robot.cleanup()
+
+    def test_robots_replace_global_backend(self):
+        previous = components.GPIO
+        fleet = FleetSimulation(1)
+        fleet.robots(init=False)
+        self.addCleanup(use_gpio, previous)
+        self.assertIs(components.GPIO, fleet)
+        self.assertIs(fleet.previous_gpio, previous)
+
+    def test_rays_match_single_ray_cast(self):
+        world = World.box(200, 100)
+        fleet = FleetSimulation(2, world)
+        fleet.set_pose(0, 50, 50, 0.3)
+        fleet.set_pose(1, 150, 20, 2.0)
+        for index, (x, y, heading) in enumerate(fleet.poses):
+            expected = world.ray_distance(x, y, heading, 400)
+            self.assertAlmostEqual(fleet.sonar_ranges[index], expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
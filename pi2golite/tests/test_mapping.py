@@ -0,0 +1,64 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from pi2golite.mapping import OccupancyGrid
+
+
+class OccupancyGridTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def _grid(self):
+        grid = OccupancyGrid(tile_size=16)
+        angles = np.radians(np.arange(-90, 91, 15))
+        grid.update((0.0, 0.0, 0.0), angles, np.full(len(angles), 60.0))
+        return grid
+
+    def test_save_onto_loaded_file(self):
+        path = os.path.join(self.directory, 'map.npy')
+        grid = self._grid()
+        expected, origin = grid.to_array()
+        grid.save(path)
+        loaded = OccupancyGrid.load(path)
+        loaded.save(path)
+        self.assertEqual(sorted(os.listdir(self.directory)), ['map.npy', 'map.npy.meta.npz'])
+        saved, saved_origin = OccupancyGrid.load(path).to_array()
+        np.testing.assert_array_equal(saved, expected)
+        self.assertEqual(saved_origin, origin)
+
+    def test_updates_after_save_go_to_saved_file(self):
+        path = os.path.join(self.directory, 'map.npy')
+        self._grid().save(path)
+        loaded = OccupancyGrid.load(path)
+        loaded.save(path)
+        loaded.update((0.0, 0.0, 0.0), [0.0], [30.0])
+        loaded.flush()
+        expected, _ = loaded.to_array()
+        saved, _ = OccupancyGrid.load(path, mode='r').to_array()
+        np.testing.assert_array_equal(saved, expected)
+
+
+    def test_saved_tiles_are_mapped_from_file(self):
+        path = os.path.join(self.directory, 'map.npy')
+        grid = self._grid()
+        grid.save(path)
+        for key in grid.tiles:
+            self.assertIsInstance(grid._tiles[key], np.memmap)
+        grid.update((0.0, 0.0, 0.0), [0.0], [30.0])
+        grid.flush()
+        expected, _ = grid.to_array()
+        saved, _ = OccupancyGrid.load(path, mode='r').to_array()
+        np.testing.assert_array_equal(saved, expected)
+
+    def test_empty_update(self):
+        grid = self._grid()
+        version = grid.version
+        grid.update((0.0, 0.0, 0.0), [], [])
+        self.assertEqual(grid.version, version)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,94 @@
+import math
+import unittest
+import numpy as np
+from pi2golite.mapping import OccupancyGrid
+from pi2golite.planner import PathPlanner
+from tests.simrobot import sim_robot
+
+
+def free_grid():
+    """Grid with free space of radius 150 around 0, 0"""
+    grid = OccupancyGrid(beam_rays=1)
+    angles = np.radians(np.arange(0, 360, 1))
+    grid.update((0.0, 0.0, 0.0), angles, np.zeros(len(angles)))
+    return grid
+
+
+def add_wall(grid, x, y_from, y_to):
+    #Readings from 10 cm in front of the wall hit it perpendicularly
+    for y in np.arange(y_from, y_to + grid.resolution, grid.resolution / 2):
+        grid.update((x - 10.0, y, 0.0), [0.0, 0.0], [10.0, 10.0])
+
+
+def drive(start, segments):
+    """Pose reached by running MeasureSteering segments from start"""
+    x, y, heading = start
+    for action, value in segments:
+        if action == 'forward':
+            x += value * math.cos(heading)
+            y += value * math.sin(heading)
+        else:
+            angle = math.radians(value)
+            heading += angle if action == 'spin_left' else -angle
+    return x, y, heading
+
+
+class PathPlannerTest(unittest.TestCase):
+    def setUp(self):
+        self.grid = free_grid()
+        add_wall(self.grid, 30, -40, 40)
+        self.planner = PathPlanner(self.grid, step_distance=1.28, robot_width=12.0)
+
+    def test_path_keeps_clear_of_the_wall(self):
+        waypoints = self.planner.plan((0, 0, 0.0), (60, 0))
+        self.assertEqual(waypoints[0], (0, 0))
+        self.assertEqual(waypoints[-1], (60, 0))
+        self.assertGreater(len(waypoints), 2)
+        cost, distance, origin = self.planner.cost_grid()
+        for (x0, y0), (x1, y1) in zip(waypoints, waypoints[1:]):
+            for fraction in np.linspace(0, 1, 50):
+                point = (x0 + (x1 - x0) * fraction, y0 + (y1 - y0) * fraction)
+                row, column = self.planner._to_cell(point, origin)
+                self.assertTrue(np.isfinite(cost[row, column]), point)
+
+    def test_no_path(self):
+        #Goal inside the wall and outside of the map
+        self.assertIsNone(self.planner.plan((0, 0), (31, 0)))
+        self.assertIsNone(self.planner.plan((0, 0), (500, 0)))
+        self.assertIsNone(self.planner.plan_moves((0, 0, 0.0), (31, 0)))
+
+    def test_cost_grid_cached_until_map_changes(self):
+        cost = self.planner.cost_grid()[0]
+        self.assertIs(self.planner.cost_grid()[0], cost)
+        add_wall(self.grid, -30, -40, 40)
+        changed, _, origin = self.planner.cost_grid()
+        self.assertIsNot(changed, cost)
+        self.assertFalse(np.isfinite(changed[self.planner._to_cell((-31, 0), origin)]))
+
+    def test_moves_are_whole_steps_reaching_goal(self):
+        start = (0.0, 0.0, 0.3)
+        segments = self.planner.plan_moves(start, (60, 0))
+        step = self.planner.step_distance
+        spin_step = math.degrees(2.0 * step / self.planner.robot_width)
+        for action, value in segments:
+            self.assertIn(action, ('forward', 'spin_left', 'spin_right'))
+            unit = step if action == 'forward' else spin_step
+            self.assertAlmostEqual(value / unit, round(value / unit), places=6)
+        x, y, _ = drive(start, segments)
+        self.assertLess(math.hypot(x - 60, y), step)
+
+    def test_moves_run_on_robot(self):
+        robot, sim, clock = sim_robot()
+        self.addCleanup(robot.cleanup)
+        sim.set_pose(100, 100)
+        robot.set_speed(50)
+        planner = PathPlanner(free_grid(), measure_steering=robot.measure_steering)
+        segments = planner.plan_moves((0.0, 0.0, 0.0), (40, 30))
+        self.assertTrue(robot.motion_queue.run(segments).wait(60))
+        x, y, _ = sim.pose
+        self.assertAlmostEqual(x, 140, delta=4)
+        self.assertAlmostEqual(y, 130, delta=4)
+
+
+if __name__ == '__main__':
+    unittest.main()
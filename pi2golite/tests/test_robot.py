@@ -0,0 +1,113 @@
+import unittest
+from pi2golite.simGPIO import World
+from tests.simrobot import sim_robot, wheel_config
+
+
+class SnapshotTest(unittest.TestCase):
+    def test_state_follows_edges_without_reading_pins(self):
+        robot, sim, clock = sim_robot(world=World.box(200, 200))
+        self.addCleanup(robot.cleanup)
+        sim.set_pose(100, 100)
+        clock.advance(0.01)
+        reads = []
+        read = sim.input
+
+        def _input(pin):
+            reads.append(pin)
+            return read(pin)
+        sim.input = _input
+        snapshot = robot.snapshot()
+        self.assertFalse(snapshot.obstacle_left)
+        self.assertFalse(snapshot.switch)
+        self.assertIsNone(snapshot.distance)
+        for _ in range(100):
+            robot.components['obstacle_left'].activated
+        self.assertEqual(reads, [])
+
+        #Wall in front of the robot and the switch pressed
+        sim.set_pose(190, 100)
+        sim.switch_pressed = True
+        pressed = clock.monotonic_ns()
+        clock.advance(0.01)
+        snapshot = robot.snapshot()
+        self.assertTrue(snapshot.obstacle_left)
+        self.assertTrue(snapshot.obstacle_right)
+        self.assertTrue(snapshot.switch)
+        self.assertGreater(robot.components['switch'].last_change, pressed)
+        self.assertAlmostEqual(robot.components['distance_sensor'].get_distance(), 10,
+                               delta=1)
+        self.assertEqual(robot.snapshot().distance,
+                         robot.components['distance_sensor'].last_distance)
+
+    def test_wheel_counts(self):
+        robot, sim, clock = sim_robot()
+        self.addCleanup(robot.cleanup)
+        robot.set_speed(50)
+        self.assertTrue(robot.meas_forward(20).wait(10))
+        snapshot = robot.snapshot()
+        self.assertEqual(snapshot.wheelcount_left,
+                         robot.components['wheelcounter_left'].accepted_edges)
+        self.assertGreater(snapshot.wheelcount_right, 10)
+
+
+class DelegationTest(unittest.TestCase):
+    def test_steering_methods_are_bound_once(self):
+        robot, sim, clock = sim_robot()
+        self.addCleanup(robot.cleanup)
+        self.assertIn('forward', robot.__dict__)
+        self.assertEqual(robot.forward, robot.steering.forward)
+        self.assertEqual(robot.meas_forward, robot.measure_steering.forward)
+        self.assertEqual(robot.step_forward, robot.step_steering.forward)
+        #Methods of Robot itself are not replaced by delegated ones
+        self.assertEqual(robot.init.__func__, type(robot).init)
+
+    def test_properties_are_read_on_access(self):
+        robot, sim, clock = sim_robot()
+        self.addCleanup(robot.cleanup)
+        self.assertNotIn('current_speed', robot.__dict__)
+        robot.set_speed(30)
+        self.assertEqual(robot.current_speed, robot.steering.current_speed)
+        robot.set_speed(70)
+        self.assertEqual(robot.current_speed, robot.steering.current_speed)
+        self.assertEqual(robot.meas_step_distance, robot.measure_steering.step_distance)
+
+    def test_unknown_attribute(self):
+        robot, sim, clock = sim_robot()
+        self.addCleanup(robot.cleanup)
+        with self.assertRaises(AttributeError):
+            robot.no_such_command
+        with self.assertRaises(AttributeError):
+            robot.components['wheelsensor_left'].no_such_attribute
+
+    def test_wheel_sensor_delegates_to_line_sensor(self):
+        robot, sim, clock = sim_robot()
+        self.addCleanup(robot.cleanup)
+        wheel_sensor = robot.components['wheelsensor_left']
+        line_sensor = robot.components['linesensor_left']
+        self.assertEqual(wheel_sensor.register_both_callbacks,
+                         line_sensor.register_both_callbacks)
+        self.assertEqual(wheel_sensor.last_change, line_sensor.last_change)
+        robot.set_speed(50)
+        robot.forward()
+        clock.advance(0.5)
+        self.assertEqual(wheel_sensor.activated, line_sensor.activated)
+        self.assertEqual(wheel_sensor.last_change, line_sensor.last_change)
+
+
+class CleanupTest(unittest.TestCase):
+    def test_cleanup_stops_speed_jobs(self):
+        robot, sim, clock = sim_robot(wheel_config(speed_control=True, speed_ramp=True))
+        robot.set_speed(50)
+        robot.forward()
+        clock.advance(0.05)
+        self.assertEqual(clock.scheduler.pending_jobs, 2)
+        robot.cleanup()
+        self.assertEqual(clock.scheduler.pending_jobs, 0)
+        self.assertIsNone(robot.steering.speed_control)
+        self.assertIsNone(robot.steering.speed_ramp)
+        clock.advance(0.5)
+        self.assertEqual(sim.wheel_speeds(), (0, 0))
+
+
+if __name__ == '__main__':
+    unittest.main()
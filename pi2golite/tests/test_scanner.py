@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+from pi2golite.components import Servo
+from pi2golite.scanner import SweepScanner, ECHO_DELAY
+from pi2golite.simGPIO import SimServoBlaster, World
+from tests.simrobot import sim_robot
+
+
+class SweepScannerTest(unittest.TestCase):
+    def _scanner(self, world):
+        robot, sim, clock = sim_robot(world=world)
+        self.addCleanup(robot.cleanup)
+        sim.set_pose(100, 100)
+        servo = Servo(18, 50, 250, 180, SimServoBlaster(sim))
+        servo.init()
+        sensor = robot.components['distance_sensor']
+        scanner = SweepScanner(servo, sensor, clock)
+        self.addCleanup(scanner.close)
+        return scanner, servo, sensor, clock
+
+    def test_servo_moves_on_echo_end(self):
+        scanner, servo, sensor, clock = self._scanner(World.box(200, 200))
+        echoes = []
+        moves = []
+        sensor.add_echo_listener(echoes.append)
+        set_angle = servo.set_angle
+
+        def _set_angle(angle):
+            moves.append(clock.monotonic_ns())
+            set_angle(angle)
+        servo.set_angle = _set_angle
+        scan = scanner.scan()
+        self.assertFalse(np.isnan(scan['range']).any())
+        #First move starts the scan, every other one is sent at an echo end
+        self.assertEqual(moves[1:], echoes[:-1])
+
+    def test_no_echo_costs_echo_window(self):
+        scanner, servo, sensor, clock = self._scanner(World())
+        scanner.set_mode(angles=[90])
+        scanner.scan()
+        start = clock.time()
+        scan = scanner.scan()
+        self.assertTrue(np.isnan(scan['range']).all())
+        self.assertAlmostEqual(clock.time() - start, ECHO_DELAY + 400 / 17150.0, delta=0.002)
+
+
+if __name__ == '__main__':
+    unittest.main()
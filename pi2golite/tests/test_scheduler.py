@@ -0,0 +1,90 @@
+import threading
+import time
+import unittest
+from pi2golite import VirtualClock, use_gpio
+from pi2golite.clock import SystemClock
+from pi2golite.components import DistanceSensor
+from pi2golite.simGPIO import Simulation
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_jobs_run_in_due_order(self):
+        clock = VirtualClock()
+        runs = []
+        clock.call_later(0.3, lambda: runs.append(('c', clock.time())))
+        clock.call_later(0.1, lambda: runs.append(('a', clock.time())))
+        clock.call_later(0.2, lambda: runs.append(('b1', clock.time())))
+        clock.call_later(0.2, lambda: runs.append(('b2', clock.time())))
+        clock.advance(1)
+        #Jobs due at the same time run in the order they were registered
+        self.assertEqual([name for name, _ in runs], ['a', 'b1', 'b2', 'c'])
+        for (_, when), expected in zip(runs, (0.1, 0.2, 0.2, 0.3)):
+            self.assertAlmostEqual(when, expected)
+
+    def test_periodic_job_until_false_or_cancel(self):
+        clock = VirtualClock()
+        ticks = []
+
+        def _count():
+            ticks.append(clock.time())
+            if len(ticks) == 5:
+                return False
+
+        counted = clock.scheduler.call_every(0.1, _count, name='count')
+        cancelled = []
+        other = clock.scheduler.call_every(0.25, lambda: cancelled.append(clock.time()))
+        clock.advance(0.6)
+        other.cancel()
+        clock.advance(1)
+        #Fixed rate from the start, stopped by returning False
+        self.assertEqual(len(ticks), 5)
+        for tick, expected in zip(ticks, (0.0, 0.1, 0.2, 0.3, 0.4)):
+            self.assertAlmostEqual(tick, expected)
+        self.assertTrue(counted.done)
+        self.assertEqual(len(cancelled), 3)
+        self.assertEqual(clock.scheduler.pending_jobs, 0)
+        stats = dict((entry['name'], entry) for entry in clock.scheduler.stats())
+        self.assertEqual(stats['count']['runs'], 5)
+
+    def test_late_periodic_job_skips_slots(self):
+        clock = SystemClock()
+        runs = []
+
+        def _slow():
+            runs.append(time.monotonic())
+            if len(runs) == 1:
+                time.sleep(0.035)
+            return len(runs) < 3
+
+        job = clock.scheduler.call_every(0.01, _slow, name='slow')
+        self.assertTrue(job.wait(2))
+        stats = dict((entry['name'], entry) for entry in clock.scheduler.stats())
+        self.assertEqual(stats['slow']['runs'], 3)
+        self.assertEqual(stats['slow']['overruns'], 1)
+        #Next run keeps the rate - at the next free slot after the late one
+        self.assertGreaterEqual(runs[1] - runs[0], 0.035)
+        self.assertLess(runs[1] - runs[0], 0.05)
+
+    def test_get_distance_from_scheduler_job(self):
+        #Timeout of the measurement is a job of the same scheduler thread
+        clock = SystemClock()
+        sim = Simulation()
+        previous = use_gpio(sim)
+        self.addCleanup(use_gpio, previous)
+        sensor = DistanceSensor(sim.pins['sonar'], timeout=0.05, clock=clock)
+        sensor.init()
+        self.addCleanup(sensor.cleanup)
+        results = []
+        done = threading.Event()
+
+        def _job():
+            results.append(sensor.get_distance())
+            done.set()
+
+        clock.call_later(0, _job)
+        self.assertTrue(done.wait(2))
+        self.assertEqual(results, [0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+import math
+import os
+import shutil
+import tempfile
+import unittest
+from pi2golite import Pi2GoLiteConfig
+from pi2golite.sweep import (ColumnStore, ParameterSweep, SCORE_COLUMNS, grid, ideal_poses,
+                             make_config, random_search, run_trial)
+
+SEGMENTS = [('forward', 40), ('spin_left', 90)] * 4
+
+
+class TrialsTest(unittest.TestCase):
+    def test_grid_combines_values(self):
+        trials = grid(kp=[0.2, 0.5], whl_diameter=[6.3, 6.5, 6.7])
+        self.assertEqual(len(trials), 6)
+        self.assertIn({'kp': 0.5, 'whl_diameter': 6.3}, trials)
+
+    def test_random_search_repeats_with_seed(self):
+        ranges = {'numsteps': (14, 18), 'kp': (0.1, 1.0), 'speed': [30, 50]}
+        trials = random_search(20, seed=3, **ranges)
+        self.assertEqual(trials, random_search(20, seed=3, **ranges))
+        for trial in trials:
+            self.assertIsInstance(trial['numsteps'], int)
+            self.assertTrue(14 <= trial['numsteps'] <= 18)
+            self.assertTrue(0.1 <= trial['kp'] <= 1.0)
+            self.assertIn(trial['speed'], [30, 50])
+
+    def test_make_config_keeps_defaults(self):
+        cfg = make_config({'kp': 0.3, 'whl_diameter': 6.7, 'right_fwdcorr': 5, 'speed': 50})
+        self.assertTrue(cfg.speed_control['avail'])
+        self.assertEqual(cfg.speed_control['param']['kp'], 0.3)
+        self.assertEqual(cfg.wheelsensors['measure_param']['whl_diameter'], 6.7)
+        self.assertEqual(cfg.motor_right['fwdcorr'], 5)
+        self.assertFalse(Pi2GoLiteConfig.speed_control['avail'])
+        self.assertNotEqual(Pi2GoLiteConfig.wheelsensors['measure_param']['whl_diameter'], 6.7)
+        with self.assertRaises(AttributeError):
+            make_config({'no_such_parameter': 1})
+
+    def test_ideal_square_returns_to_start(self):
+        poses = ideal_poses([('forward', 30), ('turn_left', 90)] * 4, robot_width=12)
+        x, y, heading = poses[-1]
+        self.assertAlmostEqual(x, 0)
+        self.assertAlmostEqual(y, 0)
+        self.assertAlmostEqual(heading, 2 * math.pi)
+        self.assertAlmostEqual(poses[0][0], 30)
+        #First turn pivots around the left wheel
+        self.assertAlmostEqual(poses[1][0], 36)
+        self.assertAlmostEqual(poses[1][1], 6)
+
+    def test_run_trial_scores_path_and_time(self):
+        good = run_trial({'speed': 50}, SEGMENTS)
+        wrong = run_trial({'speed': 50, 'whl_diameter': 6.0}, SEGMENTS)
+        self.assertEqual(good['completed'], 1.0)
+        self.assertLess(good['path_error'], 4)
+        self.assertGreater(wrong['path_error'], good['path_error'] + 2)
+        self.assertAlmostEqual(good['score'],
+                               good['path_error'] + 0.1 * good['completion_time'])
+        failed = run_trial({'speed': 50}, SEGMENTS, timeout=0.5)
+        self.assertEqual(failed['completed'], 0.0)
+        self.assertEqual(failed['score'], float('inf'))
+
+
+class ColumnStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def test_partial_row_dropped_on_open(self):
+        path = os.path.join(self.directory, 'store')
+        store = ColumnStore(path, ['a', 'b'], meta={'name': 'test'})
+        store.append({'a': 1, 'b': 2})
+        store.append({'a': 3})
+        store.close()
+        #Interrupted write of a third row
+        with open(os.path.join(path, 'a.f8'), 'ab') as column_file:
+            column_file.write(b'\0' * 8)
+        store = ColumnStore(path)
+        self.assertEqual(len(store), 2)
+        self.assertEqual(list(store.read('a')), [1, 3])
+        self.assertTrue(math.isnan(store.read('b')[1]))
+        self.assertEqual(store.meta, {'name': 'test'})
+        with self.assertRaises(AttributeError):
+            ColumnStore(path, ['a', 'c'])
+
+
+class ParameterSweepTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.path = os.path.join(self.directory, 'sweep')
+        self.trials = grid(speed=[50], whl_diameter=[6.0, 6.5, 7.0])
+
+    def test_interrupted_sweep_resumes(self):
+        def interrupt(index, params, scores):
+            raise KeyboardInterrupt
+
+        sweep = ParameterSweep(self.path, self.trials, SEGMENTS, workers=1)
+        with self.assertRaises(KeyboardInterrupt):
+            sweep.run(interrupt)
+        finished = sweep.finished
+        self.assertEqual(len(finished), 1)
+        #Results belong to this sweep only
+        with self.assertRaises(AttributeError):
+            ParameterSweep(self.path, self.trials[:2], SEGMENTS)
+        run = []
+        sweep = ParameterSweep(self.path, self.trials, SEGMENTS, workers=2)
+        results = sweep.run(lambda index, params, scores: run.append(index))
+        self.assertEqual(sorted(run + list(finished)), [0, 1, 2])
+        self.assertEqual(sorted(results['trial']), [0, 1, 2])
+        self.assertEqual(set(results), set(['trial', 'speed', 'whl_diameter'] +
+                                           list(SCORE_COLUMNS)))
+        score, params = sweep.best()[0]
+        self.assertEqual(params['whl_diameter'], 6.5)
+        self.assertEqual(score, min(results['score']))
+
+    def test_finished_sweep_runs_nothing(self):
+        ParameterSweep(self.path, self.trials, SEGMENTS, workers=2).run()
+        run = []
+        results = ParameterSweep(self.path, self.trials, SEGMENTS).run(
+            lambda index, params, scores: run.append(index))
+        self.assertEqual(run, [])
+        self.assertEqual(len(results['trial']), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,107 @@
+import shutil
+import tempfile
+import unittest
+from pi2golite import Robot, TelemetryRecorder, VirtualClock, set_recorder, use_gpio
+from pi2golite.replay import ReplayGPIO
+from pi2golite.simGPIO import World
+from pi2golite.telemetry import decode_command_args, read_ring
+from tests.simrobot import sim_robot, wheel_config
+
+
+class TelemetryRecorderTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.clock = VirtualClock()
+        self.recorder = TelemetryRecorder(self.directory, capacity=4, clock=self.clock)
+        self.addCleanup(self.recorder.close)
+
+    def test_ring_keeps_newest_records(self):
+        for duty in range(6):
+            self.clock.advance(0.001)
+            self.recorder.record_pwm(26, duty)
+        records = read_ring(self.recorder.path('pwm'))
+        self.assertEqual([record[-1] for record in records], [2, 3, 4, 5])
+        self.assertEqual(self.recorder.counts()['pwm'], 6)
+
+    def test_disabled_recorder_skips_records(self):
+        self.recorder.disable()
+        self.recorder.record_edge(12, 1)
+        self.recorder.enable()
+        self.recorder.record_edge(12, 0)
+        self.assertEqual([record[-1] for record in self.recorder.read('edge')], [0])
+
+    def test_command_records_args_and_kwargs(self):
+        calls = []
+        command = self.recorder.wrap_command(
+            'turn_left', lambda *args, **kwargs: calls.append((args, kwargs)))
+        command(lf_pct=30)
+        command('left', 2.5)
+        recorded = [decode_command_args(record[-1]) for record in self.recorder.read('command')]
+        self.assertEqual(recorded, [((), {'lf_pct': 30}), (('left', 2.5), {})])
+        self.assertEqual(calls, [((), {'lf_pct': 30}), (('left', 2.5), {})])
+
+    def test_command_without_recordable_args(self):
+        command = self.recorder.wrap_command('forward', lambda *args: args)
+        with self.assertLogs('pi2golite.telemetry', 'DEBUG') as logs:
+            command(object())
+            command('x' * 200)
+        self.assertEqual(len(logs.records), 2)
+        recorded = [decode_command_args(record[-1]) for record in self.recorder.read('command')]
+        self.assertEqual(recorded, [None, None])
+
+
+class ReplayTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(set_recorder, None)
+
+    def record(self):
+        cfg = wheel_config(telemetry={'directory': self.directory})
+        robot, sim, clock = sim_robot(cfg, world=World.box(200, 200))
+        sim.set_pose(100, 100)
+        robot.set_speed(speed=40)
+        #Next command is issued from the edge finishing the move - both
+        #are recorded with the same timestamp
+        robot.meas_forward(30).add_done_callback(lambda move: robot.step_spin_right(10))
+        clock.advance(5)
+        robot.turn_left(lf_pct=30)
+        clock.advance(0.5)
+        robot.stop()
+        robot.meas_spin_left(90)
+        clock.advance(3)
+        robot.cleanup()
+        set_recorder(None)
+        robot.telemetry.close()
+        return robot.telemetry.counts()
+
+    def replay(self, **measure_param):
+        replay = ReplayGPIO(self.directory)
+        use_gpio(replay)
+        cfg = wheel_config()
+        cfg.wheelsensors['measure_param'] = dict(cfg.wheelsensors['measure_param'],
+                                                 **measure_param)
+        robot = Robot(cfg, replay.clock)
+        self.addCleanup(robot.cleanup)
+        return replay.run(robot)
+
+    def test_unmodified_stack_replays_ok(self):
+        counts = self.record()
+        report = self.replay()
+        self.assertTrue(report.ok, report.summary())
+        self.assertEqual(report.commands, counts['command'])
+        self.assertEqual(report.edges, counts['edge'])
+        self.assertEqual(report.compared, counts['pwm'])
+
+    def test_modified_stack_diverges(self):
+        self.record()
+        report = self.replay(whl_diameter=6.0)
+        self.assertFalse(report.ok)
+        first = report.first_divergence
+        self.assertEqual(first.channel, 'pwm')
+        self.assertIsNotNone(first.expected)
+
+
+if __name__ == '__main__':
+    unittest.main()